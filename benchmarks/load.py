@@ -0,0 +1,311 @@
+"""Load generator: replays a chat trace through the BoardManager handlers,
+without a chat server, and reports throughput, latency and memory.
+
+The trace is either synthetic (a mix of requests, dones and "is free?"
+questions from random users over random resources) or recorded, in a file with
+one "nick: message" per line. Results can be saved as JSON and compared with
+the results of another version.
+
+Run from the project root with, for example:
+
+    python -m benchmarks.load --users 10000 --resources 5000 \\
+        --messages 100000 --threads 4 --output results.json
+    python -m benchmarks.load --trace chat.log --compare results.json
+
+With --send-delay the replies go through the outbox to a fake chat server that
+takes that long to accept each message, spread over --rooms rooms; with --core
+the commands go through the asyncio core (plugins.core) instead of running in
+the handler threads, and the latency is from queueing a command until it ran.
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from plugins.core import FakeChat
+from plugins.outbox import TokenBucket
+from plugins.resourcemanager import BoardManager
+from plugins.storage import Storage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource as rusage
+except ImportError:
+    rusage = None
+
+
+class Sender(object):
+    def __init__(self, nick):
+        self.nick = nick
+
+
+class Message(dict):
+    """Just enough of a chat message for the handlers."""
+
+    def __init__(self, nick, room=None):
+        super(Message, self).__init__(type='groupchat', mucroom=room)
+        self.sender = Sender(nick)
+
+
+def synthetic_trace(users, resources, messages, mix, seed=42):
+    """A list of (nick, message) with the given mix of commands."""
+    rnd = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[kind] for kind in kinds]
+    total = float(sum(weights))
+    bounds = []
+    running = 0
+    for weight in weights:
+        running += weight
+        bounds.append(running / total)
+
+    trace = []
+    for _ in range(messages):
+        nick = 'user{0}'.format(rnd.randrange(users))
+        board = 'board{0}'.format(rnd.randrange(resources))
+        pick = rnd.random()
+        kind = kinds[-1]
+        for (candidate, bound) in zip(kinds, bounds):
+            if pick < bound:
+                kind = candidate
+                break
+        if kind == 'request':
+            trace.append((nick, 'request ' + board))
+        elif kind == 'done':
+            trace.append((nick, 'done'))
+        elif kind == 'is_free':
+            trace.append((nick, board + ' is free?'))
+        elif kind == 'status':
+            trace.append((nick, 'status board{0}*'.format(rnd.randrange(10))))
+        else:
+            trace.append((nick, 'request any of board{0}*'.format(
+                rnd.randrange(10))))
+    return trace
+
+
+def recorded_trace(path):
+    trace = []
+    with open(path) as content:
+        for line in content:
+            (nick, _, body) = line.strip().partition(': ')
+            if nick and body:
+                trace.append((nick, body))
+    return trace
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def build_robot(resources, core=False, send_delay=None):
+    robot = BoardManager(storage=Storage(), async_core=core)
+    robot.sent = [0]
+
+    if send_delay is None:
+        def say(content, **kwargs):
+            robot.sent[0] += 1
+
+        robot.say = say
+    else:
+        # the fake chat server is the only limit
+        robot.outbox.send = FakeChat(send_delay).send
+        robot.outbox.bucket = TokenBucket(rate=1e9, burst=1e9)
+
+    admin = Message('admin')
+    for start in range(0, resources, 1000):
+        end = min(resources, start + 1000) - 1
+        robot.dispatch_admin(admin, 'add resource board{{{0}..{1}}}'.format(
+            start, end))
+    if robot.core is not None:
+        robot.core.submit(lambda: None).wait()
+    return robot
+
+
+def run(trace, resources, threads, trace_memory=False, core=False,
+        send_delay=None, rooms=1):
+    robot = build_robot(resources, core, send_delay)
+    messages = {}
+    for (nick, _) in trace:
+        if nick not in messages:
+            messages[nick] = Message(nick, 'room{0}'.format(
+                len(messages) % rooms))
+
+    latencies = [[] for _ in range(threads)]
+
+    def worker(number):
+        clock = timeit.default_timer
+        dispatch = robot.dispatch
+        own = latencies[number]
+        for (nick, body) in trace[number::threads]:
+            start = clock()
+            dispatch(messages[nick], body)
+            own.append(clock() - start)
+
+    def core_worker(number):
+        # what dispatch does, keeping the command to see when it ran
+        submit = robot.core.submit
+        own = latencies[number]
+        for (nick, body) in trace[number::threads]:
+            own.append(submit(robot._run_command, robot.router,
+                              messages[nick], body))
+
+    trace_memory = trace_memory and tracemalloc is not None
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    workers = [threading.Thread(target=core_worker if core else worker,
+                                args=(number,))
+               for number in range(threads)]
+    start = timeit.default_timer()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if core:
+        for own in latencies:
+            own[-1].wait()
+            own[:] = [command.finished - command.submitted
+                      for command in own]
+    elapsed = timeit.default_timer() - start
+
+    # how long the chat server takes to get what's left
+    drain = timeit.default_timer()
+    if robot.core is not None:
+        robot.core.stop()
+    else:
+        robot.outbox.stop()
+    drain = timeit.default_timer() - drain
+    if send_delay is not None:
+        robot.sent[0] = robot.outbox.sent
+
+    memory = {}
+    if trace_memory:
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory['traced_bytes'] = current
+        memory['traced_peak_bytes'] = peak
+    if rusage:
+        memory['max_rss_kb'] = rusage.getrusage(rusage.RUSAGE_SELF).ru_maxrss
+
+    merged = sorted(latency for own in latencies for latency in own)
+    return {
+        'messages': len(trace),
+        'seconds': elapsed,
+        'throughput': len(trace) / elapsed if elapsed else None,
+        'latency_ms': dict(
+            ('p{0}'.format(percent),
+             percentile(merged, percent) * 1000 if merged else None)
+            for percent in (50, 90, 95, 99, 100)),
+        'replies': robot.sent[0],
+        'drain_seconds': drain,
+        'memory': memory,
+        'consistency_errors': len(robot._consistency_errors()),
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, previous):
+    """Print how the results changed from a previous run."""
+    print('compared with {0}:'.format(previous.get('version')))
+    pairs = [('throughput', results['throughput'],
+              previous['throughput'])]
+    for (key, value) in sorted(results['latency_ms'].items()):
+        pairs.append(('latency ' + key, value,
+                      previous['latency_ms'].get(key)))
+    for (name, now, before) in pairs:
+        if now is None or not before:
+            continue
+        print('{0:>16}: {1:12.3f} -> {2:12.3f} ({3:+.1f}%)'.format(
+            name, before, now, (now - before) * 100.0 / before))
+    return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--resources', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--mix', default='request=40,done=30,is_free=25,'
+                        'request_any=5',
+                        help='weights of each command in the synthetic trace')
+    parser.add_argument('--trace', help='replay a recorded trace instead')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--core', action='store_true',
+                        help='run the commands in the asyncio core')
+    parser.add_argument('--send-delay', type=float,
+                        help='seconds the fake chat server takes to accept '
+                        'a message')
+    parser.add_argument('--rooms', type=int, default=1,
+                        help='rooms the users talk in')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure the memory allocated during the run '
+                        'with tracemalloc (python 3 only, and much slower)')
+    parser.add_argument('--output', help='save the results as JSON here')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    args = parser.parse_args(argv)
+
+    mix = dict((kind, float(weight)) for (kind, weight)
+               in (item.split('=') for item in args.mix.split(',')))
+    if args.trace:
+        trace = recorded_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.users, args.resources, args.messages,
+                                mix, args.seed)
+
+    results = run(trace, args.resources, args.threads, args.trace_memory,
+                  args.core, args.send_delay, args.rooms)
+    results.update({
+        'version': version(),
+        'python': sys.version.split()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'users': args.users, 'resources': args.resources,
+                   'threads': args.threads, 'mix': mix,
+                   'trace_memory': args.trace_memory, 'core': args.core,
+                   'send_delay': args.send_delay, 'rooms': args.rooms,
+                   'trace': args.trace, 'seed': args.seed},
+    })
+
+    print('{messages} messages in {seconds:.2f}s: {throughput:.0f} '
+          'messages/s, {replies} replies sent, {drain_seconds:.2f}s to send '
+          'the last ones'.format(**results))
+    print('latency (ms): ' + ', '.join(
+        '{0} {1:.3f}'.format(key, value)
+        for (key, value) in sorted(results['latency_ms'].items(),
+                                   key=lambda item: int(item[0][1:]))))
+    print('memory: ' + ', '.join('{0} {1}'.format(key, value)
+                                 for (key, value)
+                                 in sorted(results['memory'].items())))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Memory taken by the resource lists: a dict of lists of nicks (the old
+layout of `resources`) against the dict of plugins.waitlist.Waitlist.
+
+Run from the project root, with Python 3 (for tracemalloc), with:
+
+    python -m benchmarks.memory [entries] [resources]
+"""
+from __future__ import print_function
+
+import gc
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from plugins.names import NAMES
+from plugins.waitlist import Waitlist
+
+
+def footprint(build):
+    """Bytes allocated by `build()` and still held by what it returns."""
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def fill(factory, resources, users):
+    """Every user waiting for one of the resources, round robin."""
+    lists = dict((resource, factory()) for resource in resources)
+    for (number, user) in enumerate(users):
+        lists[resources[number % len(resources)]].append(user)
+    return lists
+
+
+def number_all(names):
+    for name in names:
+        NAMES.id(name)
+    return
+
+
+def main(entries=100000, resources=100):
+    if tracemalloc is None:
+        print('tracemalloc is needed, run it with Python 3')
+        return None
+    # the nicks exist anyway (as the keys of `users`), so they aren't counted
+    users = ['user{0}'.format(number) for number in range(entries)]
+    names = ['board{0}'.format(number) for number in range(resources)]
+
+    print('{0} entries waiting for {1} resources'.format(entries, resources))
+    results = {}
+    # the numbers of the names, shared with the statistics
+    results['names'] = footprint(lambda: number_all(users + names))
+    for (name, factory) in (('list', list), ('Waitlist', Waitlist)):
+        results[name] = footprint(lambda: fill(factory, names, users))
+    for name in ('list', 'Waitlist', 'names'):
+        print('{0:>10}: {1:8.1f} MiB, {2:6.1f} bytes per entry'.format(
+            name, results[name] / 2.0 ** 20,
+            results[name] / float(entries)))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
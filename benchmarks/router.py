@@ -0,0 +1,84 @@
+"""Benchmark of the command matching: a regex per handler, all of them tried on
+every message (how Will matched the plugin's handlers), against the Router.
+
+Run from the project root with:
+
+    python -m benchmarks.router [messages]
+"""
+from __future__ import print_function
+
+import random
+import re
+import sys
+import timeit
+
+from plugins.router import Router
+
+# the handlers, as they were registered with respond_to
+PATTERNS = [
+    (r'add resource (?P<resource>.+)', 'add_resource'),
+    (r'remove resource (?P<resource>.+)', 'remove_resource'),
+    (r'tag resource (?P<resources>.+) as (?P<tag>\S+)', 'tag_resource'),
+    (r'untag resource (?P<resources>.+) from (?P<tag>\S+)',
+     'untag_resource'),
+    (r'lease resource (?P<resources>.+) for (?P<duration>\S+)',
+     'lease_resource'),
+    (r'request (?P<resource>\S+)', 'request'),
+    (r'request any of (?P<resources>.+)', 'request_any'),
+    (r'request any (?P<tag>\S+)', 'request_tag'),
+    (r'done', 'done'),
+    (r'renew', 'renew'),
+    (r'(?P<resource>\S+) is free\?', 'is_free'),
+]
+
+MESSAGES = [
+    'request board{0}',
+    'request any of board*',
+    'request any arm',
+    'done',
+    'board{0} is free?',
+    'renew',
+    'add resource board{0}',
+    'good morning everyone, the build for board{0} is broken again',
+]
+
+
+def per_handler(regexes, messages):
+    """Every regex is tried on every message, like Will does."""
+    for message in messages:
+        for (regex, handler) in regexes:
+            match = regex.search(message)
+            if match:
+                match.groupdict()
+
+
+def routed(router, messages):
+    for message in messages:
+        router.match(message)
+
+
+def main(count=20000, repeat=3):
+    rnd = random.Random(42)
+    messages = [rnd.choice(MESSAGES).format(rnd.randint(1, 500))
+                for _ in range(count)]
+
+    regexes = [(re.compile(pattern, re.IGNORECASE), handler)
+               for (pattern, handler) in PATTERNS]
+    router = Router()
+    for (pattern, handler) in PATTERNS:
+        router.add(pattern, handler)
+
+    print('{0} messages, {1} commands'.format(count, len(PATTERNS)))
+    results = {}
+    for (name, run) in (('regexes', lambda: per_handler(regexes, messages)),
+                        ('router', lambda: routed(router, messages))):
+        best = min(timeit.repeat(run, number=1, repeat=repeat))
+        results[name] = count / best
+        print('{0:>10}: {1:10.0f} messages/s'.format(name, results[name]))
+    print('{0:>10}: {1:10.1f}x'.format(
+        'speedup', results['router'] / results['regexes']))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,56 @@
+"""Snapshots of a large state: size, and how long it takes to save and load
+them as JSON (what the journal keeps) and in the snapshot format
+(plugins.snapshot), and to start a bot from the snapshot.
+
+Run from the project root with:
+
+    python -m benchmarks.snapshot [waiting] [resources]
+"""
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+
+from plugins.resourcemanager import BoardManager
+from plugins.snapshot import dumps, loads
+from plugins.storage import Storage
+
+
+def build_state(waiting, resources):
+    """The state of a bot with `waiting` users spread over the resources."""
+    robot = BoardManager(storage=Storage())
+    for number in range(resources):
+        robot._op_add('board{0}'.format(number))
+    for number in range(waiting):
+        robot._op_request('board{0}'.format(number % resources),
+                          'user{0}'.format(number), float(number))
+    return robot._state()
+
+
+def best(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def main(waiting=100000, resources=1000):
+    state = build_state(waiting, resources)
+    print('{0} users waiting for {1} resources'.format(waiting, resources))
+    formats = (('json', lambda: json.dumps(state).encode('utf-8'),
+                lambda data: json.loads(data.decode('utf-8'))),
+               ('snapshot', lambda: dumps(state), loads))
+    for (name, save, load) in formats:
+        data = save()
+        print('{0:>10}: {1:6.1f} MiB, save {2:7.1f} ms, load {3:7.1f} ms'
+              .format(name, len(data) / 2.0 ** 20, best(save) * 1000,
+                      best(lambda: load(data)) * 1000))
+
+    data = dumps(state)
+    robot = BoardManager(storage=Storage())
+    start = best(lambda: robot._load(loads(data), []))
+    print('{0:>10}: {1:7.1f} ms from the snapshot to a bot with the lists '
+          'back'.format('start', start * 1000))
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
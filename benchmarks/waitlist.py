@@ -0,0 +1,58 @@
+"""Micro-benchmark of the resource waitlists: a plain list (the old storage)
+against plugins.waitlist.Waitlist.
+
+Run from the project root with:
+
+    python -m benchmarks.waitlist [waiters]
+"""
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+
+from plugins.waitlist import Waitlist
+
+
+def workload(factory, users, cancels, lookups):
+    """Fill a list with everyone, telling each one their position as they
+    get in (as `request` does), ask for some positions between cancels of
+    users from the middle and then drain the list from the front."""
+    waitlist = factory()
+    for user in users:
+        if user not in waitlist:
+            waitlist.append(user)
+            waitlist.index(user)
+    for (cancel, user) in zip(cancels, lookups):
+        waitlist.remove(cancel)
+        if user in waitlist:
+            waitlist.index(user)
+    while len(waitlist):
+        if hasattr(waitlist, 'popleft'):
+            waitlist.popleft()
+        else:
+            waitlist.pop(0)
+
+
+def main(waiters=10000, repeat=3):
+    rnd = random.Random(42)
+    users = ['user{0}'.format(i) for i in range(waiters)]
+    cancels = rnd.sample(users, waiters // 10)
+    lookups = rnd.sample(users, waiters // 10)
+
+    print('{0} waiters, {1} cancels, {2} position lookups'.format(
+        waiters, len(cancels), len(lookups)))
+    results = {}
+    for (name, factory) in (('list', list), ('Waitlist', Waitlist)):
+        best = min(timeit.repeat(
+            lambda: workload(factory, users, cancels, lookups),
+            number=1, repeat=repeat))
+        results[name] = best
+        print('{0:>10}: {1:8.3f} ms'.format(name, best * 1000))
+    print('{0:>10}: {1:8.1f}x'.format(
+        'speedup', results['list'] / results['Waitlist']))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
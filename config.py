@@ -129,6 +129,14 @@ ACL = {
 STORAGE_BACKEND = 'file'
 FILE_DIR = './settings/'
 
+# Run the BoardManager commands in an asyncio loop instead of Will's handler
+# threads, sending to several rooms at once (needs Python 3 or trollius).
+# ASYNC_CORE = True
+
+# Where the BoardManager `snapshot` command saves the state (by default,
+# "snapshots" in FILE_DIR).
+# SNAPSHOT_DIR = './settings/snapshots/'
+
 # Disable SSL checks.  Strongly recommended this is not set to True.
 # ALLOW_INSECURE_HIPCHAT_SERVER = False
 
@@ -0,0 +1,447 @@
+import collections
+import logging
+import threading
+import time
+import unittest
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from plugins.metrics import REGISTRY, clock
+from plugins.outbox import WINDOW, Batch, TokenBucket, destination_of
+
+# ----------------------------------------------------------------------
+#  The core
+# ----------------------------------------------------------------------
+
+# commands waiting for the core; past this, the handler threads wait too
+MAX_QUEUED = 1000
+# messages being sent to the chat server at the same time (one per room)
+CONCURRENT_SENDS = 8
+
+QUEUE_WAIT = REGISTRY.histogram('boardmanager_core_queue_seconds', 'queue',
+                                'commands', 'Seconds commands wait for the '
+                                'core.')
+
+
+def use_core():
+    """Tell if Will's settings ask for the core (ASYNC_CORE) and it can run
+    here."""
+    from will import settings
+    if not getattr(settings, 'ASYNC_CORE', False):
+        return False
+    if asyncio is None:
+        logging.warning('ASYNC_CORE needs asyncio (or trollius), running the '
+                        'commands in the handler threads')
+        return False
+    return True
+
+
+class Command(object):
+    """A command waiting for the core, or done."""
+    __slots__ = ('function', 'args', 'kwargs', 'submitted', 'finished',
+                 '_done')
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = clock()
+        self.finished = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait until the command ran; returns False on timeout."""
+        return self._done.wait(timeout)
+
+
+class Core(object):
+    """Runs the commands of the plugin one at a time in an asyncio loop, in
+    a thread of its own.
+
+    The Will handlers only put the command in a queue and go back to Will, so
+    a handler thread doesn't wait for the state lock or for other commands
+    (unless `max_queued` are waiting already, which keeps the time in the
+    queue bounded); the loop takes everything queued each time it wakes up.
+    The commands hold their storage operations and what they say (see
+    `hold`), and the batch is committed with a single `commit` call before
+    the messages go out, so a burst of commands costs one flush. What the
+    commands say goes to an AsyncOutbox in the same loop, which sends to
+    several rooms at the same time: a slow chat server holds the messages of
+    one room, not the commands or the other rooms. Only the loop thread
+    changes the state, so the handlers keep working the same way when they
+    are called directly (by the tests, or when there is no asyncio)."""
+
+    def __init__(self, send, window=WINDOW, bucket=None,
+                 concurrency=CONCURRENT_SENDS, max_queued=MAX_QUEUED,
+                 clock=time.time, commit=None):
+        self.loop = asyncio.new_event_loop()
+        self.outbox = AsyncOutbox(self.loop, send, window, bucket,
+                                  concurrency, clock)
+        self.commit = commit    # waits until an operation is stored
+        self._commands = collections.deque()
+        self._held_seq = 0
+        self._held = []         # (content, kwargs) said by the batch
+        self._max_queued = max_queued
+        self._not_full = threading.Condition()
+        self._blocked = 0       # threads waiting for room in the queue
+        self._lock = threading.Lock()
+        self._waking = False
+        self.processed = 0
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='boardmanager-core')
+        self._thread.daemon = True
+        self._thread.start()
+        self.outbox.thread = self._thread
+
+    def __len__(self):
+        """Commands waiting."""
+        return len(self._commands)
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call for the loop; returns the Command right away, unless
+        the queue is full."""
+        if len(self._commands) >= self._max_queued:
+            with self._not_full:
+                self._blocked += 1
+                while len(self._commands) >= self._max_queued:
+                    self._not_full.wait()
+                self._blocked -= 1
+        command = Command(function, args, kwargs)
+        self._commands.append(command)
+        with self._lock:
+            if self._waking:
+                return command
+            self._waking = True
+        self.loop.call_soon_threadsafe(self._run_commands)
+        return command
+
+    def hold(self, seq, messages):
+        """Keep the last storage operation (`seq`, 0 for none) and what a
+        command said until the batch it runs in is over. Returns False, and
+        holds nothing, outside the loop thread."""
+        if threading.current_thread() is not self._thread:
+            return False
+        self._held_seq = max(self._held_seq, seq)
+        self._held.extend(messages)
+        return True
+
+    def stop(self):
+        """Run what's queued, send what's left and stop the loop."""
+        if self._thread is None:
+            return
+        self.submit(lambda: None).wait()
+        flushed = threading.Event()
+        self.loop.call_soon_threadsafe(self.outbox.flush, flushed.set)
+        flushed.wait()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._thread = None
+        self.loop.close()
+        self.outbox.shutdown()
+        return
+
+    # internals
+
+    def _run_commands(self):
+        with self._lock:
+            self._waking = False
+        while self._commands:
+            batch = []
+            for _ in range(len(self._commands)):
+                command = self._commands.popleft()
+                QUEUE_WAIT.observe(clock() - command.submitted)
+                try:
+                    command.function(*command.args, **command.kwargs)
+                except Exception:
+                    logging.exception('Failed to run %s', command.function)
+                finally:
+                    command.finished = clock()
+                    self.processed += 1
+                    batch.append(command)
+                if self._blocked:
+                    with self._not_full:
+                        self._not_full.notify_all()
+            self._release()
+            for command in batch:
+                command._done.set()
+        return
+
+    def _release(self):
+        """Commit what the batch held and send what it said."""
+        (seq, self._held_seq) = (self._held_seq, 0)
+        (messages, self._held) = (self._held, [])
+        if seq and self.commit is not None:
+            try:
+                self.commit(seq)
+            except Exception:
+                logging.exception('Failed to commit operation %s', seq)
+        for (content, kwargs) in messages:
+            self.outbox.post(content, **kwargs)
+        return
+
+
+class AsyncOutbox(object):
+    """The Outbox, in an asyncio loop: messages to the same room within
+    `window` seconds are sent together and the token bucket limits the rate,
+    but up to `concurrency` rooms are sent to at the same time (in executor
+    threads, Will's `say` being a blocking call). Each room gets its messages
+    in order, one at a time. `post` can be called from any thread."""
+
+    def __init__(self, loop, send, window=WINDOW, bucket=None,
+                 concurrency=CONCURRENT_SENDS, clock=time.time):
+        self.loop = loop
+        self.send = send
+        self.window = window
+        self.bucket = bucket or TokenBucket(clock=clock)
+        self.concurrency = concurrency
+        self.clock = clock
+        self._executor = ThreadPoolExecutor(concurrency) \
+            if ThreadPoolExecutor else None
+        self._queues = {}       # destination -> deque of Batch, oldest first
+        self._busy = set()      # destinations with a batch being sent
+        self._timer = None
+        self._flushed = None    # called once everything is sent, on flush
+        self.thread = None      # the thread running the loop
+        self.sent = 0
+
+    def post(self, content, **kwargs):
+        """Queue a message; kwargs go to `send` along with the content."""
+        if threading.current_thread() is self.thread:
+            self._post(content, kwargs)
+        else:
+            self.loop.call_soon_threadsafe(self._post, content, kwargs)
+        return
+
+    def flush(self, callback):
+        """Send everything queued ignoring the window and the rate limit, and
+        call `callback` when it's all sent. Runs in the loop."""
+        self._flushed = callback
+        self._schedule()
+        return
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        return
+
+    # internals
+
+    def _post(self, content, kwargs):
+        queue = self._queues.setdefault(destination_of(kwargs),
+                                        collections.deque())
+        if not queue or not queue[-1].fits(content):
+            queue.append(Batch(kwargs, self.clock()))
+        queue[-1].add(content)
+        if self._timer is None:
+            # otherwise the timer comes sooner than this batch can go
+            self._schedule()
+        return
+
+    def _schedule(self):
+        """Start sending the batches that can go, oldest first, and come back
+        when the next one can."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        flushing = self._flushed is not None
+        ready = sorted(((queue[0].created, place)
+                        for (place, queue) in self._queues.items()
+                        if place not in self._busy),
+                       key=lambda item: item[0])
+        wait = None
+        for (created, place) in ready:
+            if len(self._busy) >= self.concurrency:
+                break
+            if not flushing:
+                wait = created + self.window - self.clock()
+                if wait > 0:
+                    break
+                wait = self.bucket.take()
+                if wait:
+                    break
+            wait = None
+            self._launch(place)
+
+        if wait is not None:
+            self._timer = self.loop.call_later(wait, self._schedule)
+        elif flushing and not self._queues and not self._busy:
+            (callback, self._flushed) = (self._flushed, None)
+            callback()
+        return
+
+    def _launch(self, place):
+        queue = self._queues[place]
+        batch = queue.popleft()
+        if not queue:
+            del self._queues[place]
+        self._busy.add(place)
+        future = self.loop.run_in_executor(self._executor, self._send, batch)
+        future.add_done_callback(lambda _: self._sent(place))
+        return
+
+    def _sent(self, place):
+        self._busy.discard(place)
+        self._schedule()
+        return
+
+    def _send(self, batch):
+        try:
+            self.send(batch.content(), **batch.kwargs)
+            self.sent += 1
+        except Exception:
+            logging.exception('Failed to send "%s"', batch.content())
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class FakeChat(object):
+    """A chat server that takes `delay` seconds to accept each message."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []      # (content, room, when it arrived)
+        self._lock = threading.Lock()
+
+    def send(self, content, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.sent.append((content, destination_of(kwargs)[1],
+                              time.time()))
+        return
+
+    def rooms(self):
+        found = {}
+        for (content, room, _) in self.sent:
+            found.setdefault(room, []).append(content)
+        return found
+
+
+@unittest.skipIf(asyncio is None, 'needs asyncio')
+class TestCore(unittest.TestCase):
+
+    def setUp(self):
+        self.chat = FakeChat()
+        self.core = Core(self.chat.send, window=0.05,
+                         bucket=TokenBucket(rate=1000, burst=1000))
+
+    def tearDown(self):
+        self.core.stop()
+
+    def test_commands_in_order(self):
+        """Test if the commands run in the loop thread, in the order they
+        were queued, while the callers go on."""
+        done = []
+        threads = set()
+
+        def command(number):
+            done.append(number)
+            threads.add(threading.current_thread().name)
+            time.sleep(0.001)
+
+        commands = [self.core.submit(command, number) for number in range(50)]
+        self.assertTrue(len(done) < 50)
+        self.assertTrue(commands[-1].wait(5))
+        self.assertEquals(done, list(range(50)))
+        self.assertEquals(threads, set(['boardmanager-core']))
+        self.assertTrue(commands[-1].finished >= commands[0].finished)
+        self.assertEquals(self.core.processed, 50)
+        return
+
+    def test_full_queue(self):
+        """Test if queueing waits while the queue is full."""
+        core = Core(self.chat.send, max_queued=2)
+        started = threading.Event()
+        go_on = threading.Event()
+        core.submit(lambda: (started.set(), go_on.wait()))
+        started.wait(5)
+        core.submit(lambda: None)
+        core.submit(lambda: None)
+        third = []
+        thread = threading.Thread(
+            target=lambda: third.append(core.submit(lambda: None)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEquals(third, [])
+        go_on.set()
+        thread.join(5)
+        self.assertTrue(third[0].wait(5))
+        core.stop()
+        return
+
+    def test_failing_command(self):
+        """Test if a command that fails doesn't stop the others."""
+        done = []
+        self.core.submit(lambda: 1 / 0)
+        self.assertTrue(self.core.submit(done.append, 'ok').wait(5))
+        self.assertEquals(done, ['ok'])
+        return
+
+    def test_commit_per_batch(self):
+        """Test if the operations held by the commands queued together are
+        committed once, before what they said is sent."""
+        commits = []
+        self.core.commit = lambda seq: commits.append(
+            (seq, self.core.outbox.sent, self.chat.rooms()))
+        started = threading.Event()
+        go_on = threading.Event()
+        self.core.submit(lambda: (started.set(), go_on.wait()))
+        started.wait(5)
+        for seq in range(1, 11):
+            self.core.submit(self.core.hold, seq,
+                             [('@u{0} hi'.format(seq), {'room': 'R1'})])
+        go_on.set()
+        self.assertFalse(self.core.hold(11, []))
+        self.core.stop()
+        self.assertEquals(commits, [(10, 0, {})])
+        self.assertEquals(self.chat.rooms(),
+                          {'R1': ['\n'.join('@u{0} hi'.format(seq)
+                                            for seq in range(1, 11))]})
+        return
+
+    def test_slow_chat(self):
+        """Test if a slow chat server only holds the room it sends to, and
+        every room gets its messages in order."""
+        self.chat.delay = 0.3
+        start = time.time()
+        for room in ('R1', 'R2', 'R3', 'R4'):
+            self.core.outbox.post('@a first', room=room)
+        time.sleep(0.1)
+        for room in ('R1', 'R2', 'R3', 'R4'):
+            self.core.outbox.post('@a second', room=room)
+        self.core.stop()
+        # two rounds of four rooms at once; one at a time it would take 2.4s
+        self.assertTrue(time.time() - start < 1.2)
+        self.assertEquals(self.chat.rooms(),
+                          dict((room, ['@a first', '@a second'])
+                               for room in ('R1', 'R2', 'R3', 'R4')))
+        return
+
+    def test_coalesce(self):
+        """Test if messages to the same room are still sent together."""
+        self.core.outbox.post('@a one', room='R1')
+        self.core.outbox.post('@b two', room='R1')
+        self.core.outbox.post('@a three', room='R2')
+        self.core.stop()
+        self.assertEquals(self.chat.rooms(), {'R1': ['@a one\n@b two'],
+                                              'R2': ['@a three']})
+        self.assertEquals(self.core.outbox.sent, 2)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from plugins.storage import Storage
+
+# ----------------------------------------------------------------------
+#  The journal
+# ----------------------------------------------------------------------
+
+# after this many operations in the log, it's time for a new snapshot
+SNAPSHOT_EVERY = 1000
+
+
+class Journal(Storage):
+    """Storage in files: an append-only log of the operations done on the
+    resources, with periodic snapshots of the whole state.
+
+    Every operation is a JSON line in `<name>.log`. Writers don't fsync the
+    file themselves: they queue their line and whoever gets the flush lock
+    first writes and fsyncs everything queued so far, so a burst of commands
+    costs a single flush (group commit). A snapshot holds the whole state and
+    the sequence number of the last operation in it; once it is safely on disk
+    the log is truncated, so a restart only needs to load the snapshot and
+    replay what came after it."""
+
+    def __init__(self, directory, name='boardmanager',
+                 snapshot_every=SNAPSHOT_EVERY):
+        self.log_path = os.path.join(directory, name + '.log')
+        self.snapshot_path = os.path.join(directory, name + '.snapshot')
+        self.snapshot_every = snapshot_every
+
+        self._lock = threading.Lock()        # protects _seq and _pending
+        self._flush_lock = threading.Lock()  # one writer in the file at a time
+        self._pending = []
+        self._seq = 0
+        self._durable = 0
+        self._logged = 0        # operations in the log since the snapshot
+        self._log = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self):
+        """Read the latest snapshot and the operations logged after it.
+        Returns the snapshot state (None if there is no snapshot) and a list
+        of (operation, args)."""
+        state = None
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as content:
+                snapshot = json.load(content)
+            state = snapshot['state']
+            snapshot_seq = snapshot['seq']
+
+        operations = []
+        self._seq = snapshot_seq
+        if os.path.exists(self.log_path):
+            end = 0     # where the last complete line ends
+            with open(self.log_path, 'rb') as content:
+                for line in content:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('torn write')
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # a torn write in the end of the log; the operation
+                        # was never acknowledged, so just drop it.
+                        break
+                    end += len(line)
+                    if record['seq'] <= snapshot_seq:
+                        continue
+                    operations.append((record['op'], record['args']))
+                    self._seq = record['seq']
+            if end < os.path.getsize(self.log_path):
+                # cut it off, or the next operations would be appended to
+                # the same line and dropped with it in the next restart
+                with open(self.log_path, 'r+b') as log:
+                    log.truncate(end)
+                    os.fsync(log.fileno())
+
+        self._durable = self._seq
+        self._logged = len(operations)
+        return (state, operations)
+
+    def record(self, op, *args):
+        """Queue an operation for the log, without waiting for the disk.
+        Returns its sequence number, for commit()."""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._pending.append(json.dumps({'seq': seq,
+                                             'op': op,
+                                             'args': args}) + '\n')
+        return seq
+
+    def commit(self, seq):
+        """Wait until the operation `seq` (and everything before it) is on
+        disk."""
+        with self._flush_lock:
+            if self._durable >= seq:
+                # someone else flushed our operation while we waited
+                return
+            self._flush()
+        return
+
+    def needs_snapshot(self):
+        """Tell if the log grew enough to be worth a snapshot."""
+        return self._logged >= self.snapshot_every
+
+    def snapshot(self, state):
+        """Save the state as a snapshot and clear the log. The state must
+        include every operation appended so far."""
+        with self._flush_lock:
+            self._flush()
+            snapshot = json.dumps({'seq': self._durable, 'state': state})
+
+            directory = os.path.dirname(self.snapshot_path) or '.'
+            (handle, temp_path) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, 'w') as temp:
+                temp.write(snapshot)
+                temp.flush()
+                os.fsync(temp.fileno())
+            os.rename(temp_path, self.snapshot_path)
+            self._fsync_dir(directory)
+
+            # everything in the log is in the snapshot now
+            self._open_log().truncate(0)
+            self._logged = 0
+        return
+
+    def close(self):
+        with self._flush_lock:
+            self._flush()
+            if self._log:
+                self._log.close()
+                self._log = None
+        return
+
+    # internals
+
+    def _flush(self):
+        """Write and fsync everything pending. Must hold the flush lock."""
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+            last = self._seq
+        if not batch:
+            return
+
+        log = self._open_log()
+        log.write(''.join(batch))
+        log.flush()
+        os.fsync(log.fileno())
+        self._durable = last
+        self._logged += len(batch)
+        return
+
+    def _open_log(self):
+        if not self._log:
+            self._log = open(self.log_path, 'a')
+        return self._log
+
+    def _fsync_dir(self, directory):
+        try:
+            handle = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(handle)
+        except OSError:
+            pass
+        finally:
+            os.close(handle)
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        """Test if the operations come back in the same order."""
+        journal = Journal(self.directory)
+        journal.append('add', 'A')
+        journal.append('request', 'A', 'user')
+        journal.close()
+
+        (state, operations) = Journal(self.directory).load()
+        self.assertEquals(state, None)
+        self.assertEquals(operations, [('add', ['A']),
+                                       ('request', ['A', 'user'])])
+        return
+
+    def test_snapshot(self):
+        """Test if a snapshot replaces the log and only the operations after
+        it are replayed."""
+        journal = Journal(self.directory, snapshot_every=2)
+        journal.append('add', 'A')
+        self.assertFalse(journal.needs_snapshot())
+        journal.append('add', 'B')
+        self.assertTrue(journal.needs_snapshot())
+        journal.snapshot({'resources': {'A': [], 'B': []}})
+        self.assertFalse(journal.needs_snapshot())
+        journal.append('remove', 'B')
+        journal.close()
+
+        journal = Journal(self.directory)
+        (state, operations) = journal.load()
+        self.assertEquals(state, {'resources': {'A': [], 'B': []}})
+        self.assertEquals(operations, [('remove', ['B'])])
+        self.assertEquals(journal.append('add', 'C'), 4)
+        return
+
+    def test_torn_write(self):
+        """Test if a half-written line in the end of the log is ignored."""
+        journal = Journal(self.directory)
+        journal.append('add', 'A')
+        journal.close()
+        with open(journal.log_path, 'a') as log:
+            log.write('{"seq": 2, "op": "ad')
+
+        (_, operations) = Journal(self.directory).load()
+        self.assertEquals(operations, [('add', ['A'])])
+        return
+
+    def test_append_after_torn_write(self):
+        """Test if the operations logged after a torn write survive the next
+        restart."""
+        journal = Journal(self.directory)
+        journal.append('add', 'A')
+        journal.close()
+        with open(journal.log_path, 'a') as log:
+            log.write('{"seq": 2, "op": "ad')
+
+        journal = Journal(self.directory)
+        journal.load()
+        journal.append('add', 'B')
+        journal.append('add', 'C')
+        journal.close()
+
+        (_, operations) = Journal(self.directory).load()
+        self.assertEquals(operations, [('add', ['A']), ('add', ['B']),
+                                       ('add', ['C'])])
+        return
+
+    def test_group_commit(self):
+        """Test if concurrent writers share the flushes."""
+        journal = Journal(self.directory)
+        writers = 10
+        flushes = []
+        queued = threading.Condition()
+        original_fsync = os.fsync
+        original_record = journal.record
+
+        def counting_record(op, *args):
+            with queued:
+                seq = original_record(op, *args)
+                queued.notify_all()
+            return seq
+
+        def counting_fsync(handle):
+            if not flushes:
+                # hold the first flush until every writer queued its
+                # operation, so they are all waiting for the disk at once
+                with queued:
+                    while journal._seq < writers:
+                        queued.wait(5)
+            flushes.append(handle)
+            return original_fsync(handle)
+
+        def writer(number):
+            journal.append('add', str(number))
+
+        journal.record = counting_record
+        os.fsync = counting_fsync
+        try:
+            threads = [threading.Thread(target=writer, args=(number,))
+                       for number in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.fsync = original_fsync
+        journal.close()
+
+        (_, operations) = Journal(self.directory).load()
+        self.assertEquals(len(operations), writers)
+        # the first writer's flush, and a single one for all the others
+        self.assertTrue(len(flushes) <= 2)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
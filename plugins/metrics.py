@@ -0,0 +1,188 @@
+import bisect
+import functools
+import threading
+import timeit
+import unittest
+
+# ----------------------------------------------------------------------
+#  The metrics
+# ----------------------------------------------------------------------
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+           0.5, 1.0, 5.0)
+
+clock = timeit.default_timer
+
+
+class Histogram(object):
+    """Latency histogram in the Prometheus way: a count per bucket, the sum
+    and the number of observations. Observing is a bisect and three
+    additions."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += seconds
+            self.count += 1
+        return
+
+    def cumulative(self):
+        """(upper bound, observations up to it) for each bucket."""
+        total = 0
+        result = []
+        for (bound, count) in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry(object):
+    """The histograms, by metric name and label."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, label, value, help=''):
+        key = (name, label, value)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+                self.help.setdefault(name, help)
+        return histogram
+
+    def render(self, gauges=()):
+        """The metrics in the text exposition format. `gauges` is a list of
+        (name, help, type, [(labels, value)]) to include along with the
+        histograms."""
+        lines = []
+        by_name = {}
+        for key in sorted(self.histograms):
+            by_name.setdefault(key[0], []).append(key)
+
+        for name in sorted(by_name):
+            lines.append('# HELP {name} {help}'.format(
+                name=name, help=self.help[name]))
+            lines.append('# TYPE {name} histogram'.format(name=name))
+            for key in by_name[name]:
+                (_, label, value) = key
+                histogram = self.histograms[key]
+                for (bound, count) in histogram.cumulative():
+                    lines.append('{name}_bucket{{{label}="{value}",'
+                                 'le="{bound}"}} {count}'.format(
+                                     name=name, label=label, value=value,
+                                     bound=bound, count=count))
+                lines.append('{name}_sum{{{label}="{value}"}} {sum}'.format(
+                    name=name, label=label, value=value,
+                    sum=repr(histogram.sum)))
+                lines.append('{name}_count{{{label}="{value}"}} '
+                             '{count}'.format(name=name, label=label,
+                                              value=value,
+                                              count=histogram.count))
+
+        for (name, help, kind, samples) in gauges:
+            lines.append('# HELP {name} {help}'.format(name=name, help=help))
+            lines.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+            for (labels, value) in samples:
+                labels = ','.join('{0}="{1}"'.format(key, escape(label))
+                                  for (key, label) in sorted(labels.items()))
+                lines.append('{name}{labels} {value}'.format(
+                    name=name, labels='{' + labels + '}' if labels else '',
+                    value=value))
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+
+def timed(metric, label, help=''):
+    """Observe how long each call of the function takes in the histogram
+    `metric`, labelled with the function name."""
+    def decorator(function):
+        histogram = REGISTRY.histogram(metric, label, function.__name__, help)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(clock() - start)
+        return wrapper
+    return decorator
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        """Test if observations land in the right buckets."""
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 2):
+            histogram.observe(seconds)
+        self.assertEquals(histogram.cumulative(),
+                          [(0.1, 2), (1.0, 3), ('+Inf', 4)])
+        self.assertEquals(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        return
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_render(self):
+        """Test the exposition format."""
+        registry = Registry()
+        histogram = registry.histogram('test_seconds', 'handler', 'done',
+                                       'Time in handlers.')
+        histogram.buckets = (1.0,)
+        histogram.counts = [0, 0]
+        histogram.observe(0.5)
+        text = registry.render([('test_depth', 'Users waiting.', 'gauge',
+                                 [({'resource': 'A"1'}, 3)])])
+        self.assertEquals(text.splitlines(), [
+            '# HELP test_seconds Time in handlers.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{handler="done",le="1.0"} 1',
+            'test_seconds_bucket{handler="done",le="+Inf"} 1',
+            'test_seconds_sum{handler="done"} 0.5',
+            'test_seconds_count{handler="done"} 1',
+            '# HELP test_depth Users waiting.',
+            '# TYPE test_depth gauge',
+            'test_depth{resource="A\\"1"} 3'])
+        return
+
+    def test_timed(self):
+        """Test if the decorator observes every call."""
+        @timed('test_timed_seconds', 'function')
+        def function():
+            return 42
+
+        self.assertEquals(function(), 42)
+        histogram = REGISTRY.histograms[('test_timed_seconds', 'function',
+                                         'function')]
+        self.assertEquals(histogram.count, 1)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import threading
+import unittest
+
+# ----------------------------------------------------------------------
+#  The names
+# ----------------------------------------------------------------------
+
+
+class Names(object):
+    """Numbers for the names of users and resources, so the same name is the
+    same number while something uses it. Structures with many entries keep
+    the numbers, in arrays, instead of a reference to the name in each entry.
+
+    Every `id` takes a reference to the number, and `release` gives it back;
+    once no one uses a name, it is forgotten and its number goes to the next
+    new name, so users who come and go don't pile up."""
+
+    def __init__(self):
+        self._names = []
+        self._ids = {}
+        self._counts = []       # references to each number
+        self._free = []         # numbers no name has now
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Names in use."""
+        return len(self._ids)
+
+    def id(self, name):
+        """The number of the name, giving it one if it's new; the caller
+        must `release` it when done with it."""
+        with self._lock:
+            number = self._ids.get(name)
+            if number is None:
+                if self._free:
+                    number = self._free.pop()
+                    self._names[number] = name
+                else:
+                    number = len(self._names)
+                    self._names.append(name)
+                    self._counts.append(0)
+                self._ids[name] = number
+            self._counts[number] += 1
+            return number
+
+    def release(self, number):
+        """Give back a reference taken by `id`."""
+        with self._lock:
+            self._counts[number] -= 1
+            if not self._counts[number]:
+                del self._ids[self._names[number]]
+                self._names[number] = None
+                self._free.append(number)
+        return
+
+    def find(self, name):
+        """The number of the name, or None if it never got one."""
+        return self._ids.get(name)
+
+    def name(self, number):
+        return self._names[number]
+
+
+# the numbers every structure shares
+NAMES = Names()
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestNames(unittest.TestCase):
+
+    def test_same_number(self):
+        """Test if a name keeps its number and numbers give the names
+        back."""
+        names = Names()
+        self.assertEquals(names.id('user'), 0)
+        self.assertEquals(names.id('board'), 1)
+        self.assertEquals(names.id('user'), 0)
+        self.assertEquals(names.name(1), 'board')
+        self.assertEquals(names.find('board'), 1)
+        self.assertEquals(names.find('nobody'), None)
+        self.assertEquals(len(names), 2)
+        return
+
+    def test_release(self):
+        """Test if a name is forgotten once every reference is given back,
+        and its number goes to the next new name."""
+        names = Names()
+        user = names.id('user')
+        names.id('user')
+        names.release(user)
+        self.assertEquals(names.find('user'), user)
+        names.release(user)
+        self.assertEquals(names.find('user'), None)
+        self.assertEquals(len(names), 0)
+        self.assertEquals(names.id('other'), user)
+        self.assertEquals(names.name(user), 'other')
+        self.assertEquals(names.id('board'), 1)
+        return
+
+    def test_threads(self):
+        """Test if threads naming the same users get the same numbers."""
+        names = Names()
+        users = ['user{0}'.format(number) for number in range(1000)]
+        found = []
+        threads = [threading.Thread(
+            target=lambda: found.append([names.id(user) for user in users]))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(names), len(users))
+        for numbers in found:
+            self.assertEquals([names.name(number) for number in numbers],
+                              users)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
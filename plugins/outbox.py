@@ -0,0 +1,329 @@
+import itertools
+import logging
+import threading
+import time
+import unittest
+
+# ----------------------------------------------------------------------
+#  The outbox
+# ----------------------------------------------------------------------
+
+# how long a message waits for others going to the same room
+WINDOW = 0.5
+# the chat server accepts this many messages per second, in bursts of BURST
+RATE = 0.5
+BURST = 5
+# HipChat refuses longer messages
+MAX_LENGTH = 10000
+
+
+class TokenBucket(object):
+    """Classic token bucket: `rate` tokens per second, up to `burst`."""
+
+    def __init__(self, rate=RATE, burst=BURST, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._last = clock()
+
+    def take(self):
+        """Take a token. Returns 0 if there was one, or how many seconds to
+        wait for the next one."""
+        now = self.clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class Batch(object):
+    """Messages going to the same place, merged into a single one. Lines
+    mentioning the same user are joined, and repeated lines are dropped."""
+
+    def __init__(self, kwargs, created):
+        self.kwargs = kwargs
+        self.created = created
+        self.lines = []
+        self.length = 0         # of the lines, plus a newline after each
+        self._mentions = {}     # user -> position in lines
+        self._texts = {}        # user -> texts already in their line
+
+    def add(self, content):
+        if content in self.lines:
+            return
+
+        (mention, _, text) = content.partition(' ')
+        if not mention.startswith('@') or mention == '@all' or not text:
+            self._append(content)
+            return
+
+        if mention in self._mentions:
+            position = self._mentions[mention]
+            if text not in self._texts[mention]:
+                self._texts[mention].add(text)
+                self.lines[position] += ' ' + text
+                self.length += len(text) + 1
+            return
+
+        self._mentions[mention] = len(self.lines)
+        self._texts[mention] = set([text])
+        self._append(content)
+
+    def fits(self, content):
+        """Tell if the content can go in the batch without making the message
+        too long."""
+        return not self.lines or self.length + len(content) <= MAX_LENGTH
+
+    def _append(self, content):
+        self.lines.append(content)
+        self.length += len(content) + 1
+
+    def content(self):
+        return '\n'.join(self.lines)
+
+
+def destination_of(kwargs):
+    """Where a message goes. Messages can only be merged if they go to the
+    same room with the same options; direct messages are never merged."""
+    message = kwargs.get('message')
+    room = kwargs.get('room')
+    if room is None and message is not None:
+        try:
+            if message['type'] != 'groupchat':
+                return ('message', id(message))
+            room = message['mucroom']
+        except (KeyError, TypeError):
+            room = None
+    options = tuple(sorted((key, value)
+                           for (key, value) in kwargs.items()
+                           if key not in ('message', 'room')))
+    return ('room', room, options)
+
+
+class Outbox(object):
+    """Queue for the messages the bot sends. Whoever posts a message doesn't
+    wait for the chat server: a background thread collects what was posted to
+    the same room in the last `window` seconds, sends it as a single message
+    and keeps the sending rate under the token bucket limits."""
+
+    def __init__(self, send, window=WINDOW, bucket=None, clock=time.time):
+        self.send = send
+        self.window = window
+        self.bucket = bucket or TokenBucket(clock=clock)
+        self.clock = clock
+
+        self._condition = threading.Condition()
+        self._batches = {}      # destination -> Batch
+        self._order = []        # destinations, oldest batch first
+        self._sealed = itertools.count()
+        self._thread = None
+        self._running = False
+        self.sent = 0
+
+    def post(self, content, **kwargs):
+        """Queue a message; kwargs go to `send` along with the content."""
+        destination = destination_of(kwargs)
+        with self._condition:
+            batch = self._batches.get(destination)
+            if batch is not None and not batch.fits(content):
+                self._seal(destination)
+                batch = None
+            if batch is None:
+                batch = Batch(kwargs, self.clock())
+                self._batches[destination] = batch
+                self._order.append(destination)
+            batch.add(content)
+            self._condition.notify()
+        self._start()
+        return
+
+    def flush(self):
+        """Send everything queued right now, ignoring the window and the rate
+        limit."""
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            self._send(batch)
+
+    def stop(self):
+        """Stop the sending thread, sending what's left."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        return
+
+    # internals
+
+    def _seal(self, destination):
+        """Keep the batch in its place in the queue, but don't add anything
+        else to it."""
+        sealed = ('sealed', next(self._sealed))
+        self._batches[sealed] = self._batches.pop(destination)
+        self._order[self._order.index(destination)] = sealed
+        return
+
+    def _next_batch(self):
+        if not self._order:
+            return None
+        destination = self._order.pop(0)
+        return self._batches.pop(destination)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='boardmanager-outbox')
+            self._thread.daemon = True
+            self._thread.start()
+        return
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._order:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                oldest = self._batches[self._order[0]].created
+
+            # give the batch some time to collect more messages
+            delay = oldest + self.window - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+
+            delay = self.bucket.take()
+            while delay:
+                time.sleep(delay)
+                delay = self.bucket.take()
+
+            with self._condition:
+                batch = self._next_batch()
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch):
+        try:
+            self.send(batch.content(), **batch.kwargs)
+            self.sent += 1
+        except Exception:
+            logging.exception('Failed to send "%s"', batch.content())
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestBatch(unittest.TestCase):
+
+    def test_merge(self):
+        """Test if lines to the same user are merged and repeated lines are
+        dropped."""
+        batch = Batch({}, 0)
+        batch.add('@user A is free.')
+        batch.add('@all B is free to use.')
+        batch.add('@user B is free.')
+        batch.add('@user A is free.')
+        batch.add('@all B is free to use.')
+        self.assertEquals(batch.content(),
+                          '@user A is free. B is free.\n'
+                          '@all B is free to use.')
+        self.assertEquals(batch.length, len(batch.content()) + 1)
+        return
+
+    def test_merge_similar(self):
+        """Test if a line is kept when its text is only part of a line merged
+        before."""
+        batch = Batch({}, 0)
+        batch.add('@user AA is free.')
+        batch.add('@user A is free.')
+        batch.add('@user AA is free.')
+        self.assertEquals(batch.content(), '@user AA is free. A is free.')
+        return
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        """Test if the bucket allows the burst and then refills at the
+        rate."""
+        now = [0.0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEquals([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertEquals(bucket.take(), 0.5)
+        now[0] += 0.5
+        self.assertEquals(bucket.take(), 0)
+        return
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.outbox = Outbox(self._send, window=0.05,
+                             bucket=TokenBucket(rate=100, burst=100))
+
+    def tearDown(self):
+        self.outbox.stop()
+
+    def _send(self, content, **kwargs):
+        self.sent.append((content, kwargs.get('room')))
+
+    def test_coalesce(self):
+        """Test if messages to the same room are sent together."""
+        self.outbox.post('@a one', room='R1')
+        self.outbox.post('@b two', room='R1')
+        self.outbox.post('@a three', room='R2')
+        self.outbox.stop()
+        self.assertEquals(sorted(self.sent), [('@a one\n@b two', 'R1'),
+                                              ('@a three', 'R2')])
+        return
+
+    def test_background(self):
+        """Test if the thread sends the messages after the window."""
+        self.outbox.post('hello', room='R1')
+        deadline = time.time() + 5
+        while not self.sent and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.sent, [('hello', 'R1')])
+        return
+
+    def test_long_messages(self):
+        """Test if messages that would be too long together are sent
+        apart, in order."""
+        first = 'a' * (MAX_LENGTH - 10)
+        second = 'b' * 20
+        self.outbox.post(first, room='R1')
+        self.outbox.post(second, room='R1')
+        self.outbox.post('c', room='R1')
+        self.outbox.stop()
+        self.assertEquals(self.sent, [(first, 'R1'), (second + '\nc', 'R1')])
+        return
+
+    def test_direct_messages(self):
+        """Test if messages in direct chats are not merged."""
+        first = {'type': 'chat'}
+        second = {'type': 'chat'}
+        self.outbox.post('@a one', message=first)
+        self.outbox.post('@a two', message=second)
+        self.outbox.flush()
+        self.assertEquals(len(self.sent), 2)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import random
+import unittest
+
+# ----------------------------------------------------------------------
+#  The reservations
+# ----------------------------------------------------------------------
+
+
+class Node(object):
+    __slots__ = ('start', 'end', 'value', 'priority', 'left', 'right',
+                 'max_end')
+
+    def __init__(self, start, end, value, priority):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+
+class IntervalTree(object):
+    """Intervals [start, end), each with a value, in a treap sorted by start
+    where every node also knows the latest end in its subtree.
+
+    Adding and removing are O(log n) (expected, the treap being balanced by
+    random priorities). Finding the intervals that overlap a range only goes
+    into subtrees that end after the range starts and begin before it ends,
+    so it's O(log n) plus the intervals found; the same goes for walking the
+    intervals from a point in time on, which is what finding a free slot
+    does."""
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+        self._random = random.Random()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """The intervals, as (start, end, value), by start."""
+        return self.after(None)
+
+    def add(self, start, end, value=None):
+        if not start < end:
+            raise ValueError('empty interval')
+        node = Node(start, end, value, self._random.random())
+        (before, after) = self._split(self._root, start)
+        self._root = self._merge(self._merge(before, node), after)
+        self._size += 1
+        return
+
+    def remove(self, start):
+        """Remove the interval starting at `start`; returns it as (start,
+        end, value), or None if there's no such interval."""
+        (before, rest) = self._split(self._root, start)
+        (found, after) = self._split(rest, start, inclusive=True)
+        interval = None
+        if found is not None:
+            # intervals starting at the same time can't be told apart, take
+            # the first one
+            interval = (found.start, found.end, found.value)
+            found = self._merge(found.left, found.right)
+            self._size -= 1
+        self._root = self._merge(self._merge(before, found), after)
+        return interval
+
+    def first(self):
+        """The interval that starts first, or None."""
+        node = self._root
+        if node is None:
+            return None
+        while node.left is not None:
+            node = node.left
+        return (node.start, node.end, node.value)
+
+    def overlapping(self, start, end):
+        """The intervals that overlap [start, end), by start."""
+        found = []
+        pending = [self._root]
+        while pending:
+            node = pending.pop()
+            if node is None or node.max_end <= start:
+                continue
+            if node.start < end:
+                if node.end > start:
+                    found.append((node.start, node.end, node.value))
+                pending.append(node.right)
+            pending.append(node.left)
+        found.sort(key=lambda interval: interval[0])
+        return found
+
+    def after(self, when):
+        """The intervals that end after `when` (all of them if it's None), by
+        start."""
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            if node is not None:
+                if when is not None and node.max_end <= when:
+                    node = None
+                    continue
+                stack.append(node)
+                node = node.left
+                continue
+            node = stack.pop()
+            if when is None or node.end > when:
+                yield (node.start, node.end, node.value)
+            node = node.right
+
+    def free_slot(self, when, length):
+        """The start of the first gap of at least `length` from `when` on."""
+        for (start, end, _) in self.after(when):
+            if start - when >= length:
+                break
+            when = max(when, end)
+        return when
+
+    # internals
+
+    def _update(self, node):
+        node.max_end = node.end
+        for child in (node.left, node.right):
+            if child is not None and child.max_end > node.max_end:
+                node.max_end = child.max_end
+        return node
+
+    def _split(self, node, start, inclusive=False):
+        """Split the tree in the nodes starting before `start` (or at it, if
+        inclusive) and the rest."""
+        if node is None:
+            return (None, None)
+        if node.start < start or (inclusive and node.start == start):
+            (left, right) = self._split(node.right, start, inclusive)
+            node.right = left
+            return (self._update(node), right)
+        (left, right) = self._split(node.left, start, inclusive)
+        node.left = right
+        return (left, self._update(node))
+
+    def _merge(self, left, right):
+        """Join two trees, everything in `left` starting before `right`."""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            return self._update(left)
+        right.left = self._merge(left, right.left)
+        return self._update(right)
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestIntervalTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = IntervalTree()
+        for (start, end) in ((10, 20), (30, 40), (0, 5), (50, 100)):
+            self.tree.add(start, end, 'user{0}'.format(start))
+
+    def test_order(self):
+        """Test if the intervals come out by start."""
+        self.assertEquals([start for (start, _, _) in self.tree],
+                          [0, 10, 30, 50])
+        self.assertEquals(self.tree.first(), (0, 5, 'user0'))
+        self.assertEquals(len(self.tree), 4)
+        self.assertRaises(ValueError, self.tree.add, 5, 5)
+        return
+
+    def test_overlapping(self):
+        """Test if only the intervals overlapping the range are found."""
+        self.assertEquals(self.tree.overlapping(5, 10), [])
+        self.assertEquals(self.tree.overlapping(15, 35),
+                          [(10, 20, 'user10'), (30, 40, 'user30')])
+        self.assertEquals(self.tree.overlapping(60, 61),
+                          [(50, 100, 'user50')])
+        return
+
+    def test_remove(self):
+        """Test if removing an interval keeps the others."""
+        self.assertEquals(self.tree.remove(30), (30, 40, 'user30'))
+        self.assertEquals(self.tree.remove(30), None)
+        self.assertEquals(self.tree.overlapping(0, 1000),
+                          [(0, 5, 'user0'), (10, 20, 'user10'),
+                           (50, 100, 'user50')])
+        self.assertEquals(len(self.tree), 3)
+        return
+
+    def test_free_slot(self):
+        """Test if the first gap that is long enough is found."""
+        self.assertEquals(self.tree.free_slot(0, 5), 5)
+        self.assertEquals(self.tree.free_slot(0, 10), 20)
+        self.assertEquals(self.tree.free_slot(12, 11), 100)
+        self.assertEquals(self.tree.free_slot(200, 1000), 200)
+        return
+
+    def test_compare_with_list(self):
+        """Test many random intervals against a plain list."""
+        rnd = random.Random(42)
+        tree = IntervalTree()
+        intervals = []
+        for number in range(2000):
+            start = rnd.randrange(100000)
+            end = start + rnd.randrange(1, 500)
+            if not tree.overlapping(start, end):
+                tree.add(start, end, number)
+                intervals.append((start, end, number))
+            if intervals and rnd.random() < 0.3:
+                interval = intervals.pop(rnd.randrange(len(intervals)))
+                self.assertEquals(tree.remove(interval[0]), interval)
+        intervals.sort()
+        self.assertEquals(list(tree), intervals)
+        for (start, end, _) in intervals:
+            self.assertFalse(any(other[0] < end and other[1] > start
+                                 for other in intervals
+                                 if other[0] != start))
+        self.assertEquals(list(tree.after(50000)),
+                          [interval for interval in intervals
+                           if interval[1] > 50000])
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,49 +1,560 @@
+import fnmatch
+import functools
+import itertools
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import UserDict
 
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
 from will.plugin import WillPlugin
-from will.decorators import respond_to
+from will.decorators import respond_to, periodic, route
+
+from plugins.core import Core, FakeChat, asyncio, use_core
+from plugins.journal import Journal
+from plugins.metrics import CONTENT_TYPE, REGISTRY, clock, timed
+from plugins.outbox import Outbox, TokenBucket
+from plugins.reservations import IntervalTree
+from plugins.router import Router, command
+from plugins.scheduler import DEFAULT_PRIORITY, PRIORITIES, Scheduler
+from plugins.snapshot import EXTENSION, SnapshotError, load_snapshot, \
+    save_snapshot, snapshot_settings
+from plugins.stats import ENQUEUE, GRANT, Stats
+from plugins.status import Status, render_line
+from plugins.storage import Conflict, RedisStorage, Storage, from_settings
+from plugins.timers import TimerHeap
+from plugins.waitlist import Waitlist
+
+# ----------------------------------------------------------------------
+#  Name lists
+# ----------------------------------------------------------------------
+
+# the largest list of resources a single command can produce
+MAX_BATCH = 1000
+
+RANGE = re.compile(r'\{(\d+)\.\.(\d+)\}')
+GLOB = re.compile(r'[*?[]')
+
+
+def expand_names(text):
+    """Split a list of names separated by commas or spaces, expanding ranges
+    like "board{1..20}" (or "board{01..20}", to keep the zeroes).  Returns the
+    names in order, without duplicates."""
+    names = []
+    for name in re.split(r'[,\s]+', text or ''):
+        if not name:
+            continue
+
+        match = RANGE.search(name)
+        if not match:
+            names.append(name)
+            continue
+
+        (start, end) = match.groups()
+        width = len(start) if start.startswith('0') else 0
+        (first, last) = (int(start), int(end))
+        if last - first + 1 > MAX_BATCH:
+            raise ValueError('{name} has too many names'.format(name=name))
+        for number in range(first, last + 1):
+            names.append(name[:match.start()] +
+                         str(number).zfill(width) +
+                         name[match.end():])
+
+    if len(names) > MAX_BATCH:
+        raise ValueError('too many names')
+
+    seen = set()
+    return [name for name in names
+            if not (name in seen or seen.add(name))]
+
+
+def is_pattern(name):
+    """Tell if the name is a glob pattern instead of a single name."""
+    return GLOB.search(name) is not None
+
+
+DURATION = re.compile(r'^(\d+)([smhd]?)$')
+DURATION_UNITS = {'': 60, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(text):
+    """Convert "30s", "15m", "2h" or "1d" to seconds; plain numbers are
+    minutes. Returns None if the text isn't a duration."""
+    match = DURATION.match(text or '')
+    if not match:
+        return None
+    (amount, unit) = match.groups()
+    return int(amount) * DURATION_UNITS[unit]
+
+
+def format_duration(seconds):
+    """The opposite of parse_duration, with the largest unit that fits."""
+    for unit in ('d', 'h', 'm'):
+        if seconds >= DURATION_UNITS[unit] and \
+                seconds % DURATION_UNITS[unit] == 0:
+            return '{amount}{unit}'.format(
+                amount=seconds // DURATION_UNITS[unit], unit=unit)
+    return '{amount}s'.format(amount=seconds)
+
+
+TIME_TEXT = r'(?:\d{4}-\d\d-\d\d )?\d\d?:\d\d'
+TIME = re.compile(r'^(?:(\d{4})-(\d\d)-(\d\d) )?(\d\d?):(\d\d)$')
+
+
+def parse_time(text, after):
+    """Convert "22:00" or "2026-10-18 22:00", in local time, to a timestamp.
+    Without a date, it's the first time the clock shows that hour after
+    `after`. Returns None if the text isn't a time."""
+    match = TIME.match(text or '')
+    if not match:
+        return None
+    (year, month, day, hour, minute) = [int(field) if field else None
+                                        for field in match.groups()]
+    if hour > 23 or minute > 59:
+        return None
+    if year is None:
+        (year, month, day) = time.localtime(after)[:3]
+
+    try:
+        when = time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+        while match.group(1) is None and when <= after:
+            day += 1
+            when = time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+    return int(when)
+
+
+def format_time(when):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(when))
+
+
+def rough_duration(seconds):
+    """Round a duration to the unit that makes it easy to read."""
+    for (unit, limit) in (('s', 90), ('m', 90 * 60), ('h', 36 * 3600)):
+        if seconds < limit:
+            break
+    else:
+        unit = 'd'
+    return '{amount}{unit}'.format(
+        amount=int(round(float(seconds) / DURATION_UNITS[unit])), unit=unit)
+
+
+def short_list(names, limit=10):
+    """Join the names for a message, cutting long lists."""
+    names = list(names)
+    if len(names) <= limit:
+        return ', '.join(names)
+    return '{names} and {more} more'.format(names=', '.join(names[:limit]),
+                                            more=len(names) - limit)
+
 
 # ----------------------------------------------------------------------
 #  The plugin
 # ----------------------------------------------------------------------
 
+# holders get a reminder when this fraction of their lease is gone
+REMINDER_AT = 0.8
+# waiting users don't get a resource someone reserved from this many seconds
+# on; the one who reserved it gets it instead
+RESERVATION_GUARD = 30 * 60
+# the key that puts someone first in a list
+FIRST_IN_LINE = float('-inf')
+# how many times a command runs again after other bots changed the state
+RETRIES = 5
+# the first words of the commands only admins can use
+ADMIN_COMMANDS = ('(?:(?:add|remove|tag|untag|lease) resource |'
+                  'set (?:priority|share) of |'
+                  r'(?=(?:snapshot|restore)(?: [\w.-]+)?$))')
+# the names admins can give the snapshots
+SNAPSHOT_NAME = r'[\w.-]+'
+
+handler_timer = timed('boardmanager_handler_seconds', 'handler',
+                      'Seconds spent in each command handler.')
+lookup_timer = timed('boardmanager_lookup_seconds', 'lookup',
+                     'Seconds spent in the state lookups.')
+LOCK_WAIT = REGISTRY.histogram('boardmanager_lock_wait_seconds', 'lock',
+                               'state', 'Seconds waiting for the state lock.')
+
+
+def serialized(function):
+    """Run the handler holding the state lock, so only one handler changes the
+    resources at a time.
+
+    Before running, the state catches up with what other bots sharing the
+    storage did. The operations of the handler change the state right away,
+    but they are only recorded once it's done, all of them at once; if another
+    bot still manages to change the storage before that, the storage refuses
+    them all, the state goes back to what the storage has and the handler
+    runs again. That's why what the handler says, and what goes to the
+    statistics, is held until its operations are recorded. The storage is only
+    waited on after the lock is released, so handlers running one after the
+    other still share the disk flushes; in the core, the whole batch of
+    commands waits for the storage once (see Core.hold)."""
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if getattr(self._outgoing, 'messages', None) is not None:
+            # called from another serialized handler
+            return function(self, *args, **kwargs)
+
+        for attempt in range(RETRIES):
+            start = clock()
+            with self._lock:
+                LOCK_WAIT.observe(clock() - start)
+                self._sync()
+                self._outgoing.messages = []
+                self._staged.operations = []
+                self._staged.tracked = []
+                try:
+                    try:
+                        result = function(self, *args, **kwargs)
+                    finally:
+                        # even if the handler failed, what it did is in the
+                        # state already
+                        seq = self._store()
+                except Conflict:
+                    # nothing was recorded: undo it all and try again
+                    self._reload()
+                    continue
+                finally:
+                    messages = self._outgoing.messages
+                    self._outgoing.messages = None
+                    self._staged.operations = None
+                    self._staged.tracked = None
+
+            if self.core is not None and self.core.hold(seq, messages):
+                return result
+            if seq:
+                self.storage.commit(seq)
+            for (content, kwargs) in messages:
+                self.outbox.post(content, **kwargs)
+            return result
+
+        raise Conflict('gave up after {retries} tries'.format(
+            retries=RETRIES))
+    return wrapper
+
+
 class BoardManager(WillPlugin):
     """A general resource allocation plugin."""
 
-    def __init__(self):
+    clock = staticmethod(time.time)
+
+    def __init__(self, storage=None, async_core=None, snapshot_dir=None):
+        self._lock = threading.RLock()
+        # the operations of the running handler, and what they do to the
+        # statistics, until they are recorded; see serialized
+        self._staged = threading.local()
+        self._outgoing = threading.local()
+        self._reset()
+
+        restore = None
+        if storage is None:
+            storage = from_settings()
+            if async_core is None:
+                async_core = use_core()
+            (settings_dir, restore) = snapshot_settings()
+            snapshot_dir = snapshot_dir or settings_dir
+        self.storage = storage
+        self.snapshot_dir = snapshot_dir or 'snapshots'
+        self._restore()
+
+        # with the core, the handlers only queue the commands; see Core
+        self.core = Core(self._send, commit=self.storage.commit) \
+            if async_core else None
+        self.outbox = self.core.outbox if self.core is not None \
+            else Outbox(self._send)
+        self.stats = Stats()
+        self.router = Router.from_class(BoardManager)
+        self.admin_router = Router.from_class(BoardManager, admin_only=True)
+        if restore:
+            self.restore_file(restore)
+
+    def _reset(self):
+        """Forget everything."""
+        for users in getattr(self, 'resources', {}).values():
+            users.clear()
         self.resources = {}
+        # reverse index: user -> resource they are using/waiting for
+        self.users = {}
+        # user -> the resources they asked for together; they are in all of
+        # those lists (and not in `users`)
+        self.bundles = {}
+        # pools: tag -> resources with the tag, and tag -> the free ones
+        self.tags = {}
+        self.free = {}
+        self.resource_tags = {}     # resource -> its tags
+        # leases: resource -> seconds a holder can keep it, and the timers
+        # for the reminders/expirations of the current holders
+        self.leases = {}
+        self.timers = TimerHeap()
+        # priority classes and shares of the users
+        self.scheduler = Scheduler()
+        # resource -> IntervalTree with the (start, end, user) reservations
+        self.reservations = {}
+        # resource or tag -> users to tell when it's free, and the reverse
+        self.watchers = {}
+        self.watching = {}
+        # resource -> (holder, users in the list); each entry is replaced, never
+        # changed, so readers can use it without the lock.
+        self.view = {}
+        # the same, rendered for the status command
+        self.status = Status()
+        return
+
+    def say(self, content, **kwargs):
+        """Everything the bot says goes through the outbox, so handlers don't
+        wait for the chat server."""
+        messages = getattr(self._outgoing, 'messages', None)
+        if messages is not None:
+            # the handler isn't done yet; see `serialized`
+            messages.append((content, kwargs))
+            return
+        self.outbox.post(content, **kwargs)
+        return
+
+    def _send(self, content, **kwargs):
+        WillPlugin.say(self, content, **kwargs)
+        return
+
+    # Will tries the regex of every handler on every message, so instead of a
+    # handler per command there are only two, one for the admins and one for
+    # everyone else, and they find the command with a Router.
+
+    @respond_to('^(?P<body>' + ADMIN_COMMANDS + '.+)', admin_only=True)
+    def dispatch_admin(self, message, body=None):
+        self._dispatch(self.admin_router, message, body)
+        return
+
+    @respond_to('^(?P<body>(?!' + ADMIN_COMMANDS + ').+)')
+    def dispatch(self, message, body=None):
+        self._dispatch(self.router, message, body)
+        return
+
+    @route('/metrics')
+    def metrics(self):
+        """Latency histograms, queue depths and message counts, for
+        Prometheus."""
+        try:
+            from bottle import response
+            response.content_type = CONTENT_TYPE
+        except ImportError:
+            pass
+        return self._metrics_text()
+
+    def _metrics_text(self):
+        view = self.view.copy()
+        gauges = [
+            ('boardmanager_resources', 'Known resources.', 'gauge',
+             [({}, len(view))]),
+            ('boardmanager_resources_in_use', 'Resources someone is holding.',
+             'gauge',
+             [({}, sum(1 for (holder, _) in view.values() if holder))]),
+            ('boardmanager_queue_depth', 'Users waiting for each resource.',
+             'gauge',
+             [({'resource': resource}, max(length - 1, 0))
+              for (resource, (_, length)) in sorted(view.items())]),
+            ('boardmanager_messages_sent_total', 'Messages sent to the chat.',
+             'counter', [({}, self.outbox.sent)]),
+        ]
+        if self.core is not None:
+            gauges.append(('boardmanager_core_commands',
+                           'Commands waiting for the core.', 'gauge',
+                           [({}, len(self.core))]))
+        return REGISTRY.render(gauges)
+
+    def _dispatch(self, router, message, body):
+        if self.core is not None:
+            self.core.submit(self._run_command, router, message, body)
+            return
+        self._run_command(router, message, body)
+        return
+
+    def _run_command(self, router, message, body):
+        (handler, kwargs) = router.match(body or '')
+        if handler:
+            getattr(self, handler)(message, **kwargs)
+        return
 
-    @respond_to('add resource (?P<resource>\S+)', admin_only=True)
+    @command('add resource (?P<resource>.+)', admin_only=True)
+    @handler_timer
+    @serialized
     def add_resource(self, message, resource=None):
-        if not resource:
+        try:
+            names = expand_names(resource)
+        except ValueError:
+            self.reply(message, 'That\'s way too many resources, I can add '
+                       'up to {limit} at a time.'.format(limit=MAX_BATCH))
+            return
+
+        if not names:
             self.reply(message, "Add WHAT, exactly?")
             return
 
+        if len(names) > 1:
+            self._add_many(message, names)
+            return
+
+        resource = names[0]
         if resource in self.resources:
             self.reply(message, 'Resource already in the list, dummy')
             return
 
-        self.resources[resource] = []
+        self._apply('add', resource)
         self.reply(message, 'Resource "{resource}" added.'.format(
             resource=resource))
         return
 
-    @respond_to('remove resource (?P<resource>\S+)', admin_only=True)
+    @command('remove resource (?P<resource>.+)', admin_only=True)
+    @handler_timer
+    @serialized
     def remove_resource(self, message, resource=None):
-        if not resource:
+        try:
+            names = expand_names(resource)
+        except ValueError:
+            self.reply(message, 'That\'s way too many resources, I can '
+                       'remove up to {limit} at a time.'.format(
+                           limit=MAX_BATCH))
+            return
+
+        if not names:
             self.reply(message, "Remove WHAT, exactly?")
             return
 
+        if len(names) > 1 or is_pattern(names[0]):
+            self._remove_many(message, names)
+            return
+
+        resource = names[0]
         if resource not in self.resources:
             self.reply(message, 'I know nothing about that resource.')
             return
 
-        del self.resources[resource]
+        self._remove(resource)
         self.reply(message, 'Resource removed')
         return
 
-    @respond_to('request (?P<resource>\S+)')
+    def _remove(self, resource):
+        """Remove the resource. The users who asked for it in a set can't
+        have the whole set any more and leave the other lists too, so they
+        are told, and so is whoever gets the other resources now."""
+        sets = dict((user, self.bundles[user])
+                    for user in self.resources[resource]
+                    if user in self.bundles)
+        heads = dict((other, self.resources[other][0])
+                     for bundle in sets.values() for other in bundle
+                     if other != resource)
+        self._apply('remove', resource)
+        for (user, bundle) in sorted(sets.items()):
+            self.say('@{user} {resource} was removed, so you\'re out of the '
+                     'lists for {names}.'.format(user=user, resource=resource,
+                                                 names=', '.join(bundle)))
+        freed = []
+        for (other, head) in sorted(heads.items()):
+            users = self.resources[other]
+            if not users:
+                freed.append(other)
+            elif users[0] != head:
+                self._wake(other)
+        self._announce_free(freed, None)
+        return
+
+    def _add_many(self, message, names):
+        added = []
+        existing = []
+        for resource in names:
+            if resource in self.resources:
+                existing.append(resource)
+            else:
+                self._apply('add', resource)
+                added.append(resource)
+
+        reply = []
+        if added:
+            reply.append('{count} resources added: {names}.'.format(
+                count=len(added), names=short_list(added)))
+        if existing:
+            reply.append('Already in the list: {names}.'.format(
+                names=short_list(existing)))
+        self.reply(message, ' '.join(reply))
+        return
+
+    def _remove_many(self, message, names):
+        removed = self._match_resources(names)
+        unknown = [name for name in names
+                   if not is_pattern(name) and name not in self.resources]
+        for resource in removed:
+            self._remove(resource)
+
+        reply = []
+        if removed:
+            reply.append('{count} resources removed: {names}.'.format(
+                count=len(removed), names=short_list(removed)))
+        else:
+            reply.append('No resources removed.')
+        if unknown:
+            reply.append('I know nothing about {names}.'.format(
+                names=short_list(unknown)))
+        self.reply(message, ' '.join(reply))
+        return
+
+    @command('tag resource (?P<resources>.+) as (?P<tag>\S+)',
+             admin_only=True)
+    @handler_timer
+    @serialized
+    def tag_resource(self, message, resources=None, tag=None):
+        """Put resources in a pool."""
+        try:
+            names = expand_names(resources)
+        except ValueError:
+            names = []
+        found = self._match_resources(names)
+        if not found:
+            self.reply(message, 'I know nothing about those resources.')
+            return
+
+        for resource in found:
+            if tag not in self.resource_tags[resource]:
+                self._apply('tag', resource, tag)
+        self.reply(message, '{names} tagged as {tag}.'.format(
+            names=short_list(found), tag=tag))
+        return
+
+    @command('untag resource (?P<resources>.+) from (?P<tag>\S+)',
+             admin_only=True)
+    @handler_timer
+    @serialized
+    def untag_resource(self, message, resources=None, tag=None):
+        """Take resources out of a pool."""
+        try:
+            names = expand_names(resources)
+        except ValueError:
+            names = []
+        found = [resource for resource in self._match_resources(names)
+                 if tag in self.resource_tags[resource]]
+        if not found:
+            self.reply(message, 'None of those resources is tagged as '
+                       '{tag}.'.format(tag=tag))
+            return
+
+        for resource in found:
+            self._apply('untag', resource, tag)
+        self.reply(message, '{names} no longer tagged as {tag}.'.format(
+            names=short_list(found), tag=tag))
+        return
+
+    @command('request (?P<resource>\S+)')
+    @handler_timer
+    @serialized
     def request(self, message, resource=None):
         if not resource:
             self.reply(message, 'I can\'t get an empty resource. Think '
@@ -66,21 +577,328 @@ class BoardManager(WillPlugin):
                        'first.'.format(resource=user_resource))
             return
 
-        if not self.resources[resource]:
+        reservation = self._upcoming(resource, self.clock())
+        if not self.resources[resource] and reservation and \
+                reservation[2] != message.sender.nick:
+            self.reply(message, '{resource} is reserved for {user} from '
+                       '{start}, try another one.'.format(
+                           resource=resource, user=reservation[2],
+                           start=format_time(reservation[0])))
+            return
+
+        self._enqueue(resource, message.sender.nick)
+        users = self.resources[resource]
+        if users[0] == message.sender.nick:
             self.reply(message, 'There is no one using it, you\'re free '
                        'to go.')
         else:
             self.reply(message, '{user} is using it right now, you\'re '
                        'user {position} in the {resource} list.'.format(
-                           user=self.resources[resource][0],
-                           position=len(self.resources[resource]),
+                           user=users[0],
+                           position=users.index(message.sender.nick),
                            resource=resource))
+        return
+
+    @command('request any of (?P<resources>.+)')
+    @handler_timer
+    @serialized
+    def request_any(self, message, resources=None):
+        """Get the first free resource in a list or pattern."""
+        try:
+            names = expand_names(resources)
+        except ValueError:
+            names = []
+
+        candidates = self._match_resources(names)
+        if not candidates:
+            self.reply(message, 'I don\'t know any resources like '
+                       '"{pattern}".'.format(pattern=resources))
+            return
+
+        user_resource = self._user_resource(message.sender.nick)
+        if user_resource:
+            self.reply(message, 'stop being greedy and free {resource} '
+                       'first.'.format(resource=user_resource))
+            return
+
+        now = self.clock()
+        for resource in candidates:
+            if self._available(resource, message.sender.nick, now):
+                self._enqueue(resource, message.sender.nick)
+                self.reply(message, 'You got {resource}, no one was using '
+                           'it.'.format(resource=resource))
+                return
+
+        self.reply(message, 'Sorry, all {count} of them are in use.'.format(
+            count=len(candidates)))
+        return
+
+    @command('request any (?P<tag>\S+)')
+    @handler_timer
+    @serialized
+    def request_tag(self, message, tag=None):
+        """Get any free resource with the tag or, if they are all in use, get
+        in the shortest list."""
+        if tag not in self.tags:
+            self.reply(message, 'I don\'t know any resources tagged as '
+                       '{tag}.'.format(tag=tag))
+            return
+
+        user_resource = self._user_resource(message.sender.nick)
+        if user_resource:
+            self.reply(message, 'stop being greedy and free {resource} '
+                       'first.'.format(resource=user_resource))
+            return
+
+        now = self.clock()
+        resource = next((resource for resource in self.free[tag]
+                         if self._available(resource, message.sender.nick,
+                                            now)), None)
+        if resource:
+            self._enqueue(resource, message.sender.nick)
+            self.reply(message, 'You got {resource}, no one was using '
+                       'it.'.format(resource=resource))
+            return
+
+        # the free ones left are reserved for someone else
+        busy = [resource for resource in self.tags[tag]
+                if self.resources[resource]]
+        if not busy:
+            self.reply(message, 'Sorry, all of them are reserved for someone '
+                       'else right now.')
+            return
+
+        resource = min(busy,
+                       key=lambda resource: (len(self.resources[resource]),
+                                             resource))
+        self._enqueue(resource, message.sender.nick)
+        users = self.resources[resource]
+        if users[0] == message.sender.nick:
+            # a set was keeping it, and gave it up
+            self.reply(message, 'You got {resource}, no one was using '
+                       'it.'.format(resource=resource))
+            return
+        self.reply(message, '{user} is using {resource} right now, you\'re '
+                   'user {position} in the {resource} list.'.format(
+                       user=users[0],
+                       position=users.index(message.sender.nick),
+                       resource=resource))
+        return
+
+    @command('request (?P<resources>\S+(?:[ ,]+\S+)+)')
+    @handler_timer
+    @serialized
+    def request_all(self, message, resources=None):
+        """Get several resources together: all of them at once, or none of
+        them until they can all be had."""
+        try:
+            names = sorted(set(expand_names(resources.replace(',', ' '))))
+        except ValueError:
+            self.reply(message, 'That\'s too many resources at once.')
+            return
+
+        unknown = [name for name in names if name not in self.resources]
+        if unknown:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=unknown[0]))
+            return
+        if len(names) == 1:
+            self.request(message, names[0])
+            return
+
+        user = message.sender.nick
+        user_resource = self._user_resource(user)
+        if user_resource:
+            self.reply(message, 'stop being greedy and free {resource} '
+                       'first.'.format(resource=user_resource))
+            return
+
+        now = self.clock()
+        for resource in names:
+            if not self._available(resource, user, now) and \
+                    not self.resources[resource]:
+                reservation = self._upcoming(resource, now)
+                self.reply(message, '{resource} is reserved for {user} from '
+                           '{start}, try another one.'.format(
+                               resource=resource, user=reservation[2],
+                               start=format_time(reservation[0])))
+                return
+
+        self._apply('request_all', names, user,
+                    self.scheduler.key(user, now))
+        for resource in names:
+            self._preempt(resource, user)
+        if self._granted(user):
+            self.reply(message, 'You got {names}, no one was using '
+                       'them.'.format(names=', '.join(names)))
+            return
+
+        busy = [resource for resource in names
+                if self.resources[resource][0] != user]
+        self.reply(message, '{busy} in use right now; I\'ll tell you when '
+                   'you have all of {names}.'.format(
+                       busy=', '.join('{resource} ({user})'.format(
+                           resource=resource,
+                           user=self.resources[resource][0])
+                           for resource in busy),
+                       names=', '.join(names)))
+        return
+
+    def _enqueue(self, resource, user):
+        """Put the user in the resource list, where the scheduler says."""
+        self._apply('request', resource, user,
+                    self.scheduler.key(user, self.clock()))
+        self._preempt(resource, user)
+        return
+
+    # Users asking for several resources get in all the lists with the same
+    # key, so everybody is sorted the same way in every list. When one of
+    # them gets to the front of a list the resource is kept for them, unused,
+    # until they are at the front of all of their lists; then they have the
+    # whole set at once. Nobody holds something while waiting for something
+    # else, except for these resources kept for a set, and someone with a
+    # lower key takes those over (see `_preempt`): the user with the lowest
+    # key of all is at the front of all of their lists as soon as the
+    # holders are done, so there are no deadlocks.
+
+    def _granted(self, user):
+        """Tell if a user who asked for several resources has all of them."""
+        for resource in self.bundles[user]:
+            users = self.resources.get(resource)
+            if not users or users[0] != user:
+                return False
+        return True
+
+    def _preempt(self, resource, user):
+        """If the resource is kept for a set and someone with a lower key is
+        waiting for it (`user` just got in the list), the set gives it up."""
+        users = self.resources[resource]
+        if len(users) < 2:
+            return
+        holder = users[0]
+        if holder not in self.bundles or self._granted(holder) or \
+                not users.next_key() < users.key(holder):
+            return
+        self._apply('yield', resource, holder)
+        if users[0] != user:
+            self._wake(resource)
+        return
+
+    def _wake(self, resource):
+        """Tell whoever is first in the list now that the resource is
+        theirs. Only the user at the front of a list that changed can get
+        something, so a release only looks at the lists it changed."""
+        user = self.resources[resource][0]
+        if user not in self.bundles:
+            self.say('@{user} there is no one using {resource} right now, '
+                     'you\'re free to go.'.format(user=user,
+                                                  resource=resource))
+        elif self._granted(user):
+            self.say('@{user} you have {names} now, go ahead.'.format(
+                user=user, names=', '.join(self.bundles[user])))
+        return
+
+    @command('set priority of (?P<user>\S+) to (?P<priority>\S+)',
+             admin_only=True)
+    @handler_timer
+    @serialized
+    def set_priority(self, message, user=None, priority=None):
+        """Put a user in a priority class, for the next requests."""
+        if priority not in PRIORITIES:
+            self.reply(message, 'The priorities are {names}.'.format(
+                names=', '.join(sorted(PRIORITIES, key=PRIORITIES.get,
+                                       reverse=True))))
+            return
+
+        if self.scheduler.priorities.get(user, DEFAULT_PRIORITY) != priority:
+            self._apply('priority', user, priority)
+        self.reply(message, '{user} has {priority} priority now.'.format(
+            user=user, priority=priority))
+        return
+
+    @command('set share of (?P<user>\S+) to (?P<share>\S+)',
+             admin_only=True)
+    @handler_timer
+    @serialized
+    def set_share(self, message, user=None, share=None):
+        """Set how much of the resources a user can use before being pushed
+        back in the lists, compared to everyone else."""
+        try:
+            share = float(share)
+        except ValueError:
+            share = 0
+        if not share > 0:
+            self.reply(message, 'A share is a number larger than 0, like 2 '
+                       'or 0.5.')
+            return
+
+        if self.scheduler.shares.get(user, 1) != share:
+            self._apply('share', user, share)
+        self.reply(message, '{user} has a share of {share:g} now.'.format(
+            user=user, share=share))
+        return
 
-        self.resources[resource].append(message.sender.nick)
+    @command('watch (?P<name>\S+)')
+    @handler_timer
+    @serialized
+    def watch(self, message, name=None):
+        """Ask to be told when a resource, or any resource with a tag, gets
+        free."""
+        user = message.sender.nick
+        if name not in self.resources and name not in self.tags:
+            self.reply(message, 'I never heard of "{name}", is it '
+                       'something you can eat?'.format(name=name))
+            return
+        if name in self.watching.get(user, ()):
+            self.reply(message, 'You\'re watching {name} already.'.format(
+                name=name))
+            return
+
+        self._apply('watch', user, name)
+        if name in self.resources:
+            self.reply(message, 'I\'ll tell you when {name} is free.'.format(
+                name=name))
+        else:
+            self.reply(message, 'I\'ll tell you when a resource tagged '
+                       '{name} is free.'.format(name=name))
+        return
+
+    @command('unwatch(?: (?P<name>\S+))?')
+    @handler_timer
+    @serialized
+    def unwatch(self, message, name=None):
+        """Stop watching a resource or tag; everything, without a name."""
+        user = message.sender.nick
+        watching = self.watching.get(user, set())
+        if name and name not in watching:
+            self.reply(message, 'You weren\'t watching {name}.'.format(
+                name=name))
+            return
+        if not watching:
+            self.reply(message, 'You weren\'t watching anything.')
+            return
+
+        names = [name] if name else sorted(watching)
+        for watched in names:
+            self._apply('unwatch', user, watched)
+        self.reply(message, 'Ok, no more news about {names}.'.format(
+            names=short_list(names)))
         return
 
-    @respond_to('done')
+    @command('done')
+    @handler_timer
+    @serialized
     def done(self, message):
+        bundle = self.bundles.get(message.sender.nick)
+        if bundle is not None:
+            granted = self._granted(message.sender.nick)
+            self._release(message.sender.nick, bundle[0],
+                          message if granted else None)
+            if not granted:
+                self.reply(message, 'Ok, you\'re out of the lists for '
+                           '{names}'.format(names=', '.join(bundle)))
+            return
+
         used_resource = self._user_resource(message.sender.nick)
         if not used_resource:
             self.reply(message, 'I didn\'t even know you were using '
@@ -94,153 +912,1121 @@ class BoardManager(WillPlugin):
         # them but:
         # 2.1) If the list is not empty after that, we alert the next one in
         # the list (the new first person in the list)
-        # 2.2) If the list gets empty, we alert everyone that the resource is
-        # free to everyone
+        # 2.2) If the list gets empty, we tell the users watching it that
+        # the resource is free, and the user that they are done with it
 
         if self.resources[used_resource][0] != message.sender.nick:
-            self.resources[used_resource].remove(message.sender.nick)
-            self.reply('Ok, you\'re out of the list for resource '
+            self._apply('done', message.sender.nick)
+            self.reply(message, 'Ok, you\'re out of the list for resource '
                        '{resource}'.format(resource=used_resource))
             return
 
-        # we know it's the first in the list, we can just pop() it out
-        self.resources[used_resource].pop(0)
+        self._release(message.sender.nick, used_resource, message)
+        return
+
+    def _release(self, user, used_resource, message=None):
+        """Take the resource from the user holding it (or all the resources
+        they asked for together) and tell whoever is next; with the
+        `message` of the user, they are told first which resources no one is
+        waiting for now."""
+        resources = self.bundles.get(user, (used_resource,))
+        now = self.clock()
+        for resource in resources:
+            if self.resources[resource][0] == user:
+                self._hand_over_reserved(resource, user, now)
+
+        heads = dict((resource, self.resources[resource][0])
+                     for resource in resources)
+        self._apply('done', user)
+        freed = [resource for resource in resources
+                 if not self.resources[resource]]
+        if freed and message is not None:
+            self.reply(message, 'Ok, {names} {verb} free now.'.format(
+                names=', '.join(freed),
+                verb='is' if len(freed) == 1 else 'are'))
+        for resource in resources:
+            users = self.resources[resource]
+            if users and users[0] != heads[resource]:
+                self._wake(resource)
+        self._announce_free(freed, user)
+        return
 
-        if len(self.resources[used_resource]) > 0:
-            self.say('@{user} there is no one using {resource} right now, '
-                     'you\'re free to go.'.format(
-                         user=self.resources[used_resource][0],
-                         resource=used_resource))
+    def _announce_free(self, resources, user):
+        """Tell the users watching the resources (or their tags) that they
+        are free, in a single message; `user`, who freed them, knows it
+        already. Only the watchers are looked at, not everyone."""
+        lines = []
+        for resource in resources:
+            watchers = set(self.watchers.get(resource, ()))
+            for tag in self.resource_tags[resource]:
+                watchers.update(self.watchers.get(tag, ()))
+            watchers.discard(user)
+            if watchers:
+                # mentions in the end, so the outbox doesn't join the line
+                # with the others for the first one
+                lines.append('{resource} is free to use, just ask it: '
+                             '{mentions}'.format(
+                                 resource=resource,
+                                 mentions=' '.join('@' + watcher for watcher
+                                                   in sorted(watchers))))
+        if lines:
+            self.say('\n'.join(lines))
+        return
+
+    def _hand_over_reserved(self, resource, user, now):
+        """The user is giving the resource up: end their reservation, or put
+        whoever reserved it next first in the list."""
+        reservation = self._upcoming(resource, now)
+        if reservation is None:
+            return
+        (start, _, reserver) = reservation
+        if reserver == user:
+            if start <= now:
+                # done before the reservation is over
+                self._apply('unreserve', resource, start)
+        elif self.users.get(reserver) in (None, resource) and \
+                reserver not in self.bundles:
+            # no point in giving it to someone who would have to give it
+            # back soon
+            self._put_first(resource, reserver)
+        return
+
+    @command('lease resource (?P<resources>.+) for (?P<duration>\S+)',
+             admin_only=True)
+    @handler_timer
+    @serialized
+    def lease_resource(self, message, resources=None, duration=None):
+        """Set how long someone can hold the resources; "0" removes the
+        limit."""
+        seconds = parse_duration(duration)
+        if seconds is None:
+            self.reply(message, 'How long is "{duration}"? Try something '
+                       'like 30m, 2h or 1d.'.format(duration=duration))
+            return
+
+        try:
+            names = expand_names(resources)
+        except ValueError:
+            names = []
+        found = self._match_resources(names)
+        if not found:
+            self.reply(message, 'I know nothing about those resources.')
             return
 
-        self.say('@all {resource} is free to use, just ask it.'.format(
-            resource=used_resource))
+        for resource in found:
+            self._apply('lease', resource, seconds)
+        if seconds:
+            self.reply(message, '{names} can be used for {duration} at a '
+                       'time.'.format(names=short_list(found),
+                                      duration=format_duration(seconds)))
+        else:
+            self.reply(message, '{names} can be used for as long as '
+                       'needed.'.format(names=short_list(found)))
         return
 
-    @respond_to('(?P<resource>\S+) is free\?')
-    def is_free(self, message, resource=None):
-        """Answers if a resource is free."""
-        if not resource:
-            self.reply('The nothingness is always free.')
+    @command('renew')
+    @handler_timer
+    @serialized
+    def renew(self, message):
+        """Restart the lease of the resource the user is holding."""
+        resource = self._user_resource(message.sender.nick)
+        if not resource or \
+                self.resources[resource][0] != message.sender.nick:
+            self.reply(message, 'You\'re not using anything right now.')
             return
 
-        if resource not in self.resources:
-            self.reply(message, 'I never heard of "{resource}", is it '
-                       'something you can eat?'.format(resource=resource))
+        resources = self.bundles.get(message.sender.nick, (resource,))
+        if message.sender.nick in self.bundles and \
+                not self._granted(message.sender.nick):
+            self.reply(message, 'You don\'t have all of {names} yet, the '
+                       'time only starts when you do.'.format(
+                           names=', '.join(resources)))
             return
 
-        if not self.resources[resource]:
-            self.reply(message, 'Resource {resource} is free.'.format(
-                resource=resource))
+        leased = [resource for resource in resources
+                  if self.leases.get(resource)]
+        if not leased:
+            self.reply(message, 'There is no time limit for {resource}, keep '
+                       'using it.'.format(resource=', '.join(resources)))
             return
 
-        try:
-            pos = self.resources[resource].index(message.sender.nick)
-            if pos == 0:
-                self.reply(message, 'Why are you asking if {resource} '
-                           'is free when you\'re the one using it?'.format(
-                               resource=resource))
-            else:
-                self.reply(message, '{user} is using it right now, you\'re '
-                           'user {pos} in the list.'.format(
-                               user=self.resources[resource][0],
-                               pos=pos))
-        except ValueError:
-            self.reply(message, '{user} is using {resource} right now, '
-                       'but you\'re not in the list'.format(
-                           user=self.resources[resource][0],
-                           resource=resource))
+        for resource in leased:
+            self._start_lease(resource)
+        self.reply(message, 'Ok, you have {resource} for {duration} '
+                   'more.'.format(resource=', '.join(leased),
+                                  duration=format_duration(min(
+                                      self.leases[resource]
+                                      for resource in leased))))
         return
 
-    def _user_resource(self, user):
-        """Return the resource the user is using right now. If the user is not
-        using any resources, return None."""
-        used_resource = None
-        for resource in self.resources:
-            if user in self.resources[resource]:
-                used_resource = resource
-                break
-        return used_resource
+    @periodic(second='*/15')
+    def check_leases(self):
+        """Remind holders that their time is almost gone, release the
+        resources of those whose time is over and start and end the
+        reservations."""
+        if self.core is not None:
+            self.core.submit(self._check_leases)
+            return
+        self._check_leases()
+        return
 
+    @serialized
+    def _check_leases(self):
+        self._expire_leases(self.clock())
+        return
 
-# ----------------------------------------------------------------------
-#  The tests
-# ----------------------------------------------------------------------
+    def _expire_leases(self, now):
+        expired = self.timers.pop_expired(now)
+        try:
+            self._handle_expired(expired, now)
+        except Exception:
+            # put the timers back, they'll fire again after the retry (or
+            # in the next check), instead of getting lost
+            for key in expired:
+                if key not in self.timers:
+                    self.timers.schedule(key, now)
+            raise
+        return
 
-class ObjDict(UserDict.UserDict):
-    def __getattr__(self, key):
-        return self.data[key]
+    def _handle_expired(self, expired, now):
+        for (kind, resource) in expired:
+            if kind in ('begin', 'end'):
+                self._reservation_event(kind, resource, now)
+                continue
+            if not self.resources.get(resource):
+                continue
+            user = self.resources[resource][0]
+            if kind == 'remind':
+                deadline = self.timers.deadline(('expire', resource))
+                if deadline is None:
+                    # the time is over too (a short lease, or the bot was
+                    # stalled), it expires in this same check
+                    continue
+                self.say('@{user} you have {resource} for {duration} more, '
+                         'say "renew" if you still need it or "done" if you '
+                         'don\'t.'.format(
+                             user=user, resource=resource,
+                             duration=format_duration(int(round(
+                                 deadline - now)))))
+            else:
+                self.say('@{user} your time with {resource} is over, I\'m '
+                         'releasing it.'.format(user=user, resource=resource))
+                self._release(user, resource)
+        return
 
-class TestBoardManager(unittest.TestCase):
-    def setUp(self):
-        self.robot = BoardManager()
-        self.last_message = None
+    @command('reserve (?P<resource>\S+) (?P<start>' + TIME_TEXT + ') ?- ?'
+             '(?P<end>' + TIME_TEXT + ')')
+    @handler_timer
+    @serialized
+    def reserve(self, message, resource=None, start=None, end=None):
+        """Book a resource for a time window."""
+        if resource not in self.resources:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=resource))
+            return
 
-        self.message_user_1 = ObjDict({'type': 'groupchat',
-                                       'sender': ObjDict(
-                                           {'nick': 'TestRobot'})})
-        self.message_user_2 = ObjDict({'type': 'groupchat',
-                                       'sender': ObjDict(
-                                           {'nick': 'AnotherUser'})})
-        self.message_all = ObjDict({'type': 'groupchat',
-                                    'sender': ObjDict({'nick': 'all'})})
-        self.robot.say = self._mocked_say
+        now = self.clock()
+        begin = parse_time(start, now - 60)
+        finish = parse_time(end, begin) if begin is not None else None
+        if finish is None:
+            self.reply(message, 'When is "{start}-{end}"? Try something '
+                       'like 22:00-02:00 or 2026-10-18 22:00-2026-10-19 '
+                       '02:00.'.format(start=start, end=end))
+            return
+        if finish <= max(begin, now):
+            self.reply(message, 'That\'s over before it starts.')
+            return
 
-    def _mocked_say(self, content, message=None, **kwargs):
-        """'Mocked' reply function, so we don't need to create a real "message"
-        object."""
-        self.last_message = content
+        tree = self.reservations.get(resource, IntervalTree())
+        conflicts = tree.overlapping(begin, finish)
+        if conflicts:
+            (other_start, other_end, user) = conflicts[0]
+            self.reply(message, '{resource} is reserved for {user} from '
+                       '{start} to {end}; the next free slot that long '
+                       'starts at {slot}.'.format(
+                           resource=resource, user=user,
+                           start=format_time(other_start),
+                           end=format_time(other_end),
+                           slot=format_time(tree.free_slot(
+                               begin, finish - begin))))
+            return
+
+        self._apply('reserve', resource, message.sender.nick, begin, finish)
+        self.reply(message, '{resource} is yours from {start} to '
+                   '{end}.'.format(resource=resource,
+                                   start=format_time(begin),
+                                   end=format_time(finish)))
         return
 
-    # helpers
-    def assertLastMessage(self, message, reply_to=None):
-        """Check if the last received message is the one we expect."""
-        if reply_to is None:
-            reply_to = self.message_user_1
+    @command('cancel reservation of (?P<resource>\S+)')
+    @handler_timer
+    @serialized
+    def cancel_reservation(self, message, resource=None):
+        """Cancel the next reservation the user has for the resource."""
+        tree = self.reservations.get(resource)
+        mine = None
+        if tree:
+            mine = next((reservation for reservation
+                         in tree.after(self.clock())
+                         if reservation[2] == message.sender.nick), None)
+        if mine is None:
+            self.reply(message, 'You have no reservations of '
+                       '{resource}.'.format(resource=resource))
+            return
 
-        self.assertEquals(self.last_message, '@' + reply_to.sender.nick +
-                          ' ' + message)
+        self._apply('unreserve', resource, mine[0])
+        self.reply(message, 'Your reservation of {resource} from {start} to '
+                   '{end} is cancelled.'.format(resource=resource,
+                                                start=format_time(mine[0]),
+                                                end=format_time(mine[1])))
         return
 
+    @command('reservations (?P<resource>\S+)')
+    @handler_timer
+    def show_reservations(self, message, resource=None):
+        """List the next reservations of a resource."""
+        if resource not in self.view:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=resource))
+            return
 
-class TestBoardManagerResources(TestBoardManager):
+        with self._lock:
+            tree = self.reservations.get(resource, IntervalTree())
+            upcoming = list(itertools.islice(tree.after(self.clock()), 10))
+        if not upcoming:
+            self.reply(message, 'There are no reservations of '
+                       '{resource}.'.format(resource=resource))
+            return
 
-    def test_add_resource(self):
-        """Test if adding a resource actually adds a resource."""
-        self.robot.add_resource(self.message_user_1, 'A'),
-        self.assertLastMessage('Resource "A" added.')
-        self.assertTrue('A' in self.robot.resources)
+        self.reply(message, 'Reservations of {resource}: {list}.'.format(
+            resource=resource,
+            list=', '.join('{user} from {start} to {end}'.format(
+                user=user, start=format_time(start), end=format_time(end))
+                for (start, end, user) in upcoming)))
         return
 
-    def test_add_no_resource(self):
-        """Test if the bot complains about an add resource with a resource."""
-        self.robot.add_resource(self.message_user_1)
-        self.assertLastMessage('Add WHAT, exactly?')
-        self.assertTrue(not self.robot.resources)
-        return
+    @command('next slot of (?P<resource>\S+) for (?P<duration>\S+)')
+    @handler_timer
+    def next_slot(self, message, resource=None, duration=None):
+        """Find when the resource has no reservations for that long."""
+        seconds = parse_duration(duration)
+        if not seconds:
+            self.reply(message, 'How long is "{duration}"? Try something '
+                       'like 30m, 2h or 1d.'.format(duration=duration))
+            return
+        if resource not in self.view:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=resource))
+            return
 
-    def test_add_an_existing_resource(self):
-        """Test if the bot complains about an attemp to add a resource that is
-        already in the list."""
-        self.robot.add_resource(self.message_user_1, 'A')
-        self.robot.add_resource(self.message_user_1, 'A')
-        self.assertLastMessage('Resource already in the list, dummy')
-        self.assertTrue('A' in self.robot.resources)
+        now = self.clock()
+        with self._lock:
+            tree = self.reservations.get(resource, IntervalTree())
+            slot = tree.free_slot(now, seconds)
+        self.reply(message, '{resource} has no reservations from {start} to '
+                   '{end}.'.format(resource=resource,
+                                   start=format_time(slot),
+                                   end=format_time(slot + seconds)))
         return
 
-    def test_remove_resource(self):
-        """Test if removing a remove actually removes it."""
-        self.robot.add_resource(self.message_user_1, 'A')
-        self.robot.remove_resource(self.message_user_1, 'A')
-        self.assertLastMessage('Resource removed')
-        self.assertTrue('A' not in self.robot.resources)
+    def _upcoming(self, resource, now):
+        """The reservation of the resource going on now or starting in the
+        next RESERVATION_GUARD seconds, if there is one."""
+        tree = self.reservations.get(resource)
+        if not tree:
+            return None
+        reservation = next(tree.after(now), None)
+        if reservation and reservation[0] <= now + RESERVATION_GUARD:
+            return reservation
+        return None
+
+    def _available(self, resource, user, now):
+        """Tell if the user can get the resource right now: no one is using
+        it and it's not reserved for someone else."""
+        if self.resources[resource]:
+            return False
+        reservation = self._upcoming(resource, now)
+        return reservation is None or reservation[2] == user
+
+    def _put_first(self, resource, user):
+        """Move the user to the front of the resource list, out of the list
+        they were waiting in. They can't be holding something else."""
+        other = self.users.get(user)
+        if other == resource and self.resources[resource].index(user) <= 1:
+            return
+        if other is not None:
+            self._apply('done', user)
+        self._apply('request', resource, user, FIRST_IN_LINE)
+        self._preempt(resource, user)
         return
 
-    def test_remove_unknown_resource(self):
-        """Test error message when trying to remove a resource that doesn't
-        exist."""
-        self.robot.remove_resource(self.message_user_1, 'A')
-        self.assertLastMessage('I know nothing about that resource.')
+    def _reservation_event(self, kind, resource, now):
+        """A reservation starts or ends: hand the resource over or take it
+        back."""
+        tree = self.reservations.get(resource)
+        if not tree:
+            return
+        (start, end, user) = tree.first()
+        if kind == 'begin' and start <= now < end:
+            users = self.resources[resource]
+            if users and users[0] == user:
+                return
+            if user in self.bundles:
+                self.say('@{user} your reservation of {resource} starts now, '
+                         'I\'m releasing {other} for you.'.format(
+                             user=user, resource=resource,
+                             other=', '.join(self.bundles[user])))
+                self._release(user, self.bundles[user][0])
+            other = self.users.get(user)
+            if other is not None and self.resources[other][0] == user:
+                self.say('@{user} your reservation of {resource} starts now, '
+                         'I\'m releasing {other} for you.'.format(
+                             user=user, resource=resource, other=other))
+                self._release(user, other)
+            holder = users[0] if users else None
+            self._put_first(resource, user)
+            if holder is None:
+                self.say('@{user} your reservation of {resource} starts now, '
+                         'it\'s all yours.'.format(user=user,
+                                                    resource=resource))
+                return
+            self.say('@{holder} {resource} is reserved for {user} now, I\'m '
+                     'releasing it.'.format(holder=holder, resource=resource,
+                                            user=user))
+            self._release(holder, resource)
+        elif kind == 'end' and end <= now:
+            self._apply('unreserve', resource, start)
+            users = self.resources[resource]
+            if users and users[0] == user:
+                self.say('@{user} your reservation of {resource} is over, '
+                         'I\'m releasing it.'.format(user=user,
+                                                     resource=resource))
+                self._release(user, resource)
+        return
+
+    @command('stats (?P<resource>\S+)')
+    @handler_timer
+    def show_stats(self, message, resource=None):
+        """Tell how much a resource is used and how long people wait for
+        it."""
+        if resource not in self.view:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=resource))
+            return
+
+        now = self.clock()
+        with self._lock:
+            stats = self.stats.resource(resource, now)
+            if not stats.waits.total:
+                self.reply(message, 'No one used {resource} since {since} '
+                           'ago.'.format(resource=resource,
+                                         since=rough_duration(
+                                             now - stats.since)))
+                return
+
+            holds = ('p50 {p50}, p95 {p95}'.format(
+                p50=rough_duration(stats.holds.percentile(50)),
+                p95=rough_duration(stats.holds.percentile(95)))
+                if stats.holds.total else 'no one released it yet')
+            self.reply(message, '{resource} in the last {since}: used '
+                       '{utilisation:.0%} of the time, by {grants} users. '
+                       'Wait: p50 {wait50}, p95 {wait95}. Hold: {holds}. '
+                       'Queue: {average:.1f} waiting on average, {max} at '
+                       'most, {depth} now.'.format(
+                           resource=resource,
+                           since=rough_duration(now - stats.since),
+                           utilisation=stats.utilisation(now),
+                           grants=stats.waits.total,
+                           wait50=rough_duration(stats.waits.percentile(50)),
+                           wait95=rough_duration(stats.waits.percentile(95)),
+                           holds=holds,
+                           average=stats.average_depth(now),
+                           max=stats.max_depth,
+                           depth=stats.depth))
+        return
+
+    @command('status(?: (?!page )(?P<pattern>\S+))?(?: page (?P<page>\d+))?')
+    @handler_timer
+    def show_status(self, message, pattern=None, page=None):
+        """Tell who is using each resource and how many are waiting for it, a
+        page at a time. Like is_free, this doesn't wait for the handlers
+        changing the resources: the report is kept rendered in `status`."""
+        (count, pages) = self.status.pages(pattern or '*')
+        if not count:
+            if pattern:
+                self.reply(message, 'I don\'t know any resources like '
+                           '"{pattern}".'.format(pattern=pattern))
+            else:
+                self.reply(message, 'There are no resources yet.')
+            return
+
+        page = int(page or 1)
+        if not 1 <= page <= len(pages):
+            self.reply(message, 'There are only {pages} pages.'.format(
+                pages=len(pages)))
+            return
+
+        header = '{count} resources'.format(count=count)
+        if len(pages) > 1:
+            header += ', page {page} of {pages}'.format(page=page,
+                                                        pages=len(pages))
+        text = header + ':\n' + pages[page - 1]
+        if page < len(pages):
+            text += '\nSay "status {pattern}page {next}" for more.'.format(
+                pattern=pattern + ' ' if pattern else '', next=page + 1)
+        self.reply(message, text)
+        return
+
+    @command('(?P<resource>\S+) is free\?')
+    @handler_timer
+    def is_free(self, message, resource=None):
+        """Answers if a resource is free. This reads the view, so it doesn't
+        wait for the handlers changing the resources, unless it has to find
+        the user's position in the list."""
+        if not resource:
+            self.reply(message, 'The nothingness is always free.')
+            return
+
+        view = self.view.get(resource)
+        if view is None:
+            self.reply(message, 'I never heard of "{resource}", is it '
+                       'something you can eat?'.format(resource=resource))
+            return
+
+        (holder, _) = view
+        if holder is None:
+            self.reply(message, 'Resource {resource} is free.'.format(
+                resource=resource))
+            return
+
+        if holder == message.sender.nick and \
+                message.sender.nick in self.bundles:
+            with self._lock:
+                bundle = self.bundles.get(message.sender.nick)
+                kept = bundle is not None and \
+                    not self._granted(message.sender.nick)
+            if kept:
+                self.reply(message, '{resource} is kept for you until you '
+                           'have all of {names}.'.format(
+                               resource=resource, names=', '.join(bundle)))
+                return
+
+        if holder == message.sender.nick:
+            self.reply(message, 'Why are you asking if {resource} '
+                       'is free when you\'re the one using it?'.format(
+                           resource=resource))
+            return
+
+        pos = None
+        if self.users.get(message.sender.nick) == resource or \
+                resource in self.bundles.get(message.sender.nick, ()):
+            with self._lock:
+                try:
+                    holder = self.resources[resource][0]
+                    pos = self.resources[resource].index(message.sender.nick)
+                except (KeyError, IndexError, ValueError):
+                    # the user (or the resource) left while we waited
+                    pass
+
+        if pos:
+            self.reply(message, '{user} is using it right now, you\'re '
+                       'user {pos} in the list.'.format(user=holder, pos=pos))
+        else:
+            self.reply(message, '{user} is using {resource} right now, '
+                       'but you\'re not in the list'.format(
+                           user=holder, resource=resource))
+        return
+
+    @command('snapshot(?: (?P<name>' + SNAPSHOT_NAME + '))?',
+             admin_only=True)
+    @handler_timer
+    def take_snapshot(self, message, name=None):
+        """Save the whole state in a file, to restore it later (or in another
+        bot). Only copying the state holds the lock, not writing it."""
+        if not name:
+            name = time.strftime('%Y%m%d-%H%M%S',
+                                 time.localtime(self.clock()))
+        with self._lock:
+            self._sync()
+            state = self._state()
+        save_snapshot(self._snapshot_path(name), state)
+        self.reply(message, 'Saved {count} resources in snapshot '
+                   '"{name}".'.format(count=len(self.resources), name=name))
+        return
+
+    @command('restore (?P<name>' + SNAPSHOT_NAME + ')', admin_only=True)
+    @handler_timer
+    @serialized
+    def restore_snapshot(self, message, name=None):
+        """Put everything back as it was in a snapshot."""
+        try:
+            state = load_snapshot(self._snapshot_path(name))
+        except (IOError, OSError):
+            self.reply(message, 'I have no snapshot called "{name}".'.format(
+                name=name))
+            return
+        except SnapshotError as error:
+            self.reply(message, 'I can\'t restore "{name}": {error}.'.format(
+                name=name, error=error))
+            return
+
+        self._apply('restore', state)
+        self.reply(message, 'Restored snapshot "{name}", {count} resources '
+                   'are back.'.format(name=name, count=len(self.resources)))
+        return
+
+    @serialized
+    def restore_file(self, path):
+        """Put everything back as it was in the snapshot in `path`; for
+        `run_will.py --restore`."""
+        self._apply('restore', load_snapshot(path))
+        return
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, name + EXTENSION)
+
+    def _match_resources(self, names):
+        """Return the known resources that match the list of names/patterns,
+        sorted, without duplicates."""
+        found = set()
+        for name in names:
+            if is_pattern(name):
+                found.update(fnmatch.filter(self.resources, name))
+            elif name in self.resources:
+                found.add(name)
+        return sorted(found)
+
+    @lookup_timer
+    def _user_resource(self, user):
+        """Return the resource the user is using right now (the first one,
+        if they asked for several). If the user is not using any resources,
+        return None."""
+        if user in self.bundles:
+            return self.bundles[user][0]
+        return self.users.get(user)
+
+    # state changes; everything that changes the resources goes through
+    # _apply(), so it ends up in the storage and can be replayed on restart
+    # (or by other bots sharing the storage).
+
+    def _apply(self, op, *args):
+        """Apply the operation, and record it in the storage when the handler
+        is done (right away outside the handlers). Must hold the lock; see
+        `serialized`."""
+        staged = getattr(self._staged, 'operations', None)
+        if staged is None:
+            self.storage.record(op, *args)
+        else:
+            staged.append((op, args))
+        resources = self._affected(op, args)
+        holders = [self.view[resource][0] if resource in self.view else None
+                   for resource in resources]
+        getattr(self, '_op_' + op)(*args)
+        for (resource, holder) in zip(resources, holders):
+            self._track(op, args, resource, holder)
+        if staged is None and self.storage.needs_snapshot():
+            self.storage.snapshot(self._state())
+        return
+
+    def _store(self):
+        """Record the operations of the handler, all at once, and then feed
+        the statistics with them. Returns the sequence number to commit, 0
+        if there was nothing to record."""
+        operations = self._staged.operations
+        if not operations:
+            return 0
+        seq = self.storage.record_all(operations)
+        for (function, args) in self._staged.tracked:
+            function(*args)
+        if self.storage.needs_snapshot():
+            self.storage.snapshot(self._state())
+        return seq
+
+    def _later(self, function, *args):
+        """Call `function` once the operations of the handler are recorded
+        (right away outside the handlers)."""
+        tracked = getattr(self._staged, 'tracked', None)
+        if tracked is None:
+            function(*args)
+        else:
+            tracked.append((function, args))
+        return
+
+    def _affected(self, op, args):
+        """The resources which lists the operation changes."""
+        if op in ('add', 'request', 'remove', 'yield'):
+            return [args[0]]
+        if op == 'request_all':
+            return list(args[0])
+        if op == 'done':
+            if args[0] in self.bundles:
+                return list(self.bundles[args[0]])
+            return [self.users[args[0]]] if args[0] in self.users else []
+        return []
+
+    def _track(self, op, args, resource, holder):
+        """Feed the statistics with what the operation did; `holder` is who
+        had the resource before it. A resource kept for a set counts as
+        used: nobody else can have it."""
+        now = self.clock()
+        if op == 'add':
+            self._later(self.stats.resource, resource, now)
+            return
+        if op == 'remove':
+            self._later(self.stats.forget, resource)
+            if holder is not None:
+                self._later(self.scheduler.release, holder, now)
+            return
+
+        users = self.resources[resource]
+        depth = max(len(users) - 1, 0)
+        new_holder = users[0] if users else None
+        user = args[0] if op == 'done' else args[1]
+        if op in ('request', 'request_all'):
+            self._later(self.stats.enqueue, resource, user, now, depth)
+        elif holder == user:
+            self._later(self.stats.release, resource, holder, now, depth)
+            self._later(self.scheduler.release, holder, now)
+            if op == 'yield':
+                self._later(self.stats.enqueue, resource, user, now, depth)
+        else:
+            self._later(self.stats.leave, resource, user, now, depth)
+
+        if new_holder is not None and new_holder != holder:
+            self._later(self.stats.grant, resource, new_holder, now, depth)
+            self._later(self.scheduler.grant, new_holder, now)
+        return
+
+    def _op_add(self, resource):
+        self.resources[resource] = Waitlist()
+        self.resource_tags[resource] = set()
+        self._update_view(resource)
+
+    def _op_remove(self, resource):
+        for tag in list(self.resource_tags[resource]):
+            self._op_untag(resource, tag)
+        for user in list(self.resources[resource]):
+            if user in self.bundles:
+                # they can't have the whole set any more
+                self._op_done(user)
+            else:
+                del self.users[user]
+        self._op_lease(resource, 0)
+        if resource not in self.tags:
+            for user in list(self.watchers.get(resource, ())):
+                self._op_unwatch(user, resource)
+        self.reservations.pop(resource, None)
+        self._schedule_reservation(resource)
+        del self.view[resource]
+        self.status.remove(resource)
+        self.resources.pop(resource).clear()
+        del self.resource_tags[resource]
+
+    def _op_request(self, resource, user, key=None):
+        self.users[user] = resource
+        self._join(resource, user, key)
+
+    def _op_request_all(self, resources, user, key=None):
+        self.bundles[user] = tuple(resources)
+        for resource in resources:
+            self._join(resource, user, key)
+
+    def _op_done(self, user):
+        if user in self.bundles:
+            for resource in self.bundles.pop(user):
+                self._leave(resource, user)
+            return
+        self._leave(self.users.pop(user), user)
+
+    def _op_yield(self, resource, user):
+        """The resource was kept for the set of `user`, who goes back to
+        waiting with the same key."""
+        users = self.resources[resource]
+        key = users.key(user)
+        users.remove(user)
+        users.append(user, key)
+        self._new_holder(resource)
+        self._update_view(resource)
+
+    def _join(self, resource, user, key):
+        if not self.resources[resource]:
+            self._mark_free(resource, False)
+        self.resources[resource].append(user, key)
+        if len(self.resources[resource]) == 1:
+            self._new_holder(resource)
+        self._update_view(resource)
+
+    def _leave(self, resource, user):
+        holder = self.resources[resource][0] == user
+        self.resources[resource].remove(user)
+        if not self.resources[resource]:
+            self._mark_free(resource, True)
+        if holder:
+            self._new_holder(resource)
+        self._update_view(resource)
+
+    def _new_holder(self, resource):
+        """Someone else is first in the list: start their lease or, if that
+        completes a set, the leases of the whole set."""
+        users = self.resources[resource]
+        holder = users[0] if users else None
+        if holder in self.bundles and self._granted(holder):
+            for other in self.bundles[holder]:
+                self._start_lease(other)
+            return
+        self._start_lease(resource)
+        return
+
+    def _update_view(self, resource):
+        users = self.resources[resource]
+        self.view[resource] = (users[0] if users else None, len(users))
+        self.status.update(resource, *self.view[resource])
+
+    def _op_lease(self, resource, seconds):
+        if seconds:
+            self.leases[resource] = seconds
+        else:
+            self.leases.pop(resource, None)
+        self._start_lease(resource)
+
+    def _start_lease(self, resource):
+        """(Re)start the timers for whoever is holding the resource now;
+        there are none while it's only kept for a set."""
+        seconds = self.leases.get(resource)
+        users = self.resources[resource]
+        if not seconds or not users or \
+                (users[0] in self.bundles and not self._granted(users[0])):
+            self.timers.cancel(('remind', resource))
+            self.timers.cancel(('expire', resource))
+            return
+
+        now = self.clock()
+        self.timers.schedule(('remind', resource), now + seconds * REMINDER_AT)
+        self.timers.schedule(('expire', resource), now + seconds)
+        return
+
+    def _op_tag(self, resource, tag):
+        self.resource_tags[resource].add(tag)
+        self.tags.setdefault(tag, set()).add(resource)
+        self.free.setdefault(tag, set())
+        if not self.resources[resource]:
+            self.free[tag].add(resource)
+
+    def _op_untag(self, resource, tag):
+        self.resource_tags[resource].discard(tag)
+        self.tags[tag].discard(resource)
+        self.free[tag].discard(resource)
+        if not self.tags[tag]:
+            del self.tags[tag]
+            del self.free[tag]
+
+    def _op_reserve(self, resource, user, start, end):
+        self.reservations.setdefault(resource, IntervalTree()).add(start, end,
+                                                                    user)
+        self._schedule_reservation(resource)
+
+    def _op_unreserve(self, resource, start):
+        self.reservations[resource].remove(start)
+        if not self.reservations[resource]:
+            del self.reservations[resource]
+        self._schedule_reservation(resource)
+
+    def _schedule_reservation(self, resource):
+        """Set the timers for the start and the end of the first reservation
+        of the resource."""
+        tree = self.reservations.get(resource)
+        if not tree:
+            self.timers.cancel(('begin', resource))
+            self.timers.cancel(('end', resource))
+            return
+        (start, end, _) = tree.first()
+        self.timers.schedule(('begin', resource), start)
+        self.timers.schedule(('end', resource), end)
+        return
+
+    def _op_priority(self, user, priority):
+        self.scheduler.set_priority(user, priority)
+
+    def _op_share(self, user, share):
+        self.scheduler.set_share(user, share)
+
+    def _op_watch(self, user, name):
+        self.watchers.setdefault(name, set()).add(user)
+        self.watching.setdefault(user, set()).add(name)
+
+    def _op_unwatch(self, user, name):
+        self.watchers[name].discard(user)
+        if not self.watchers[name]:
+            del self.watchers[name]
+        self.watching[user].discard(name)
+        if not self.watching[user]:
+            del self.watching[user]
+
+    def _op_restore(self, state):
+        self._load(state, [])
+
+    def _mark_free(self, resource, free):
+        for tag in self.resource_tags[resource]:
+            if free:
+                self.free[tag].add(resource)
+            else:
+                self.free[tag].discard(resource)
+
+    def _state(self):
+        """The whole state, in a format the storage can save."""
+        return {'resources': dict((resource, list(users))
+                                  for (resource, users)
+                                  in self.resources.items()),
+                'tags': dict((tag, sorted(resources))
+                             for (tag, resources) in self.tags.items()),
+                'leases': self.leases.copy(),
+                'keys': dict((resource, dict((user, users.key(user))
+                                             for user in users))
+                             for (resource, users) in self.resources.items()
+                             if users),
+                'bundles': dict((user, list(resources))
+                                for (user, resources)
+                                in self.bundles.items()),
+                'reservations': dict((resource, [list(reservation)
+                                                 for reservation in tree])
+                                     for (resource, tree)
+                                     in self.reservations.items()),
+                'priorities': self.scheduler.priorities.copy(),
+                'shares': self.scheduler.shares.copy(),
+                'watchers': dict((name, sorted(users))
+                                 for (name, users) in self.watchers.items())}
+
+    def _restore(self):
+        """Load the last snapshot and replay the operations logged after
+        it."""
+        with self._lock:
+            self._load(*self.storage.load())
+        self.storage.subscribe(self._on_update)
+        return
+
+    def _sync(self):
+        """Catch up with what other bots did. Must hold the lock."""
+        self._load(*self.storage.updates())
+        return
+
+    def _on_update(self):
+        with self._lock:
+            self._sync()
+        return
+
+    def _reload(self):
+        """Go back to the state in the storage, dropping the changes of a
+        handler whose operations the storage refused. Must hold the lock."""
+        self._reset()
+        self._load(*self.storage.load())
+        return
+
+    def _load(self, state, operations):
+        if state:
+            self._reset()
+            keys = state.get('keys', {})
+            for (user, resources) in state.get('bundles', {}).items():
+                self.bundles[user] = tuple(resources)
+            for resource in state['resources']:
+                self._op_add(resource)
+            for (resource, users) in state['resources'].items():
+                # like _op_request for each user, but the view and the
+                # status are updated once per list
+                waitlist = self.resources[resource]
+                resource_keys = keys.get(resource, {})
+                for user in users:
+                    if user not in self.bundles:
+                        self.users[user] = resource
+                    waitlist.append(user, resource_keys.get(user))
+                if users:
+                    self._mark_free(resource, False)
+                    self._new_holder(resource)
+                    self._update_view(resource)
+            for (tag, resources) in state.get('tags', {}).items():
+                for resource in resources:
+                    self._op_tag(resource, tag)
+            for (resource, seconds) in state.get('leases', {}).items():
+                self._op_lease(resource, seconds)
+            for (resource, reservations) in \
+                    state.get('reservations', {}).items():
+                for (start, end, user) in reservations:
+                    self._op_reserve(resource, user, start, end)
+            for (user, priority) in state.get('priorities', {}).items():
+                self._op_priority(user, priority)
+            for (user, share) in state.get('shares', {}).items():
+                self._op_share(user, share)
+            for (name, users) in state.get('watchers', {}).items():
+                for user in users:
+                    self._op_watch(user, name)
+
+        for (op, args) in operations:
+            getattr(self, '_op_' + op)(*args)
+        return
+
+    def _consistency_errors(self):
+        """Check the user index against the resource lists. Returns a list of
+        problems found; an empty list means everything is in sync."""
+        errors = []
+        seen = {}
+        for resource, users in self.resources.items():
+            holder = users[0] if users else None
+            if self.view.get(resource) != (holder, len(users)):
+                errors.append('view of {resource} is {view}'.format(
+                    resource=resource, view=self.view.get(resource)))
+            if self.status.lines.get(resource) != \
+                    render_line(resource, holder, len(users)):
+                errors.append('status of {resource} is {line}'.format(
+                    resource=resource,
+                    line=self.status.lines.get(resource)))
+            for user in users:
+                if user in self.bundles:
+                    if resource not in self.bundles[user]:
+                        errors.append('{user} in {resource} but not in their '
+                                      'set'.format(user=user,
+                                                   resource=resource))
+                    continue
+                if user in seen:
+                    errors.append('{user} is in both {first} and '
+                                  '{second}'.format(user=user,
+                                                    first=seen[user],
+                                                    second=resource))
+                seen[user] = resource
+                if self.users.get(user) != resource:
+                    errors.append('{user} in {resource} but indexed as '
+                                  '{indexed}'.format(
+                                      user=user, resource=resource,
+                                      indexed=self.users.get(user)))
+
+        for user, resource in self.users.items():
+            if user not in seen:
+                errors.append('{user} indexed as {resource} but not in any '
+                              'list'.format(user=user, resource=resource))
+
+        for user, resources in self.bundles.items():
+            if user in self.users:
+                errors.append('{user} asked for a set and for '
+                              '{resource}'.format(user=user,
+                                                  resource=self.users[user]))
+            granted = all(self.resources[resource][0] == user
+                          for resource in resources
+                          if user in self.resources.get(resource, ()))
+            for resource in resources:
+                users = self.resources.get(resource, ())
+                if user not in users:
+                    errors.append('{user} asked for {resource} but is not in '
+                                  'the list'.format(user=user,
+                                                    resource=resource))
+                elif users[0] == user and not granted and len(users) > 1 and \
+                        users.next_key() < users.key(user):
+                    errors.append('{resource} kept for {user} ahead of '
+                                  '{next}'.format(resource=resource,
+                                                  user=user, next=users[1]))
+
+        for tag, resources in self.tags.items():
+            free = set(resource for resource in resources
+                       if not self.resources[resource])
+            if free != self.free.get(tag):
+                errors.append('free index for {tag} is {indexed}, should be '
+                              '{free}'.format(tag=tag,
+                                              indexed=self.free.get(tag),
+                                              free=free))
+            for resource in resources:
+                if tag not in self.resource_tags.get(resource, ()):
+                    errors.append('{resource} in {tag} but not tagged'.format(
+                        resource=resource, tag=tag))
+
+        for name, users in self.watchers.items():
+            for user in users:
+                if name not in self.watching.get(user, ()):
+                    errors.append('{user} watches {name} but it\'s not in '
+                                  'their list'.format(user=user, name=name))
+        for user, names in self.watching.items():
+            for name in names:
+                if user not in self.watchers.get(name, ()):
+                    errors.append('{user} has {name} in their list but '
+                                  'doesn\'t watch it'.format(user=user,
+                                                              name=name))
+        return errors
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class ObjDict(UserDict.UserDict):
+    def __getattr__(self, key):
+        return self.data[key]
+
+class TestBoardManager(unittest.TestCase):
+    def setUp(self):
+        self.robot = BoardManager(storage=Storage())
+        self.last_message = None
+
+        self.message_user_1 = ObjDict({'type': 'groupchat',
+                                       'sender': ObjDict(
+                                           {'nick': 'TestRobot'})})
+        self.message_user_2 = ObjDict({'type': 'groupchat',
+                                       'sender': ObjDict(
+                                           {'nick': 'AnotherUser'})})
+        self.message_all = ObjDict({'type': 'groupchat',
+                                    'sender': ObjDict({'nick': 'all'})})
+        self.robot.say = self._mocked_say
+
+    def _mocked_say(self, content, message=None, **kwargs):
+        """'Mocked' reply function, so we don't need to create a real "message"
+        object."""
+        self.last_message = content
+        return
+
+    # helpers
+    def assertLastMessage(self, message, reply_to=None):
+        """Check if the last received message is the one we expect."""
+        if reply_to is None:
+            reply_to = self.message_user_1
+
+        self.assertEquals(self.last_message, '@' + reply_to.sender.nick +
+                          ' ' + message)
+        return
+
+
+class TestBoardManagerResources(TestBoardManager):
+
+    def test_add_resource(self):
+        """Test if adding a resource actually adds a resource."""
+        self.robot.add_resource(self.message_user_1, 'A'),
+        self.assertLastMessage('Resource "A" added.')
+        self.assertTrue('A' in self.robot.resources)
+        return
+
+    def test_add_no_resource(self):
+        """Test if the bot complains about an add resource with a resource."""
+        self.robot.add_resource(self.message_user_1)
+        self.assertLastMessage('Add WHAT, exactly?')
+        self.assertTrue(not self.robot.resources)
+        return
+
+    def test_add_an_existing_resource(self):
+        """Test if the bot complains about an attemp to add a resource that is
+        already in the list."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.assertLastMessage('Resource already in the list, dummy')
+        self.assertTrue('A' in self.robot.resources)
+        return
+
+    def test_remove_resource(self):
+        """Test if removing a remove actually removes it."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.remove_resource(self.message_user_1, 'A')
+        self.assertLastMessage('Resource removed')
+        self.assertTrue('A' not in self.robot.resources)
+        return
+
+    def test_remove_unknown_resource(self):
+        """Test error message when trying to remove a resource that doesn't
+        exist."""
+        self.robot.remove_resource(self.message_user_1, 'A')
+        self.assertLastMessage('I know nothing about that resource.')
         return
 
 
@@ -304,9 +2090,23 @@ class TestBoardManagerDone(TestBoardManager):
     def test_done(self):
         """Test if the bot releases the resources when requested."""
         self.robot.request(self.message_user_1, 'A')
+        self.robot.watch(self.message_user_2, 'A')
+        said = []
+        self.robot.say = lambda content, **kwargs: said.append(content)
+        self.robot.done(self.message_user_1)
+        self.assertEquals(said, ['@TestRobot Ok, A is free now.',
+                                 'A is free to use, just ask it: '
+                                 '@AnotherUser'])
+        self.assertEquals(list(self.robot.resources['A']), [])
+        return
+
+    def test_done_no_one_else(self):
+        """Test if the user is told the resource is free when no one waits
+        for it or watches it."""
+        self.robot.request(self.message_user_1, 'A')
         self.robot.done(self.message_user_1)
-        self.assertLastMessage('A is free to use, just ask it.',
-                               self.message_all)
+        self.assertLastMessage('Ok, A is free now.')
+        self.assertEquals(list(self.robot.resources['A']), [])
         return
 
     def test_done_has_nothing(self):
@@ -379,5 +2179,1411 @@ class TestBoardManagerIsFree(TestBoardManager):
         return
 
 
+class TestExpandNames(unittest.TestCase):
+
+    def test_list(self):
+        """Test if lists are split by commas and spaces."""
+        self.assertEquals(expand_names('A,B, C  D,,A'), ['A', 'B', 'C', 'D'])
+        return
+
+    def test_range(self):
+        """Test if ranges are expanded, keeping leading zeroes."""
+        self.assertEquals(expand_names('b{1..3}'), ['b1', 'b2', 'b3'])
+        self.assertEquals(expand_names('b{08..10}-x'),
+                          ['b08-x', 'b09-x', 'b10-x'])
+        return
+
+    def test_too_many(self):
+        """Test if huge ranges are refused."""
+        self.assertRaises(ValueError, expand_names,
+                          'b{1..' + str(MAX_BATCH + 1) + '}')
+        return
+
+
+class TestBoardManagerBatch(TestBoardManager):
+
+    def test_add_many(self):
+        """Test if a list of resources is added with a single reply."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.add_resource(self.message_user_1, 'A,board{1..3}')
+        self.assertLastMessage('3 resources added: board1, board2, board3. '
+                               'Already in the list: A.')
+        self.assertEquals(sorted(self.robot.resources),
+                          ['A', 'board1', 'board2', 'board3'])
+        return
+
+    def test_remove_glob(self):
+        """Test if a pattern removes all matching resources."""
+        self.robot.add_resource(self.message_user_1, 'A board{1..3}')
+        self.robot.request(self.message_user_1, 'board2')
+        self.robot.remove_resource(self.message_user_1, 'board* X')
+        self.assertLastMessage('3 resources removed: board1, board2, '
+                               'board3. I know nothing about X.')
+        self.assertEquals(list(self.robot.resources), ['A'])
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_request_any(self):
+        """Test if request any gets the first free resource."""
+        self.robot.add_resource(self.message_user_1, 'board{1..3}')
+        self.robot.request(self.message_user_2, 'board1')
+        self.robot.request_any(self.message_user_1, 'board*')
+        self.assertLastMessage('You got board2, no one was using it.')
+        self.assertEquals(self.robot._user_resource('TestRobot'), 'board2')
+        return
+
+    def test_request_any_all_used(self):
+        """Test if request any complains when everything is in use."""
+        self.robot.add_resource(self.message_user_1, 'board1')
+        self.robot.request(self.message_user_2, 'board1')
+        self.robot.request_any(self.message_user_1, 'board*')
+        self.assertLastMessage('Sorry, all 1 of them are in use.')
+        self.robot.request_any(self.message_user_1, 'nothing*')
+        self.assertLastMessage('I don\'t know any resources like '
+                               '"nothing*".')
+        return
+
+
+class TestBoardManagerPools(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerPools, self).setUp()
+        self.robot.add_resource(self.message_user_1, 'arm1 arm2 x86')
+        self.robot.tag_resource(self.message_user_1, 'arm*', 'arm')
+        self.message_user_3 = ObjDict({'type': 'groupchat',
+                                       'sender': ObjDict(
+                                           {'nick': 'ThirdUser'})})
+
+    def test_tag(self):
+        """Test if tagging puts the resources in the pool."""
+        self.assertLastMessage('arm1, arm2 tagged as arm.')
+        self.assertEquals(self.robot.tags, {'arm': set(['arm1', 'arm2'])})
+        self.assertEquals(self.robot.free, {'arm': set(['arm1', 'arm2'])})
+        return
+
+    def test_request_tag(self):
+        """Test if requesting a tag gets a free resource and, when all are in
+        use, queues the user in the shortest list."""
+        self.robot.request(self.message_user_1, 'arm1')
+        self.robot.request_tag(self.message_user_2, 'arm')
+        self.assertLastMessage('You got arm2, no one was using it.',
+                               self.message_user_2)
+        self.assertEquals(self.robot.free['arm'], set())
+
+        self.robot.request(self.message_all, 'arm1')
+        self.robot.request_tag(self.message_user_3, 'arm')
+        self.assertLastMessage('AnotherUser is using arm2 right now, you\'re '
+                               'user 1 in the arm2 list.',
+                               self.message_user_3)
+        self.assertEquals(self.robot._consistency_errors(), [])
+
+        self.robot.done(self.message_user_3)
+        self.robot.done(self.message_user_2)
+        self.assertEquals(self.robot.free['arm'], set(['arm2']))
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_request_tag_reserved(self):
+        """Test if requesting a tag doesn't queue the user for a free
+        resource reserved for someone else."""
+        now = time.mktime((2026, 10, 17, 12, 0, 0, 0, 0, -1))
+        self.robot.clock = lambda: now
+        self.robot.request(self.message_user_1, 'arm1')
+        self.robot.reserve(self.message_user_2, 'arm2', '12:10', '13:00')
+        self.robot.request_tag(self.message_user_3, 'arm')
+        self.assertLastMessage('TestRobot is using arm1 right now, you\'re '
+                               'user 1 in the arm1 list.',
+                               self.message_user_3)
+        self.assertEquals(list(self.robot.resources['arm2']), [])
+
+        self.robot.untag_resource(self.message_user_1, 'arm1', 'arm')
+        self.robot.request_tag(self.message_all, 'arm')
+        self.assertLastMessage('Sorry, all of them are reserved for someone '
+                               'else right now.', self.message_all)
+        self.assertEquals(list(self.robot.resources['arm2']), [])
+        return
+
+    def test_request_tag_from_set(self):
+        """Test if requesting a tag says so when a set gives the resource up
+        right away."""
+        self.robot.request(self.message_all, 'arm2')
+        self.robot.request(self.message_user_3, 'x86')
+        self.robot.request_all(self.message_user_1, 'arm1 x86')
+        self.robot.set_priority(self.message_user_1, 'AnotherUser', 'urgent')
+        self.robot.request_tag(self.message_user_2, 'arm')
+        self.assertLastMessage('You got arm1, no one was using it.',
+                               self.message_user_2)
+        self.assertEquals(list(self.robot.resources['arm1']),
+                          ['AnotherUser', 'TestRobot'])
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_request_unknown_tag(self):
+        """Test if the bot complains about a tag with no resources."""
+        self.robot.request_tag(self.message_user_1, 'mips')
+        self.assertLastMessage('I don\'t know any resources tagged as mips.')
+        return
+
+    def test_untag_and_remove(self):
+        """Test if untagging and removing resources update the pools."""
+        self.robot.untag_resource(self.message_user_1, 'arm1', 'arm')
+        self.assertEquals(self.robot.tags, {'arm': set(['arm2'])})
+        self.robot.remove_resource(self.message_user_1, 'arm2')
+        self.assertEquals(self.robot.tags, {})
+        self.assertEquals(self.robot.free, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+
+class TestDurations(unittest.TestCase):
+
+    def test_parse(self):
+        """Test if durations are converted to seconds."""
+        self.assertEquals(parse_duration('45s'), 45)
+        self.assertEquals(parse_duration('30'), 1800)
+        self.assertEquals(parse_duration('2h'), 7200)
+        self.assertEquals(parse_duration('1d'), 86400)
+        self.assertEquals(parse_duration('soon'), None)
+        return
+
+    def test_format(self):
+        """Test if durations are shown with the largest unit."""
+        self.assertEquals(format_duration(7200), '2h')
+        self.assertEquals(format_duration(5400), '90m')
+        self.assertEquals(format_duration(45), '45s')
+        return
+
+
+class TestBoardManagerLeases(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerLeases, self).setUp()
+        self.now = 1000.0
+        self.robot.clock = lambda: self.now
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.lease_resource(self.message_user_1, 'A', '100s')
+        self.messages = []
+        self.robot.say = lambda content, **kwargs: \
+            self.messages.append(content)
+
+    def test_lease_message(self):
+        """Test if setting a lease replies with the duration."""
+        self.robot.lease_resource(self.message_user_1, 'A', '2h')
+        self.assertEquals(self.messages[-1],
+                          '@TestRobot A can be used for 2h at a time.')
+        self.robot.lease_resource(self.message_user_1, 'A', 'a while')
+        self.assertEquals(self.messages[-1],
+                          '@TestRobot How long is "a while"? Try something '
+                          'like 30m, 2h or 1d.')
+        return
+
+    def test_expire(self):
+        """Test if the holder gets a reminder and then loses the resource to
+        the next one in the list."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        del self.messages[:]
+
+        self.now += 50
+        self.robot._expire_leases(self.now)
+        self.assertEquals(self.messages, [])
+
+        self.now += 30
+        self.robot._expire_leases(self.now)
+        self.assertEquals(self.messages,
+                          ['@TestRobot you have A for 20s more, say "renew" '
+                           'if you still need it or "done" if you don\'t.'])
+
+        self.now += 20
+        self.robot._expire_leases(self.now)
+        self.assertEquals(self.messages[1:],
+                          ['@TestRobot your time with A is over, I\'m '
+                           'releasing it.',
+                           '@AnotherUser there is no one using A right now, '
+                           'you\'re free to go.'])
+        self.assertEquals(list(self.robot.resources['A']), ['AnotherUser'])
+
+        # the next holder got a brand new lease
+        self.assertEquals(self.robot.timers.deadline(('expire', 'A')),
+                          self.now + 100)
+        return
+
+    def test_expire_without_reminder(self):
+        """Test if a check past both the reminder and the end of the lease
+        only releases the resource."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        del self.messages[:]
+
+        self.now += 120
+        self.robot._expire_leases(self.now)
+        self.assertEquals(self.messages,
+                          ['@TestRobot your time with A is over, I\'m '
+                           'releasing it.',
+                           '@AnotherUser there is no one using A right now, '
+                           'you\'re free to go.'])
+        self.assertEquals(list(self.robot.resources['A']), ['AnotherUser'])
+        return
+
+    def test_done_cancels(self):
+        """Test if releasing the resource cancels the timers."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.done(self.message_user_1)
+        self.assertEquals(len(self.robot.timers), 0)
+        return
+
+    def test_renew(self):
+        """Test if renewing pushes the deadline."""
+        self.robot.request(self.message_user_1, 'A')
+        self.now += 90
+        self.robot.renew(self.message_user_1)
+        self.assertEquals(self.messages[-1],
+                          '@TestRobot Ok, you have A for 100s more.')
+        self.now += 20
+        self.robot._expire_leases(self.now)
+        self.assertEquals(list(self.robot.resources['A']), ['TestRobot'])
+
+        self.robot.renew(self.message_user_2)
+        self.assertEquals(self.messages[-1],
+                          '@AnotherUser You\'re not using anything right '
+                          'now.')
+        return
+
+
+class TestBoardManagerOutbox(unittest.TestCase):
+
+    def test_say_goes_through_outbox(self):
+        """Test if what the bot says is merged in a single message."""
+        robot = BoardManager(storage=Storage())
+        sent = []
+        robot._send = lambda content, **kwargs: sent.append(content)
+        robot.outbox.send = robot._send
+
+        message = ObjDict({'type': 'groupchat',
+                           'sender': ObjDict({'nick': 'TestRobot'})})
+        robot.add_resource(message, 'A')
+        robot.request(message, 'A')
+        robot.outbox.stop()
+        self.assertEquals(sent, ['@TestRobot Resource "A" added. There is no '
+                                 'one using it, you\'re free to go.'])
+        return
+
+
+@unittest.skipIf(asyncio is None, 'needs asyncio')
+class TestBoardManagerCore(unittest.TestCase):
+
+    def setUp(self):
+        self.robot = BoardManager(storage=Storage(), async_core=True)
+        self.chat = FakeChat()
+        self.robot.core.outbox.send = self.chat.send
+        self.robot.core.outbox.window = 0.01
+        self.robot.core.outbox.bucket = TokenBucket(rate=1000, burst=1000)
+
+    def tearDown(self):
+        self.robot.core.stop()
+
+    def _message(self, nick, room):
+        return ObjDict({'type': 'groupchat', 'mucroom': room,
+                        'sender': ObjDict({'nick': nick})})
+
+    def test_dispatch(self):
+        """Test if the handlers only queue the commands, which the core runs
+        in order, and the replies get to each room."""
+        admin = self._message('admin', 'R1')
+        self.robot.dispatch_admin(admin, 'add resource A')
+        for number in range(10):
+            self.robot.dispatch(self._message('user{0}'.format(number),
+                                              'R{0}'.format(number % 2)),
+                                'request A')
+        self.robot.dispatch(self._message('user0', 'R0'), 'done')
+        self.robot.check_leases()
+        self.robot.core.stop()
+
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['user1'] + ['user{0}'.format(number)
+                                       for number in range(2, 10)])
+        rooms = self.chat.rooms()
+        self.assertTrue(rooms['R0'][0].startswith(
+            '@user0 There is no one using it'))
+        self.assertTrue('\n'.join(rooms['R1']).startswith(
+            '@admin Resource "A" added.\n@user1 user0 is using it'))
+        # without a message, to the default room
+        self.assertEquals(rooms[None], ['@user1 there is no one using A '
+                                        'right now, you\'re free to go.'])
+        self.assertEquals(self.robot.core.processed, 14)
+        return
+
+
+class TestBoardManagerThreads(TestBoardManager):
+
+    def test_no_double_allocation(self):
+        """Hammer the bot from several threads and check that a resource is
+        never given to someone while someone else still has it."""
+        resources = ['A', 'B', 'C']
+        self.robot.add_resource(self.message_user_1, ' '.join(resources))
+        holders = dict((resource, None) for resource in resources)
+        errors = []
+        current = threading.local()
+
+        def grant(user, resource):
+            if holders[resource] is not None:
+                errors.append('{resource} given to {user} while {holder} '
+                              'has it'.format(resource=resource, user=user,
+                                              holder=holders[resource]))
+            holders[resource] = user
+
+        def say(content, message=None, **kwargs):
+            # runs inside the handlers, while they hold the lock
+            handoff = re.match(r'@(\S+) there is no one using (\S+) right',
+                               content)
+            if handoff:
+                grant(*handoff.groups())
+            elif 'There is no one using it' in content:
+                grant(message.sender.nick, current.resource)
+
+        self.robot.say = say
+
+        def user(number):
+            rnd = random.Random(number)
+            nick = 'user{0}'.format(number)
+            message = ObjDict({'type': 'groupchat',
+                               'sender': ObjDict({'nick': nick})})
+            for _ in range(300):
+                current.resource = rnd.choice(resources)
+                action = rnd.random()
+                if action < 0.5:
+                    self.robot.request(message, current.resource)
+                elif action < 0.8:
+                    # forget what we hold only when the bot can't give us
+                    # anything else in between
+                    with self.robot._lock:
+                        for (resource, holder) in list(holders.items()):
+                            if holder == nick:
+                                holders[resource] = None
+                        self.robot.done(message)
+                else:
+                    self.robot.is_free(message, current.resource)
+
+        threads = [threading.Thread(target=user, args=(number,))
+                   for number in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+        self.assertEquals(self.robot._consistency_errors(), [])
+        for resource in resources:
+            users = self.robot.resources[resource]
+            self.assertEquals(holders[resource], users[0] if users else None)
+        return
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestBoardManagerRedis(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerRedis, self).setUp()
+        server = fakeredis.FakeServer()
+        self.robot = self._robot(server)
+        self.other = self._robot(server)
+
+    def tearDown(self):
+        self.robot.storage.close()
+        self.other.storage.close()
+
+    def _robot(self, server):
+        storage = RedisStorage(fakeredis.FakeStrictRedis(server=server))
+        robot = BoardManager(storage=storage)
+        robot.say = self._mocked_say
+        return robot
+
+    def test_shared_state(self):
+        """Test if two bots see the same resources."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.other.request(self.message_user_1, 'A')
+        self.assertLastMessage('There is no one using it, '
+                               'you\'re free to go.')
+        self.robot.request(self.message_user_2, 'A')
+        self.assertLastMessage('TestRobot is using it right now, you\'re '
+                               'user 1 in the A list.', self.message_user_2)
+        self.other.done(self.message_user_1)
+        self.assertLastMessage('there is no one using A right now, you\'re '
+                               'free to go.', self.message_user_2)
+        self.robot._sync()
+        self.assertEquals(self.robot._state(), self.other._state())
+        return
+
+    def test_notified(self):
+        """Test if the other bot catches up without waiting for a command."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        deadline = time.time() + 5
+        while 'A' not in self.other.view and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.other.view['A'], (None, 0))
+        return
+
+    def test_conflict(self):
+        """Test if a bot that didn't see a change in time runs the command
+        again, and only what it says the second time is sent."""
+        sent = []
+        self.other.say = BoardManager.say.__get__(self.other)
+        self.other.outbox.post = lambda content, **kwargs: \
+            sent.append(content)
+
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.other._sync()
+        self.robot.request(self.message_user_1, 'A')
+
+        # the other bot misses the request once
+        updates = self.other.storage.updates
+        calls = []
+
+        def lagging(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                return (None, [])
+            return updates(*args, **kwargs)
+
+        self.other.storage.updates = lagging
+        self.other.request(self.message_user_2, 'A')
+        self.assertEquals(sent, ['@AnotherUser TestRobot is using it right '
+                                 'now, you\'re user 1 in the A list.'])
+        self.assertEquals(list(self.other.resources['A']),
+                          ['TestRobot', 'AnotherUser'])
+        return
+
+    def _lagging(self, robot):
+        """Make the robot miss the changes of the other bot once."""
+        updates = robot.storage.updates
+        calls = []
+
+        def lagging(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                return (None, [])
+            return updates(*args, **kwargs)
+
+        robot.storage.updates = lagging
+        return
+
+    def test_conflict_undone(self):
+        """Test if none of the operations of a command that conflicted are
+        kept, so it runs again from scratch."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.other.add_resource(self.message_user_1, 'B')
+        self._lagging(self.robot)
+        self.robot.add_resource(self.message_user_1, 'B C D')
+        self.assertLastMessage('2 resources added: C, D. Already in the '
+                               'list: B.')
+
+        self.other.add_resource(self.message_user_1, 'E')
+        self._lagging(self.robot)
+        self.robot.request_all(self.message_user_2, 'A C')
+        self.assertEquals([event[1] for event in self.robot.stats.log],
+                          [ENQUEUE, GRANT, ENQUEUE, GRANT])
+        self.other._sync()
+        self.assertEquals(self.robot._state(), self.other._state())
+        return
+
+
+class TestBoardManagerDispatch(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerDispatch, self).setUp()
+        self.robot.dispatch_admin(self.message_user_1, 'add resource A '
+                                  'undone-board')
+
+    def test_dispatch(self):
+        """Test if messages reach the right handler."""
+        self.assertLastMessage('2 resources added: A, undone-board.')
+        self.robot.dispatch(self.message_user_1, 'request undone-board')
+        self.assertLastMessage('There is no one using it, '
+                               'you\'re free to go.')
+        self.robot.dispatch(self.message_user_2, 'undone-board is free?')
+        self.assertLastMessage('TestRobot is using undone-board right now, '
+                               'but you\'re not in the list',
+                               self.message_user_2)
+        self.robot.dispatch(self.message_user_2, 'watch undone-board')
+        self.assertLastMessage('I\'ll tell you when undone-board is free.',
+                               self.message_user_2)
+        self.robot.dispatch(self.message_user_1, 'done')
+        self.assertEquals(self.last_message, 'undone-board is free to use, '
+                          'just ask it: @AnotherUser')
+        return
+
+    def test_admin_commands(self):
+        """Test if admin commands don't go through the regular dispatch."""
+        self.last_message = None
+        self.robot.dispatch(self.message_user_2, 'remove resource A')
+        self.assertEquals(self.last_message, None)
+        self.assertTrue('A' in self.robot.resources)
+        return
+
+
+class TestBoardManagerWatch(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerWatch, self).setUp()
+        self.robot.add_resource(self.message_user_1, 'A B C')
+        self.robot.tag_resource(self.message_user_1, 'A B', 'pool')
+        self.robot.request_all(self.message_user_1, 'A B')
+
+    def test_watch(self):
+        """Test if only the users watching a resource or its tags are told
+        it's free, all in a single message."""
+        self.robot.watch(self.message_user_2, 'A')
+        self.assertLastMessage('I\'ll tell you when A is free.',
+                               self.message_user_2)
+        self.robot.watch(self.message_all, 'pool')
+        self.assertLastMessage('I\'ll tell you when a resource tagged pool '
+                               'is free.', self.message_all)
+        self.robot.watch(self.message_user_2, 'A')
+        self.assertLastMessage('You\'re watching A already.',
+                               self.message_user_2)
+        self.robot.watch(self.message_user_2, 'D')
+        self.assertLastMessage('I never heard of "D", is it something you '
+                               'can eat?', self.message_user_2)
+
+        said = []
+        self.robot.say = lambda content, **kwargs: said.append(content)
+        self.robot.done(self.message_user_1)
+        self.assertEquals(said, ['@TestRobot Ok, A, B are free now.',
+                                 'A is free to use, just ask it: '
+                                 '@AnotherUser @all\n'
+                                 'B is free to use, just ask it: @all'])
+        return
+
+    def test_quiet(self):
+        """Test if no one but the user who freed it is told about a resource
+        no one else watches."""
+        self.robot.watch(self.message_user_1, 'A')
+        self.robot.watch(self.message_user_2, 'C')
+        said = []
+        self.robot.say = lambda content, **kwargs: said.append(content)
+        self.robot.done(self.message_user_1)
+        self.assertEquals(said, ['@TestRobot Ok, A, B are free now.'])
+        return
+
+    def test_unwatch(self):
+        """Test if users can stop watching one or all of what they
+        watch."""
+        self.robot.unwatch(self.message_user_2)
+        self.assertLastMessage('You weren\'t watching anything.',
+                               self.message_user_2)
+        for name in ('A', 'B', 'pool'):
+            self.robot.watch(self.message_user_2, name)
+        self.robot.unwatch(self.message_user_2, 'C')
+        self.assertLastMessage('You weren\'t watching C.',
+                               self.message_user_2)
+        self.robot.unwatch(self.message_user_2, 'A')
+        self.assertLastMessage('Ok, no more news about A.',
+                               self.message_user_2)
+        self.robot.unwatch(self.message_user_2)
+        self.assertLastMessage('Ok, no more news about B, pool.',
+                               self.message_user_2)
+        self.assertEquals(self.robot.watchers, {})
+        self.assertEquals(self.robot.watching, {})
+
+        said = []
+        self.robot.say = lambda content, **kwargs: said.append(content)
+        self.robot.done(self.message_user_1)
+        self.assertEquals(said, ['@TestRobot Ok, A, B are free now.'])
+        return
+
+    def test_state(self):
+        """Test if the watchers are part of the state, and leave with the
+        resources they watch."""
+        self.robot.watch(self.message_user_2, 'A')
+        self.robot.watch(self.message_user_2, 'pool')
+        self.robot.watch(self.message_all, 'C')
+        state = self.robot._state()
+        self.assertEquals(state['watchers'], {'A': ['AnotherUser'],
+                                              'pool': ['AnotherUser'],
+                                              'C': ['all']})
+        robot = BoardManager(storage=Storage())
+        robot._load(state, [])
+        self.assertEquals(robot._state(), state)
+
+        self.robot.remove_resource(self.message_user_1, 'C')
+        self.assertEquals(self.robot.watching,
+                          {'AnotherUser': set(['A', 'pool'])})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+
+class TestBoardManagerStats(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerStats, self).setUp()
+        self.now = 0.0
+        self.robot.clock = lambda: self.now
+        self.robot.add_resource(self.message_user_1, 'A')
+
+    def test_no_usage(self):
+        """Test the stats of a resource no one used."""
+        self.now = 120
+        self.robot.show_stats(self.message_user_1, 'A')
+        self.assertLastMessage('No one used A since 2m ago.')
+        self.robot.show_stats(self.message_user_1, 'B')
+        self.assertLastMessage('I never heard of "B", is it something you '
+                               'can eat?')
+        return
+
+    def test_stats(self):
+        """Test the stats after two users took turns."""
+        self.robot.request(self.message_user_1, 'A')
+        self.now = 600
+        self.robot.request(self.message_user_2, 'A')
+        self.now = 1800
+        self.robot.done(self.message_user_1)
+        self.now = 2400
+        self.robot.done(self.message_user_2)
+        self.now = 3600
+        self.robot.show_stats(self.message_user_1, 'A')
+        self.assertLastMessage('A in the last 60m: used 67% of the time, by '
+                               '2 users. Wait: p50 1s, p95 20m. Hold: p50 '
+                               '10m, p95 34m. Queue: 0.3 waiting on average, '
+                               '1 at most, 0 now.')
+        return
+
+    def test_replay_is_not_counted(self):
+        """Test if only live operations feed the statistics."""
+        self.robot._op_request('A', 'TestRobot')
+        self.assertEquals(self.robot.stats.log.count, 0)
+        return
+
+
+class TestBoardManagerMetrics(TestBoardManager):
+
+    def test_metrics(self):
+        """Test if handlers are timed and the queues show up in the
+        metrics."""
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.is_free(self.message_user_2, 'A')
+
+        lines = self.robot._metrics_text().splitlines()
+        self.assertTrue('boardmanager_queue_depth{resource="A"} 1' in lines)
+        self.assertTrue('boardmanager_resources_in_use 1' in lines)
+        for handler in ('add_resource', 'request', 'is_free'):
+            self.assertTrue(any(
+                line.startswith('boardmanager_handler_seconds_count{handler='
+                                '"' + handler + '"}')
+                for line in lines))
+        self.assertTrue(any(
+            line.startswith('boardmanager_lookup_seconds_count')
+            for line in lines))
+        self.assertTrue(any(
+            line.startswith('boardmanager_lock_wait_seconds_count')
+            for line in lines))
+        return
+
+
+class TestBoardManagerIndex(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerIndex, self).setUp()
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.add_resource(self.message_user_1, 'B')
+
+    def test_index_follows_requests(self):
+        """Test if the user index is updated when users request and release
+        resources."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        self.assertEquals(self.robot._user_resource('TestRobot'), 'A')
+        self.assertEquals(self.robot._user_resource('AnotherUser'), 'A')
+        self.assertEquals(self.robot._consistency_errors(), [])
+
+        self.robot.done(self.message_user_2)
+        self.assertEquals(self.robot._user_resource('AnotherUser'), None)
+        self.assertEquals(self.robot._consistency_errors(), [])
+
+        self.robot.done(self.message_user_1)
+        self.assertEquals(self.robot.users, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_index_after_remove(self):
+        """Test if removing a resource also drops its users from the
+        index."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.remove_resource(self.message_user_1, 'A')
+        self.assertEquals(self.robot.users, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+
+        self.robot.request(self.message_user_1, 'B')
+        self.assertLastMessage('There is no one using it, '
+                               'you\'re free to go.')
+        return
+
+    def test_consistency_errors(self):
+        """Test if the checker detects an index out of sync."""
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.users['TestRobot'] = 'B'
+        self.robot.users['Ghost'] = 'A'
+        self.assertEquals(len(self.robot._consistency_errors()), 2)
+        return
+
+
+class TestBoardManagerJournal(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerJournal, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.robot = self._restart()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _restart(self, snapshot_every=1000):
+        robot = BoardManager(storage=Journal(self.directory,
+                                             snapshot_every=snapshot_every))
+        robot.say = self._mocked_say
+        return robot
+
+    def _fill(self):
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.add_resource(self.message_user_1, 'B')
+        self.robot.add_resource(self.message_user_1, 'C')
+        self.robot.remove_resource(self.message_user_1, 'C')
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.request(self.message_all, 'B')
+        self.robot.done(self.message_user_1)
+        self.robot.tag_resource(self.message_user_1, 'A B', 'pool')
+        self.robot.untag_resource(self.message_user_1, 'B', 'pool')
+
+    def test_restart(self):
+        """Test if the resources survive a restart."""
+        self._fill()
+        self.robot.storage.close()
+
+        robot = self._restart()
+        self.assertEquals(sorted(robot.resources), ['A', 'B'])
+        self.assertEquals(list(robot.resources['A']), ['AnotherUser'])
+        self.assertEquals(list(robot.resources['B']), ['all'])
+        self.assertEquals(robot.tags, {'pool': set(['A'])})
+        self.assertEquals(robot._consistency_errors(), [])
+        return
+
+    def test_restart_from_snapshot(self):
+        """Test if the state is the same when restoring from a snapshot plus
+        the log tail."""
+        self.robot = self._restart(snapshot_every=3)
+        self._fill()
+        self.robot.storage.close()
+
+        robot = self._restart()
+        self.assertEquals(robot._state(), self.robot._state())
+        self.assertEquals(robot._consistency_errors(), [])
+        return
+
+
+class TestBoardManagerSnapshots(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerSnapshots, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.robot = self._start(Storage())
+        self.robot.add_resource(self.message_user_1, 'A B')
+        self.robot.tag_resource(self.message_user_1, 'A B', 'pool')
+        self.robot.lease_resource(self.message_user_1, 'A', '2h')
+        self.robot.request(self.message_user_1, 'A')
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.request_all(self.message_all, 'A B')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _start(self, storage):
+        robot = BoardManager(storage=storage, snapshot_dir=self.directory)
+        robot.say = self._mocked_say
+        return robot
+
+    def test_restore(self):
+        """Test if a snapshot brings back a removed resource with its
+        list."""
+        state = self.robot._state()
+        timers = len(self.robot.timers)
+        self.robot.take_snapshot(self.message_user_1, 'before')
+        self.assertLastMessage('Saved 2 resources in snapshot "before".')
+        self.robot.remove_resource(self.message_user_1, 'A')
+        self.robot.restore_snapshot(self.message_user_1, 'before')
+        self.assertLastMessage('Restored snapshot "before", 2 resources are '
+                               'back.')
+        self.assertEquals(self.robot._state(), state)
+        self.assertEquals(self.robot._consistency_errors(), [])
+        self.assertEquals(len(self.robot.timers), timers)
+        return
+
+    def test_default_name(self):
+        """Test if snapshots without a name are named after the time."""
+        self.robot.clock = lambda: time.mktime((2026, 10, 17, 22, 30, 5, 0,
+                                                0, -1))
+        self.robot.take_snapshot(self.message_user_1)
+        self.assertLastMessage('Saved 2 resources in snapshot '
+                               '"20261017-223005".')
+        self.assertEquals(os.listdir(self.directory),
+                          ['20261017-223005' + EXTENSION])
+        return
+
+    def test_cant_restore(self):
+        """Test if missing and broken snapshots leave the state alone."""
+        state = self.robot._state()
+        self.robot.restore_snapshot(self.message_user_1, 'nothing')
+        self.assertLastMessage('I have no snapshot called "nothing".')
+        with open(os.path.join(self.directory, 'broken' + EXTENSION),
+                  'wb') as content:
+            content.write(b'not a snapshot at all')
+        self.robot.restore_snapshot(self.message_user_1, 'broken')
+        self.assertLastMessage('I can\'t restore "broken": not a snapshot.')
+        self.assertEquals(self.robot._state(), state)
+        return
+
+    def test_journal(self):
+        """Test if a restore is logged, so it survives a restart."""
+        self.robot.take_snapshot(self.message_user_1, 'before')
+        robot = self._start(Journal(self.directory))
+        robot.restore_snapshot(self.message_user_1, 'before')
+        robot.request(self.message_user_1, 'B')
+        robot.storage.close()
+
+        restarted = self._start(Journal(self.directory))
+        self.assertEquals(restarted._state(), robot._state())
+        self.assertEquals(list(restarted.resources['A']),
+                          ['TestRobot', 'AnotherUser', 'all'])
+        self.assertEquals(restarted._consistency_errors(), [])
+        return
+
+    def test_startup(self):
+        """Test if a snapshot can be restored without a command, and only
+        admins restore them in the chat."""
+        self.robot.take_snapshot(self.message_user_1, 'before')
+        robot = self._start(Storage())
+        robot.restore_file(os.path.join(self.directory, 'before' + EXTENSION))
+        self.assertEquals(robot._state(), self.robot._state())
+
+        admin = re.compile('^(?P<body>' + ADMIN_COMMANDS + '.+)')
+        self.assertTrue(admin.match('snapshot'))
+        self.assertTrue(admin.match('restore before'))
+        self.assertFalse(admin.match('restore is free?'))
+        robot.dispatch(self.message_user_2, 'snapshot')
+        self.assertEquals(os.listdir(self.directory), ['before' + EXTENSION])
+        return
+
+
+class TestBoardManagerStatus(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerStatus, self).setUp()
+        self.robot.add_resource(self.message_user_1, 'board{1..3}, jtag')
+        self.robot.request(self.message_user_1, 'board2')
+        self.robot.request(self.message_user_2, 'board2')
+
+    def test_status(self):
+        """Test the status of every resource."""
+        self.robot.show_status(self.message_user_1)
+        self.assertLastMessage('4 resources:\n'
+                               'board1: free\n'
+                               'board2: used by TestRobot, 1 waiting\n'
+                               'board3: free\n'
+                               'jtag: free')
+        self.robot.done(self.message_user_1)
+        self.robot.show_status(self.message_user_1, 'board[2-9]')
+        self.assertLastMessage('2 resources:\n'
+                               'board2: used by AnotherUser\n'
+                               'board3: free')
+        return
+
+    def test_unknown(self):
+        """Test the status of resources that don't exist."""
+        self.robot.show_status(self.message_user_1, 'nothing*')
+        self.assertLastMessage('I don\'t know any resources like '
+                               '"nothing*".')
+        self.robot.remove_resource(self.message_user_1, '*')
+        self.robot.show_status(self.message_user_1)
+        self.assertLastMessage('There are no resources yet.')
+        return
+
+    def test_pages(self):
+        """Test if a long status is split in pages."""
+        self.robot.status.page_length = 30
+        self.robot.show_status(self.message_user_1, 'board*')
+        self.assertLastMessage('3 resources, page 1 of 3:\n'
+                               'board1: free\n'
+                               'Say "status board* page 2" for more.')
+        self.robot.show_status(self.message_user_1, 'board*', '3')
+        self.assertLastMessage('3 resources, page 3 of 3:\n'
+                               'board3: free')
+        self.robot.show_status(self.message_user_1, None, '9')
+        self.assertLastMessage('There are only 3 pages.')
+        return
+
+    def test_dispatch(self):
+        """Test if the status commands reach the handler."""
+        self.assertEquals(self.robot.router.match('status'),
+                          ('show_status', {'pattern': None, 'page': None}))
+        self.assertEquals(self.robot.router.match('status page 2'),
+                          ('show_status', {'pattern': None, 'page': '2'}))
+        self.assertEquals(self.robot.router.match('status b* page 2'),
+                          ('show_status', {'pattern': 'b*', 'page': '2'}))
+        return
+
+
+class TestBoardManagerPriorities(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerPriorities, self).setUp()
+        self.now = 0.0
+        self.robot.clock = lambda: self.now
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.request(self.message_user_1, 'A')
+        self.oncall = ObjDict({'type': 'groupchat',
+                               'sender': ObjDict({'nick': 'oncall'})})
+
+    def test_priority(self):
+        """Test if users with a higher priority get ahead in the list."""
+        self.robot.set_priority(self.message_user_1, 'oncall', 'high')
+        self.assertLastMessage('oncall has high priority now.')
+        self.robot.request(self.message_user_2, 'A')
+        self.now = 60
+        self.robot.request(self.oncall, 'A')
+        self.assertLastMessage('TestRobot is using it right now, you\'re '
+                               'user 1 in the A list.', self.oncall)
+        self.robot.is_free(self.message_user_2, 'A')
+        self.assertLastMessage('TestRobot is using it right now, you\'re '
+                               'user 2 in the list.', self.message_user_2)
+        self.robot.done(self.message_user_1)
+        self.assertLastMessage('there is no one using A right now, you\'re '
+                               'free to go.', self.oncall)
+        return
+
+    def test_aging(self):
+        """Test if waiting long enough beats a higher priority."""
+        self.robot.set_priority(self.message_user_1, 'oncall', 'high')
+        self.robot.request(self.message_user_2, 'A')
+        self.now = 3601
+        self.robot.request(self.oncall, 'A')
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['TestRobot', 'AnotherUser', 'oncall'])
+        return
+
+    def test_share(self):
+        """Test if users who held resources for long wait behind the
+        others, less so with a larger share."""
+        self.robot.add_resource(self.message_user_1, 'B')
+        self.robot.request(self.message_user_2, 'B')
+        self.now = 4 * 3600
+        self.robot.done(self.message_user_2)
+        self.robot.request(self.message_user_2, 'A')
+        self.now += 1800
+        self.robot.request(self.oncall, 'A')
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['TestRobot', 'oncall', 'AnotherUser'])
+
+        self.robot.set_share(self.message_user_1, 'AnotherUser', '4')
+        self.assertLastMessage('AnotherUser has a share of 4 now.')
+        self.robot.done(self.message_user_2)
+        self.robot.done(self.oncall)
+        self.robot.request(self.message_user_2, 'A')
+        self.now += 1800
+        self.robot.request(self.oncall, 'A')
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['TestRobot', 'AnotherUser', 'oncall'])
+        return
+
+    def test_invalid(self):
+        """Test if unknown priorities and bad shares are refused."""
+        self.robot.set_priority(self.message_user_1, 'oncall', 'vip')
+        self.assertLastMessage('The priorities are urgent, high, normal, '
+                               'low.')
+        for share in ('0', 'lots'):
+            self.robot.set_share(self.message_user_1, 'oncall', share)
+            self.assertLastMessage('A share is a number larger than 0, '
+                                   'like 2 or 0.5.')
+        self.assertEquals(self.robot.scheduler.priorities, {})
+        self.assertEquals(self.robot.scheduler.shares, {})
+        return
+
+    def test_state(self):
+        """Test if the order of the lists and the priorities survive a
+        snapshot."""
+        self.robot.set_priority(self.message_user_1, 'oncall', 'urgent')
+        self.robot.set_share(self.message_user_1, 'AnotherUser', '0.5')
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.request(self.oncall, 'A')
+
+        robot = BoardManager(storage=Storage())
+        robot._load(self.robot._state(), [])
+        self.assertEquals(list(robot.resources['A']),
+                          ['TestRobot', 'oncall', 'AnotherUser'])
+        self.assertEquals(robot.scheduler.priorities, {'oncall': 'urgent'})
+        self.assertEquals(robot.scheduler.shares, {'AnotherUser': 0.5})
+        self.assertEquals(robot._state(), self.robot._state())
+        return
+
+    def test_dispatch(self):
+        """Test if the priority commands are only for admins."""
+        self.assertEquals(
+            self.robot.admin_router.match('set priority of oncall to high'),
+            ('set_priority', {'user': 'oncall', 'priority': 'high'}))
+        self.assertEquals(
+            self.robot.router.match('set share of oncall to 2'),
+            (None, None))
+        return
+
+
+class TestBoardManagerReservations(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerReservations, self).setUp()
+        self.now = self._time(17, 12)
+        self.robot.clock = lambda: self.now
+        self.robot.add_resource(self.message_user_1, 'A')
+
+    def _time(self, day, hour, minute=0):
+        return time.mktime((2026, 10, day, hour, minute, 0, 0, 0, -1))
+
+    def test_reserve(self):
+        """Test booking a resource and finding free slots."""
+        self.robot.reserve(self.message_user_1, 'A', '13:00', '14:00')
+        self.assertLastMessage('A is yours from 2026-10-17 13:00 to '
+                               '2026-10-17 14:00.')
+        self.robot.reserve(self.message_user_2, 'A', '13:30', '15:00')
+        self.assertLastMessage('A is reserved for TestRobot from 2026-10-17 '
+                               '13:00 to 2026-10-17 14:00; the next free '
+                               'slot that long starts at 2026-10-17 14:00.',
+                               self.message_user_2)
+        self.robot.reserve(self.message_user_2, 'A', '22:00', '02:00')
+        self.assertLastMessage('A is yours from 2026-10-17 22:00 to '
+                               '2026-10-18 02:00.', self.message_user_2)
+
+        self.robot.show_reservations(self.message_user_1, 'A')
+        self.assertLastMessage('Reservations of A: TestRobot from 2026-10-17 '
+                               '13:00 to 2026-10-17 14:00, AnotherUser from '
+                               '2026-10-17 22:00 to 2026-10-18 02:00.')
+        self.robot.next_slot(self.message_user_1, 'A', '30m')
+        self.assertLastMessage('A has no reservations from 2026-10-17 12:00 '
+                               'to 2026-10-17 12:30.')
+        self.robot.next_slot(self.message_user_1, 'A', '9h')
+        self.assertLastMessage('A has no reservations from 2026-10-18 02:00 '
+                               'to 2026-10-18 11:00.')
+        return
+
+    def test_invalid(self):
+        """Test if times that make no sense are refused."""
+        self.robot.reserve(self.message_user_1, 'A', '25:00', '26:00')
+        self.assertLastMessage('When is "25:00-26:00"? Try something like '
+                               '22:00-02:00 or 2026-10-18 22:00-2026-10-19 '
+                               '02:00.')
+        self.robot.reserve(self.message_user_1, 'A', '2026-10-16 10:00',
+                           '2026-10-16 11:00')
+        self.assertLastMessage('That\'s over before it starts.')
+        self.robot.reserve(self.message_user_1, 'B', '13:00', '14:00')
+        self.assertLastMessage('I never heard of "B", is it something you '
+                               'can eat?')
+        self.assertEquals(self.robot.reservations, {})
+        return
+
+    def test_begin_and_end(self):
+        """Test if the resource goes to whoever reserved it for the
+        reservation, and back after it."""
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.reserve(self.message_user_1, 'A', '13:00', '14:00')
+        self.now = self._time(17, 13)
+        self.robot.check_leases()
+        self.assertEquals(list(self.robot.resources['A']), ['TestRobot'])
+        self.assertLastMessage('there is no one using A right now, you\'re '
+                               'free to go.')
+
+        self.robot.request(self.message_user_2, 'A')
+        self.now = self._time(17, 14)
+        self.robot.check_leases()
+        self.assertEquals(list(self.robot.resources['A']), ['AnotherUser'])
+        self.assertEquals(self.robot.reservations, {})
+        return
+
+    def test_not_granted_before_reservation(self):
+        """Test if a waiting user doesn't get a resource that is about to be
+        reserved for someone else."""
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.request(self.message_all, 'A')
+        self.robot.reserve(self.message_user_1, 'A', '12:20', '13:00')
+        self.robot.done(self.message_user_2)
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['TestRobot', 'all'])
+
+        # done before the reservation is over
+        self.now = self._time(17, 12, 30)
+        self.robot.check_leases()
+        self.robot.done(self.message_user_1)
+        self.assertEquals(list(self.robot.resources['A']), ['all'])
+        self.assertEquals(self.robot.reservations, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_request_reserved(self):
+        """Test if a free resource reserved soon is kept for the one who
+        reserved it."""
+        self.robot.reserve(self.message_user_1, 'A', '12:10', '13:00')
+        self.robot.request(self.message_user_2, 'A')
+        self.assertLastMessage('A is reserved for TestRobot from 2026-10-17 '
+                               '12:10, try another one.',
+                               self.message_user_2)
+        self.robot.request_any(self.message_user_2, 'A')
+        self.assertLastMessage('Sorry, all 1 of them are in use.',
+                               self.message_user_2)
+        self.robot.request(self.message_user_1, 'A')
+        self.assertEquals(list(self.robot.resources['A']), ['TestRobot'])
+        return
+
+    def test_cancel(self):
+        """Test cancelling a reservation."""
+        self.robot.reserve(self.message_user_1, 'A', '13:00', '14:00')
+        self.robot.cancel_reservation(self.message_user_2, 'A')
+        self.assertLastMessage('You have no reservations of A.',
+                               self.message_user_2)
+        self.robot.cancel_reservation(self.message_user_1, 'A')
+        self.assertLastMessage('Your reservation of A from 2026-10-17 13:00 '
+                               'to 2026-10-17 14:00 is cancelled.')
+        self.assertEquals(self.robot.reservations, {})
+        self.assertFalse(('begin', 'A') in self.robot.timers)
+        return
+
+    def test_state(self):
+        """Test if the reservations survive a snapshot."""
+        self.robot.reserve(self.message_user_1, 'A', '13:00', '14:00')
+        robot = BoardManager(storage=Storage())
+        robot._load(self.robot._state(), [])
+        self.assertEquals(list(robot.reservations['A']),
+                          [(self._time(17, 13), self._time(17, 14),
+                            'TestRobot')])
+        self.assertEquals(robot.timers.deadline(('begin', 'A')),
+                          self._time(17, 13))
+        return
+
+    def test_dispatch(self):
+        """Test if the reservation commands reach their handlers."""
+        self.assertEquals(
+            self.robot.router.match('reserve A 2026-10-18 22:00 - 02:00'),
+            ('reserve', {'resource': 'A', 'start': '2026-10-18 22:00',
+                         'end': '02:00'}))
+        self.assertEquals(self.robot.router.match('next slot of A for 2h'),
+                          ('next_slot', {'resource': 'A', 'duration': '2h'}))
+        return
+
+
+class TestBoardManagerSets(TestBoardManager):
+
+    def setUp(self):
+        super(TestBoardManagerSets, self).setUp()
+        self.now = 0.0
+        self.robot.clock = lambda: self.now
+        self.robot.add_resource(self.message_user_1, 'A')
+        self.robot.add_resource(self.message_user_1, 'B')
+        self.robot.add_resource(self.message_user_1, 'C')
+        self.oncall = ObjDict({'type': 'groupchat',
+                               'sender': ObjDict({'nick': 'oncall'})})
+
+    def test_all_free(self):
+        """Test if a set of free resources is given at once, and released at
+        once."""
+        self.robot.request_all(self.message_user_1, 'B, A')
+        self.assertLastMessage('You got A, B, no one was using them.')
+        self.robot.request(self.message_user_1, 'C')
+        self.assertLastMessage('stop being greedy and free A first.')
+        self.robot.done(self.message_user_1)
+        self.assertEquals(self.robot.view['A'], (None, 0))
+        self.assertEquals(self.robot.view['B'], (None, 0))
+        self.assertEquals(self.robot.bundles, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_wait_for_all(self):
+        """Test if a set waits until all of it is free, without anyone else
+        getting the part that is."""
+        self.robot.request(self.message_user_2, 'A')
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.assertLastMessage('A (AnotherUser) in use right now; I\'ll tell '
+                               'you when you have all of A, B.')
+        self.assertEquals(self.robot.view['B'], ('TestRobot', 1))
+        self.robot.request(self.oncall, 'B')
+        self.assertLastMessage('TestRobot is using it right now, you\'re '
+                               'user 1 in the B list.', self.oncall)
+        self.robot.done(self.message_user_2)
+        self.assertLastMessage('you have A, B now, go ahead.')
+        self.assertEquals(self.robot._consistency_errors(), [])
+        self.robot.done(self.message_user_1)
+        self.assertLastMessage('there is no one using B right now, you\'re '
+                               'free to go.', self.oncall)
+        self.assertEquals(self.robot.view['A'], (None, 0))
+        return
+
+    def test_lower_key_takes_over(self):
+        """Test if someone who comes first takes a resource kept for a set,
+        so two sets can't wait for each other."""
+        self.robot.request(self.message_user_2, 'B')
+        self.now = 60
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.robot.set_priority(self.message_user_1, 'oncall', 'high')
+        self.robot.request_all(self.oncall, 'A B')
+        self.assertEquals(list(self.robot.resources['A']),
+                          ['oncall', 'TestRobot'])
+        self.assertEquals(list(self.robot.resources['B']),
+                          ['AnotherUser', 'oncall', 'TestRobot'])
+        self.assertEquals(self.robot._consistency_errors(), [])
+        self.robot.done(self.message_user_2)
+        self.assertLastMessage('you have A, B now, go ahead.', self.oncall)
+        self.robot.done(self.oncall)
+        self.assertLastMessage('you have A, B now, go ahead.')
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_single_takes_over(self):
+        """Test if a single request with a lower key gets a resource kept for
+        a set right away."""
+        self.robot.request(self.message_user_2, 'B')
+        self.now = 60
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.robot.set_priority(self.message_user_1, 'oncall', 'high')
+        self.robot.request(self.oncall, 'A')
+        self.assertLastMessage('There is no one using it, you\'re free to '
+                               'go.', self.oncall)
+        self.robot.done(self.message_user_2)
+        self.assertEquals(self.robot.view['B'], ('TestRobot', 1))
+        self.robot.done(self.oncall)
+        self.assertLastMessage('you have A, B now, go ahead.')
+        return
+
+    def test_give_up(self):
+        """Test if leaving the lists of a set frees what was kept for it."""
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.request_all(self.message_user_1, 'A B C')
+        self.assertLastMessage('B (AnotherUser) in use right now; I\'ll tell '
+                               'you when you have all of A, B, C.')
+        self.robot.done(self.message_user_1)
+        self.assertLastMessage('Ok, you\'re out of the lists for A, B, C')
+        self.assertEquals(self.robot.view['A'], (None, 0))
+        self.assertEquals(self.robot.view['B'], ('AnotherUser', 1))
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_remove(self):
+        """Test if removing a resource drops the sets with it."""
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.robot.remove_resource(self.message_user_1, 'B')
+        self.assertEquals(self.robot.bundles, {})
+        self.assertEquals(self.robot.view['A'], (None, 0))
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_remove_wakes(self):
+        """Test if removing a resource tells the set holder and whoever gets
+        the other resources of the set now."""
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.watch(self.oncall, 'A')
+        said = []
+        self.robot.say = lambda content, **kwargs: said.append(content)
+        self.robot.remove_resource(self.message_user_1, 'A')
+        self.assertEquals(said, ['@TestRobot A was removed, so you\'re out of '
+                                 'the lists for A, B.',
+                                 '@AnotherUser there is no one using B right '
+                                 'now, you\'re free to go.',
+                                 '@TestRobot Resource removed'])
+        self.assertEquals(list(self.robot.resources['B']), ['AnotherUser'])
+
+        self.robot.request_all(self.message_user_1, 'B C')
+        self.robot.watch(self.oncall, 'C')
+        del said[:]
+        self.robot.remove_resource(self.message_user_1, 'B')
+        self.assertEquals(said, ['@TestRobot B was removed, so you\'re out of '
+                                 'the lists for B, C.',
+                                 'C is free to use, just ask it: @oncall',
+                                 '@TestRobot Resource removed'])
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_not_granted_yet(self):
+        """Test if a set waiting for part of it can't renew, and is told the
+        rest is only kept for it."""
+        self.robot.lease_resource(self.message_user_1, 'A B', '1h')
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.robot.renew(self.message_user_1)
+        self.assertLastMessage('You don\'t have all of A, B yet, the time '
+                               'only starts when you do.')
+        self.assertFalse(('expire', 'A') in self.robot.timers)
+        self.robot.is_free(self.message_user_1, 'A')
+        self.assertLastMessage('A is kept for you until you have all of A, '
+                               'B.')
+
+        self.robot.done(self.message_user_2)
+        self.robot.is_free(self.message_user_1, 'A')
+        self.assertLastMessage('Why are you asking if A is free when you\'re '
+                               'the one using it?')
+        self.robot.renew(self.message_user_1)
+        self.assertLastMessage('Ok, you have A, B for 1h more.')
+        return
+
+    def test_leases(self):
+        """Test if the leases only start when the whole set is there."""
+        self.robot.lease_resource(self.message_user_1, 'A B', '1h')
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.request_all(self.message_user_1, 'A B')
+        self.assertFalse(('expire', 'A') in self.robot.timers)
+        self.now = 600
+        self.robot.done(self.message_user_2)
+        self.assertEquals(self.robot.timers.deadline(('expire', 'A')), 4200)
+        self.assertEquals(self.robot.timers.deadline(('expire', 'B')), 4200)
+        self.now = 3480
+        self.robot.check_leases()
+        self.assertLastMessage('you have B for 12m more, say "renew" if you '
+                               'still need it or "done" if you don\'t.')
+        self.now = 4200
+        self.robot.check_leases()
+        self.assertEquals(self.robot.bundles, {})
+        self.assertEquals(self.robot._consistency_errors(), [])
+        return
+
+    def test_state(self):
+        """Test if the sets survive a snapshot and a replay."""
+        self.robot.request(self.message_user_2, 'B')
+        self.robot.request_all(self.message_user_1, 'A B')
+        snapshot = BoardManager(storage=Storage())
+        snapshot._load(self.robot._state(), [])
+        replay = BoardManager(storage=Storage())
+        replay._load(None, [('add', ['A']), ('add', ['B']), ('add', ['C']),
+                            ('request', ['B', 'AnotherUser', 0.0]),
+                            ('request_all', [['A', 'B'], 'TestRobot', 0.0])])
+        for robot in (snapshot, replay):
+            self.assertEquals(robot.bundles, {'TestRobot': ('A', 'B')})
+            self.assertEquals(robot.view, self.robot.view)
+            self.assertEquals(robot._consistency_errors(), [])
+        return
+
+    def test_dispatch(self):
+        """Test if several names reach the set request, and the other
+        requests still work."""
+        self.assertEquals(self.robot.router.match('request A B C'),
+                          ('request_all', {'resources': 'A B C'}))
+        self.assertEquals(self.robot.router.match('request A'),
+                          ('request', {'resource': 'A'}))
+        self.assertEquals(self.robot.router.match('request any of A B'),
+                          ('request_any', {'resources': 'A B'}))
+        self.robot.request_all(self.message_user_1, 'A D')
+        self.assertLastMessage('I never heard of "D", is it something you '
+                               'can eat?')
+        self.robot.request_all(self.message_user_1, 'A A')
+        self.assertLastMessage('There is no one using it, you\'re free to '
+                               'go.')
+        return
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+import re
+import unittest
+
+# ----------------------------------------------------------------------
+#  The router
+# ----------------------------------------------------------------------
+
+LITERAL = re.compile(r'^[\w-]+$')
+
+
+def command(pattern, admin_only=False):
+    """Mark a plugin method as the handler of the command matching `pattern`.
+    The pattern is anchored in both ends."""
+    def wrapper(function):
+        function.command = (pattern, admin_only)
+        return function
+    return wrapper
+
+
+class Node(object):
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = []
+
+
+class Router(object):
+    """Finds the handler for a message in a single pass.
+
+    Routes are kept in a trie keyed by the literal words in the start of their
+    patterns ("request any of", "add resource"...). The message is split in
+    words once and walks down the trie; only the patterns in the nodes it
+    reaches are tried, starting from the deepest (most specific) one. Patterns
+    starting with a group ("<resource> is free?") sit in the root, so they are
+    tried last."""
+
+    def __init__(self, flags=re.IGNORECASE):
+        self.flags = flags
+        self._root = Node()
+
+    @classmethod
+    def from_class(cls, plugin, admin_only=False):
+        """Build a router with the methods marked with `command`."""
+        router = cls()
+        for name in sorted(dir(plugin)):
+            info = getattr(getattr(plugin, name), 'command', None)
+            if info and info[1] == admin_only:
+                router.add(info[0], name)
+        return router
+
+    def add(self, pattern, handler):
+        node = self._root
+        for word in pattern.split(' '):
+            if not LITERAL.match(word):
+                break
+            node = node.children.setdefault(word.lower(), Node())
+        node.routes.append((re.compile('(?:' + pattern + r')\Z', self.flags),
+                            handler))
+        return
+
+    def match(self, text):
+        """Return the handler for the text and the named groups of its
+        pattern, or (None, None) if nothing matches."""
+        text = text.strip()
+        node = self._root
+        candidates = [node.routes]
+        for word in text.split():
+            node = node.children.get(word.lower())
+            if node is None:
+                break
+            candidates.append(node.routes)
+
+        for routes in reversed(candidates):
+            for (regex, handler) in routes:
+                match = regex.match(text)
+                if match:
+                    return (handler, match.groupdict())
+        return (None, None)
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = Router()
+        self.router.add(r'request (?P<resource>\S+)', 'request')
+        self.router.add(r'request any of (?P<resources>.+)', 'request_any')
+        self.router.add(r'request any (?P<tag>\S+)', 'request_tag')
+        self.router.add(r'done', 'done')
+        self.router.add(r'(?P<resource>\S+) is free\?', 'is_free')
+
+    def test_most_specific(self):
+        """Test if the longest literal prefix wins."""
+        self.assertEquals(self.router.match('request any of b*'),
+                          ('request_any', {'resources': 'b*'}))
+        self.assertEquals(self.router.match('request any arm'),
+                          ('request_tag', {'tag': 'arm'}))
+        self.assertEquals(self.router.match('Request board'),
+                          ('request', {'resource': 'board'}))
+        return
+
+    def test_anchored(self):
+        """Test if patterns must match the whole message."""
+        self.assertEquals(self.router.match('request undone-board'),
+                          ('request', {'resource': 'undone-board'}))
+        self.assertEquals(self.router.match('done '), ('done', {}))
+        self.assertEquals(self.router.match('done with it'), (None, None))
+        self.assertEquals(self.router.match('hello'), (None, None))
+        return
+
+    def test_root_patterns(self):
+        """Test if patterns without a literal prefix are still found."""
+        self.assertEquals(self.router.match('done is free?'),
+                          ('is_free', {'resource': 'done'}))
+        return
+
+    def test_from_class(self):
+        """Test if the routes are collected from the marked methods."""
+        class Plugin(object):
+            @command('hello (?P<who>\\S+)')
+            def hello(self, message, who=None):
+                pass
+
+            @command('reset', admin_only=True)
+            def reset(self, message):
+                pass
+
+        self.assertEquals(Router.from_class(Plugin).match('hello you'),
+                          ('hello', {'who': 'you'}))
+        self.assertEquals(Router.from_class(Plugin).match('reset'),
+                          (None, None))
+        self.assertEquals(Router.from_class(Plugin, True).match('reset'),
+                          ('reset', {}))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
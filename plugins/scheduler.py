@@ -0,0 +1,126 @@
+import math
+import unittest
+
+# ----------------------------------------------------------------------
+#  The scheduler
+# ----------------------------------------------------------------------
+
+# priority classes, as the head start (in seconds) their users get in the
+# lists
+PRIORITIES = {'urgent': 4 * 3600, 'high': 3600, 'normal': 0, 'low': -3600}
+DEFAULT_PRIORITY = 'normal'
+# how fast the usage of a user is forgotten
+USAGE_HALF_LIFE = 8 * 3600
+# seconds a user is pushed back in the lists for each second they held
+# something recently, with a share of 1
+SHARE_PENALTY = 0.25
+
+
+class Scheduler(object):
+    """Decides where users get in the lists of the resources.
+
+    Everyone waiting is sorted by a key in seconds: when they asked for the
+    resource, minus the head start of their priority class, plus a penalty for
+    the time they held resources recently (divided by their share, so users
+    with a larger share are pushed back less). The key doesn't change while
+    they wait, but since it counts from when they asked, waiting is as good as
+    a head start: a "low" user who has been waiting for more than two hours is
+    served before a "high" one who just asked, so nobody waits forever.
+
+    Classes and shares are part of the state (see the `priority` and `share`
+    operations). Usage is only counted by the bot that sees it happen, and
+    starts over when the bot restarts, like the statistics."""
+
+    def __init__(self):
+        self.priorities = {}    # user -> class, unless it's the default
+        self.shares = {}        # user -> share, unless it's 1
+        self._usage = {}        # user -> (seconds held, when it was counted)
+        self._holding = {}      # user -> since when they hold something
+
+    def set_priority(self, user, priority):
+        if priority == DEFAULT_PRIORITY:
+            self.priorities.pop(user, None)
+        else:
+            self.priorities[user] = priority
+        return
+
+    def set_share(self, user, share):
+        if share == 1:
+            self.shares.pop(user, None)
+        else:
+            self.shares[user] = share
+        return
+
+    def key(self, user, now):
+        """Where the user gets in a list if they ask for a resource now."""
+        head_start = PRIORITIES[self.priorities.get(user, DEFAULT_PRIORITY)]
+        penalty = SHARE_PENALTY * self.usage(user, now) / \
+            self.shares.get(user, 1)
+        return round(now - head_start + penalty, 3)
+
+    def usage(self, user, now):
+        """Seconds the user held resources, forgetting half of it every
+        USAGE_HALF_LIFE."""
+        (seconds, when) = self._usage.get(user, (0.0, now))
+        seconds = self._decay(seconds, now - when)
+        if user in self._holding:
+            seconds += now - self._holding[user]
+        return seconds
+
+    def grant(self, user, now):
+        self._holding[user] = now
+        return
+
+    def release(self, user, now):
+        since = self._holding.pop(user, None)
+        if since is None:
+            return
+        (seconds, when) = self._usage.get(user, (0.0, now))
+        self._usage[user] = (self._decay(seconds, now - when) + now - since,
+                             now)
+        return
+
+    def _decay(self, seconds, elapsed):
+        return seconds * math.pow(0.5, float(elapsed) / USAGE_HALF_LIFE)
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def test_priorities(self):
+        """Test if higher classes get ahead, but not forever."""
+        self.scheduler.set_priority('oncall', 'high')
+        self.scheduler.set_priority('batch', 'low')
+        self.assertEquals(self.scheduler.key('someone', 10000), 10000)
+        self.assertEquals(self.scheduler.key('oncall', 10000), 6400)
+        self.assertEquals(self.scheduler.key('batch', 10000), 13600)
+        # a low priority user who waited for more than two hours
+        self.assertTrue(self.scheduler.key('batch', 0) <
+                        self.scheduler.key('oncall', 7201))
+        self.scheduler.set_priority('oncall', 'normal')
+        self.assertEquals(self.scheduler.priorities, {'batch': 'low'})
+        return
+
+    def test_usage(self):
+        """Test if users are pushed back by the time they held something,
+        less with a larger share."""
+        self.scheduler.grant('hog', 0)
+        self.assertEquals(self.scheduler.usage('hog', 3600), 3600)
+        self.scheduler.release('hog', 3600)
+        self.assertEquals(self.scheduler.key('hog', 3600), 4500)
+        self.scheduler.set_share('hog', 2)
+        self.assertEquals(self.scheduler.key('hog', 3600), 4050)
+        self.assertAlmostEqual(
+            self.scheduler.usage('hog', 3600 + USAGE_HALF_LIFE), 1800)
+        self.assertEquals(self.scheduler.key('someone', 3600), 3600)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
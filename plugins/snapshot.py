@@ -0,0 +1,329 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+# ----------------------------------------------------------------------
+#  The snapshots
+# ----------------------------------------------------------------------
+
+# what every snapshot file starts with, before the version
+MAGIC = b'BMSNAP'
+HEADER = struct.Struct('>6sH')
+# the version of the state in the snapshots written now
+VERSION = 1
+# functions that take the state of a version to the next one: when the
+# state changes, bump VERSION and add the function for the old one here
+UPGRADES = {}
+# snapshots file name extension
+EXTENSION = '.bmsnap'
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class SnapshotError(ValueError):
+    """The file isn't a snapshot, it's broken or it's from a newer
+    version."""
+    pass
+
+
+def dumps(state):
+    """The state in the snapshot format: the header (MAGIC and VERSION)
+    followed by the state in MessagePack, so other tools can read it too."""
+    chunks = [HEADER.pack(MAGIC, VERSION)]
+    _encode(state, chunks)
+    return b''.join(chunks)
+
+
+def loads(data):
+    """The state in a snapshot, upgraded to the current VERSION."""
+    if len(data) < HEADER.size:
+        raise SnapshotError('too short for a snapshot')
+    (magic, version) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError('not a snapshot')
+    if version > VERSION:
+        raise SnapshotError('version {version} is newer than this bot '
+                            '({current})'.format(version=version,
+                                                 current=VERSION))
+    data = bytearray(data)
+    try:
+        (state, end) = _decode(data, HEADER.size)
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError):
+        raise SnapshotError('broken snapshot')
+    if end != len(data):
+        raise SnapshotError('broken snapshot')
+
+    while version < VERSION:
+        state = UPGRADES[version](state)
+        version += 1
+    return state
+
+
+def save_snapshot(path, state):
+    """Write the state to a file; the file is replaced only once the new one
+    is safely on disk."""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (handle, temp_path) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as temp:
+        temp.write(dumps(state))
+        temp.flush()
+        os.fsync(temp.fileno())
+    os.rename(temp_path, path)
+    return
+
+
+def load_snapshot(path):
+    with open(path, 'rb') as content:
+        return loads(content.read())
+
+
+def snapshot_settings():
+    """The directory for the snapshots (SNAPSHOT_DIR, by default "snapshots"
+    in FILE_DIR) and the snapshot to load on startup (RESTORE_SNAPSHOT,
+    usually set by `run_will.py --restore`), from Will's settings."""
+    from will import settings
+    directory = getattr(settings, 'SNAPSHOT_DIR', None) or os.path.join(
+        getattr(settings, 'FILE_DIR', './settings/'), 'snapshots')
+    return (directory, getattr(settings, 'RESTORE_SNAPSHOT', None))
+
+
+# internals
+
+_DOUBLE = struct.Struct('>d')
+_TAGGED_DOUBLE = struct.Struct('>Bd')
+
+
+def _encode(value, chunks, texts=None):
+    """Append the value, in MessagePack, to `chunks`; `texts` keeps the
+    strings already encoded, since the same names show up all over the
+    state."""
+    if texts is None:
+        texts = {}
+    if isinstance(value, (str, text_type)):
+        chunks.append(_encode_text(value, texts))
+    elif isinstance(value, (list, tuple)):
+        chunks.append(_container(0x90, 0xdc, len(value)))
+        for item in value:
+            if isinstance(item, (str, text_type)):
+                chunks.append(_encode_text(item, texts))
+            else:
+                _encode(item, chunks, texts)
+    elif isinstance(value, dict):
+        chunks.append(_container(0x80, 0xde, len(value)))
+        for (key, item) in value.items():
+            if isinstance(key, (str, text_type)):
+                chunks.append(_encode_text(key, texts))
+            else:
+                _encode(key, chunks, texts)
+            if isinstance(item, float):
+                chunks.append(_TAGGED_DOUBLE.pack(0xcb, item))
+            else:
+                _encode(item, chunks, texts)
+    elif value is None:
+        chunks.append(b'\xc0')
+    elif value is True:
+        chunks.append(b'\xc3')
+    elif value is False:
+        chunks.append(b'\xc2')
+    elif isinstance(value, float):
+        chunks.append(_TAGGED_DOUBLE.pack(0xcb, value))
+    elif isinstance(value, (int, type(2 ** 64))):
+        chunks.append(_encode_int(value))
+    else:
+        raise TypeError('{value!r} can\'t go in a snapshot'.format(
+            value=value))
+    return
+
+
+def _encode_text(value, texts):
+    encoded = texts.get(value)
+    if encoded is not None:
+        return encoded
+    data = value.encode('utf-8') if isinstance(value, text_type) else value
+    size = len(data)
+    if size < 32:
+        encoded = struct.pack('>B', 0xa0 | size) + data
+    elif size < 2 ** 8:
+        encoded = struct.pack('>BB', 0xd9, size) + data
+    elif size < 2 ** 16:
+        encoded = struct.pack('>BH', 0xda, size) + data
+    else:
+        encoded = struct.pack('>BI', 0xdb, size) + data
+    texts[value] = encoded
+    return encoded
+
+
+def _encode_int(value):
+    if 0 <= value < 128:
+        return struct.pack('>B', value)
+    if -32 <= value < 0:
+        return struct.pack('>b', value)
+    for (code, fmt, low, high) in ((0xd0, '>Bb', -2 ** 7, 2 ** 7),
+                                   (0xd1, '>Bh', -2 ** 15, 2 ** 15),
+                                   (0xd2, '>Bi', -2 ** 31, 2 ** 31),
+                                   (0xd3, '>Bq', -2 ** 63, 2 ** 63),
+                                   (0xcf, '>BQ', 0, 2 ** 64)):
+        if low <= value < high:
+            return struct.pack(fmt, code, value)
+    raise OverflowError('{value} is too large for a snapshot'.format(
+        value=value))
+
+
+def _container(fixed, code, size):
+    """The header of an array (or a map) with `size` items."""
+    if size < 16:
+        return struct.pack('>B', fixed | size)
+    if size < 2 ** 16:
+        return struct.pack('>BH', code, size)
+    return struct.pack('>BI', code + 1, size)
+
+
+# first byte -> (struct format, what it is) for the values with a size or
+# a value of fixed length after the first byte
+_FIXED = {0xcc: ('>B', 'value'), 0xcd: ('>H', 'value'),
+          0xce: ('>I', 'value'), 0xcf: ('>Q', 'value'),
+          0xd0: ('>b', 'value'), 0xd1: ('>h', 'value'),
+          0xd2: ('>i', 'value'), 0xd3: ('>q', 'value'),
+          0xca: ('>f', 'value'), 0xcb: ('>d', 'value'),
+          0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+          0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'),
+          0xde: ('>H', 'map'), 0xdf: ('>I', 'map')}
+_CONSTANTS = {0xc0: None, 0xc2: False, 0xc3: True}
+
+
+def _decode(data, position):
+    """The value starting at `position` and where it ends (which may be past
+    the end of the data, if it's broken)."""
+    first = data[position]
+    position += 1
+    if 0xa0 <= first < 0xc0:
+        end = position + (first & 0x1f)
+        return (data[position:end].decode('utf-8'), end)
+    if first < 0x80:
+        return (first, position)
+    if first >= 0xe0:
+        return (first - 0x100, position)
+    if first < 0x90:
+        (kind, size) = ('map', first & 0x0f)
+    elif first < 0xa0:
+        (kind, size) = ('array', first & 0x0f)
+    elif first in _CONSTANTS:
+        return (_CONSTANTS[first], position)
+    else:
+        (fmt, kind) = _FIXED[first]
+        (size,) = struct.unpack_from(fmt, data, position)
+        position += struct.calcsize(fmt)
+        if kind == 'value':
+            # the value itself, not a size
+            return (size, position)
+
+    if kind == 'str':
+        end = position + size
+        return (data[position:end].decode('utf-8'), end)
+    if kind == 'array':
+        items = []
+        for _ in range(size):
+            first = data[position]
+            if 0xa0 <= first < 0xc0:
+                # the lists are mostly names, read them right here
+                end = position + 1 + (first & 0x1f)
+                items.append(data[position + 1:end].decode('utf-8'))
+                position = end
+            else:
+                (item, position) = _decode(data, position)
+                items.append(item)
+        return (items, position)
+    items = {}
+    for _ in range(size):
+        first = data[position]
+        if 0xa0 <= first < 0xc0:
+            end = position + 1 + (first & 0x1f)
+            key = data[position + 1:end].decode('utf-8')
+            position = end
+        else:
+            (key, position) = _decode(data, position)
+        if data[position] == 0xcb:
+            # and the keys of the users
+            (items[key],) = _DOUBLE.unpack_from(data, position + 1)
+            position += 9
+        else:
+            (items[key], position) = _decode(data, position)
+    return (items, position)
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_values(self):
+        """Test if every kind of value comes back the same."""
+        state = {'none': None, 'bools': [True, False],
+                 'ints': [0, 1, 127, 128, 255, 256, 65536, 2 ** 32, 2 ** 63,
+                          -1, -32, -33, -200, -40000, -2 ** 40],
+                 'floats': [0.5, -1e300, float('-inf')],
+                 'texts': [u'', u'a' * 31, u'b' * 32, u'c' * 300,
+                           u'd' * 70000, u'ma\xe7\xe3'],
+                 'lists': [[], list(range(15)), list(range(16)),
+                           list(range(70000))],
+                 'maps': dict((u'key{0}'.format(number), number)
+                              for number in range(20))}
+        self.assertEquals(loads(dumps(state)), state)
+        self.assertEquals(loads(dumps((1, 2))), [1, 2])
+        self.assertRaises(TypeError, dumps, set([1]))
+        return
+
+    def test_msgpack_bytes(self):
+        """Test if the body is plain MessagePack."""
+        self.assertEquals(dumps({u'a': [1, -1, None]})[HEADER.size:],
+                          b'\x81\xa1a\x93\x01\xff\xc0')
+        return
+
+    def test_broken(self):
+        """Test if broken, foreign and newer snapshots are refused."""
+        data = dumps({u'resources': {u'A': [u'user']}})
+        self.assertRaises(SnapshotError, loads, data[:-1])
+        self.assertRaises(SnapshotError, loads, data + b'\xc0')
+        self.assertRaises(SnapshotError, loads, b'{"state": {}}')
+        self.assertRaises(SnapshotError, loads, b'BM')
+        self.assertRaises(SnapshotError, loads,
+                          HEADER.pack(MAGIC, VERSION + 1) +
+                          data[HEADER.size:])
+        return
+
+    def test_upgrade(self):
+        """Test if old snapshots are upgraded to the current version."""
+        old = HEADER.pack(MAGIC, VERSION - 1) + dumps({})[HEADER.size:]
+        UPGRADES[VERSION - 1] = lambda state: dict(state, upgraded=True)
+        try:
+            self.assertEquals(loads(old), {'upgraded': True})
+        finally:
+            del UPGRADES[VERSION - 1]
+        return
+
+    def test_files(self):
+        """Test if the state survives a trip to the disk."""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'new', 'state' + EXTENSION)
+            save_snapshot(path, {u'resources': {}})
+            save_snapshot(path, {u'resources': {u'A': []}})
+            self.assertEquals(load_snapshot(path),
+                              {u'resources': {u'A': []}})
+            self.assertEquals(os.listdir(os.path.dirname(path)),
+                              ['state' + EXTENSION])
+        finally:
+            shutil.rmtree(directory)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
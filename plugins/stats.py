@@ -0,0 +1,267 @@
+import array
+import math
+import unittest
+
+from plugins.names import NAMES
+
+# ----------------------------------------------------------------------
+#  The statistics
+# ----------------------------------------------------------------------
+
+# kinds of events
+ENQUEUE = 1     # user got in the list
+GRANT = 2       # user got the resource (value: seconds waiting)
+RELEASE = 3     # user released the resource (value: seconds holding it)
+LEAVE = 4       # user left the list before getting it
+
+# events kept in the log
+CAPACITY = 100000
+
+# histogram buckets grow by this factor, so percentiles are within ~10%
+BUCKET_GROWTH = 2 ** 0.25
+BUCKETS = 100
+
+
+class Histogram(object):
+    """Counts of durations in buckets of exponential size: adding a value is
+    O(1) and percentiles only look at the buckets, never at the values."""
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = array.array('l', [0]) * BUCKETS
+        self.total = 0
+
+    def add(self, seconds):
+        if seconds < 1:
+            bucket = 0
+        else:
+            bucket = min(BUCKETS - 1,
+                         1 + int(math.log(seconds, BUCKET_GROWTH)))
+        self.counts[bucket] += 1
+        self.total += 1
+        return
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket with the given percentile, or
+        None if there are no values."""
+        if not self.total:
+            return None
+        wanted = self.total * percent / 100.0
+        seen = 0
+        for (bucket, count) in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                break
+        if bucket == 0:
+            return 1.0
+        return BUCKET_GROWTH ** bucket
+
+
+class EventLog(object):
+    """The last `capacity` events, in a ring of arrays (one per field), so
+    each event takes a couple dozen bytes instead of a tuple of objects.
+    Resources and users are stored as their numbers in NAMES."""
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.kinds = array.array('b', [0]) * capacity
+        self.resources = array.array('l', [0]) * capacity
+        self.users = array.array('l', [0]) * capacity
+        self.values = array.array('d', [0.0]) * capacity
+        self.count = 0          # events ever added
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def add(self, when, kind, resource, user, value=0.0):
+        slot = self.count % self.capacity
+        if self.count >= self.capacity:
+            # the oldest event goes, and its names with it
+            NAMES.release(self.resources[slot])
+            NAMES.release(self.users[slot])
+        self.times[slot] = when
+        self.kinds[slot] = kind
+        self.resources[slot] = NAMES.id(resource)
+        self.users[slot] = NAMES.id(user)
+        self.values[slot] = value
+        self.count += 1
+        return
+
+    def __iter__(self):
+        """The events, oldest first, as (time, kind, resource, user,
+        value)."""
+        for number in range(self.count - len(self), self.count):
+            slot = number % self.capacity
+            yield (self.times[slot], self.kinds[slot],
+                   NAMES.name(self.resources[slot]),
+                   NAMES.name(self.users[slot]), self.values[slot])
+
+
+class ResourceStats(object):
+    """Running totals for a resource, updated with every event."""
+    __slots__ = ('since', 'waits', 'holds', 'busy', 'busy_since', 'depth',
+                 'max_depth', 'depth_area', 'depth_since')
+
+    def __init__(self, now):
+        self.since = now
+        self.waits = Histogram()
+        self.holds = Histogram()
+        self.busy = 0.0         # seconds with someone holding it
+        self.busy_since = None
+        self.depth = 0          # users waiting (not counting the holder)
+        self.max_depth = 0
+        self.depth_area = 0.0   # integral of depth over time
+        self.depth_since = now
+
+    def set_depth(self, depth, now):
+        self.depth_area += self.depth * (now - self.depth_since)
+        self.depth_since = now
+        self.depth = depth
+        self.max_depth = max(self.max_depth, depth)
+        return
+
+    def utilisation(self, now):
+        """Fraction of the time someone was holding the resource."""
+        busy = self.busy
+        if self.busy_since is not None:
+            busy += now - self.busy_since
+        elapsed = now - self.since
+        return busy / elapsed if elapsed > 0 else 0.0
+
+    def average_depth(self, now):
+        area = self.depth_area + self.depth * (now - self.depth_since)
+        elapsed = now - self.since
+        return area / elapsed if elapsed > 0 else float(self.depth)
+
+
+class Stats(object):
+    """Usage of the resources: every event goes to the log and updates the
+    totals of its resource, so asking for the statistics never goes through
+    the history."""
+
+    def __init__(self, capacity=CAPACITY):
+        self.log = EventLog(capacity)
+        self.resources = {}
+        # resource -> user -> when they got in its list (users asked for
+        # several resources together are in several lists)
+        self._enqueued = {}
+
+    def resource(self, resource, now):
+        if resource not in self.resources:
+            self.resources[resource] = ResourceStats(now)
+        return self.resources[resource]
+
+    def forget(self, resource):
+        self.resources.pop(resource, None)
+        self._enqueued.pop(resource, None)
+        return
+
+    def enqueue(self, resource, user, now, depth):
+        self._enqueued.setdefault(resource, {})[user] = now
+        self.log.add(now, ENQUEUE, resource, user)
+        self.resource(resource, now).set_depth(depth, now)
+        return
+
+    def grant(self, resource, user, now, depth):
+        wait = now - self._enqueued.get(resource, {}).pop(user, now)
+        self.log.add(now, GRANT, resource, user, wait)
+        stats = self.resource(resource, now)
+        stats.waits.add(wait)
+        stats.busy_since = now
+        stats.set_depth(depth, now)
+        return
+
+    def release(self, resource, user, now, depth):
+        stats = self.resource(resource, now)
+        hold = now - stats.busy_since if stats.busy_since is not None else 0
+        self.log.add(now, RELEASE, resource, user, hold)
+        stats.holds.add(hold)
+        stats.busy += hold
+        stats.busy_since = None
+        stats.set_depth(depth, now)
+        return
+
+    def leave(self, resource, user, now, depth):
+        self._enqueued.get(resource, {}).pop(user, None)
+        self.log.add(now, LEAVE, resource, user)
+        self.resource(resource, now).set_depth(depth, now)
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        """Test if percentiles are within a bucket of the real value."""
+        histogram = Histogram()
+        self.assertEquals(histogram.percentile(50), None)
+        for seconds in range(1, 1001):
+            histogram.add(seconds)
+        self.assertTrue(500 <= histogram.percentile(50) <= 500 * 1.2)
+        self.assertTrue(950 <= histogram.percentile(95) <= 950 * 1.2)
+        return
+
+
+class TestEventLog(unittest.TestCase):
+
+    def test_ring(self):
+        """Test if only the last events are kept."""
+        log = EventLog(capacity=3)
+        for number in range(5):
+            log.add(number, ENQUEUE, 'A', 'user{0}'.format(number))
+        self.assertEquals(len(log), 3)
+        self.assertEquals([event[3] for event in log],
+                          ['user2', 'user3', 'user4'])
+        return
+
+
+class TestStats(unittest.TestCase):
+
+    def test_resource(self):
+        """Test the totals of a resource used by two users."""
+        stats = Stats()
+        stats.enqueue('A', 'one', 0, 0)
+        stats.grant('A', 'one', 0, 0)
+        stats.enqueue('A', 'two', 10, 1)
+        stats.release('A', 'one', 30, 1)
+        stats.grant('A', 'two', 30, 0)
+        stats.release('A', 'two', 40, 0)
+
+        resource = stats.resources['A']
+        self.assertEquals(resource.waits.total, 2)
+        self.assertEquals(resource.holds.percentile(100),
+                          resource.holds.percentile(95))
+        self.assertTrue(30 <= resource.holds.percentile(100) <= 36)
+        self.assertEquals(resource.utilisation(80), 0.5)
+        self.assertEquals(resource.average_depth(40), 0.5)
+        self.assertEquals(resource.max_depth, 1)
+        return
+
+    def test_several_resources(self):
+        """Test if a user waiting for several resources at once waits for
+        each of them from when they got in its list."""
+        stats = Stats()
+        for resource in ('A', 'B'):
+            stats.enqueue(resource, 'set', 0, 1)
+        stats.grant('A', 'set', 10, 0)
+        stats.grant('B', 'set', 1000, 0)
+        self.assertEquals([event[4] for event in stats.log
+                           if event[1] == GRANT], [10, 1000])
+
+        # giving A back doesn't restart the wait for the others
+        stats.enqueue('C', 'set', 1000, 1)
+        stats.release('A', 'set', 1500, 1)
+        stats.enqueue('A', 'set', 1500, 1)
+        stats.grant('C', 'set', 2000, 0)
+        stats.grant('A', 'set', 2000, 0)
+        self.assertEquals([event[4] for event in stats.log
+                           if event[1] == GRANT], [10, 1000, 1000, 500])
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
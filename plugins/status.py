@@ -0,0 +1,202 @@
+import bisect
+import collections
+import fnmatch
+import threading
+import unittest
+
+from plugins.outbox import MAX_LENGTH
+
+# ----------------------------------------------------------------------
+#  The status report
+# ----------------------------------------------------------------------
+
+# longest page of resources; the rest of the message is for the mention and
+# the header
+PAGE_LENGTH = MAX_LENGTH - 500
+# patterns which pages are kept
+CACHED_PATTERNS = 32
+
+
+def render_line(resource, holder, length):
+    """The line of a resource in the report."""
+    if holder is None:
+        return '{resource}: free'.format(resource=resource)
+    if length > 1:
+        return '{resource}: used by {holder}, {waiting} waiting'.format(
+            resource=resource, holder=holder, waiting=length - 1)
+    return '{resource}: used by {holder}'.format(resource=resource,
+                                                 holder=holder)
+
+
+class Pages(object):
+    """The report for a pattern, split in pages. A page is only joined again
+    when one of its lines changed."""
+
+    def __init__(self, names, lines, page_length):
+        self.names = names      # the resources matching the pattern, sorted
+        self.starts = []        # position in `names` where each page starts
+        self.texts = []         # the pages, None where a line changed
+        length = page_length + 1
+        for (position, name) in enumerate(names):
+            length += len(lines[name]) + 1
+            if length > page_length:
+                self.starts.append(position)
+                self.texts.append(None)
+                length = len(lines[name])
+
+    def page_of(self, name):
+        position = bisect.bisect_left(self.names, name)
+        return bisect.bisect_right(self.starts, position) - 1
+
+    def render(self, lines, page_length):
+        """Join the pages that changed; returns False if one got too long,
+        so the pages have to be split again."""
+        ends = self.starts[1:] + [len(self.names)]
+        for (page, text) in enumerate(self.texts):
+            if text is None:
+                text = '\n'.join(lines[name] for name
+                                 in self.names[self.starts[page]:ends[page]])
+                if len(text) > page_length and \
+                        ends[page] - self.starts[page] > 1:
+                    return False
+                self.texts[page] = text
+        return True
+
+
+class Status(object):
+    """The rendered status of every resource.
+
+    Each resource has its line, rendered again only when its holder or its
+    list changes. Reports for the patterns asked recently are kept as pages:
+    when a line changes, only the page with it in the reports that include the
+    resource is joined again, and adding or removing a resource only drops the
+    reports it matches. Asking for the same report again while nothing in it
+    changed costs a dictionary lookup."""
+
+    def __init__(self, page_length=PAGE_LENGTH):
+        self.page_length = page_length
+        self.names = []             # every resource, sorted
+        self.lines = {}             # resource -> its line
+        self._reports = collections.OrderedDict()   # pattern -> Pages
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, resource, holder, length):
+        line = render_line(resource, holder, length)
+        with self._lock:
+            if resource not in self.lines:
+                bisect.insort(self.names, resource)
+                self.lines[resource] = line
+                self._forget_reports(resource)
+                return
+
+            if self.lines[resource] == line:
+                return
+            self.lines[resource] = line
+            for (pattern, pages) in self._reports.items():
+                if fnmatch.fnmatchcase(resource, pattern):
+                    pages.texts[pages.page_of(resource)] = None
+        return
+
+    def remove(self, resource):
+        with self._lock:
+            if resource not in self.lines:
+                return
+            del self.lines[resource]
+            del self.names[bisect.bisect_left(self.names, resource)]
+            self._forget_reports(resource)
+        return
+
+    def pages(self, pattern='*'):
+        """The report of the resources matching the pattern, as a list of
+        pages no longer than `page_length` (unless a single line is)."""
+        with self._lock:
+            pages = self._reports.pop(pattern, None)
+            if pages is None or not pages.render(self.lines,
+                                                 self.page_length):
+                pages = self._paginate(pattern)
+            self._reports[pattern] = pages
+            while len(self._reports) > CACHED_PATTERNS:
+                self._reports.popitem(last=False)
+            return (len(pages.names), list(pages.texts))
+
+    def _paginate(self, pattern):
+        if pattern == '*':
+            names = list(self.names)
+        else:
+            names = [name for name in self.names
+                     if fnmatch.fnmatchcase(name, pattern)]
+        pages = Pages(names, self.lines, self.page_length)
+        pages.render(self.lines, self.page_length)
+        return pages
+
+    def _forget_reports(self, resource):
+        for pattern in list(self._reports):
+            if fnmatch.fnmatchcase(resource, pattern):
+                del self._reports[pattern]
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.status = Status(page_length=50)
+        for number in range(1, 7):
+            self.status.update('board{0}'.format(number), None, 0)
+        self.status.update('jtag', 'user', 3)
+
+    def test_pages(self):
+        """Test if the lines are split in pages, sorted."""
+        (count, pages) = self.status.pages()
+        self.assertEquals(count, 7)
+        self.assertEquals(pages, ['board1: free\nboard2: free\nboard3: free',
+                                  'board4: free\nboard5: free\nboard6: free',
+                                  'jtag: used by user, 2 waiting'])
+        self.assertEquals(self.status.pages('board[12]'),
+                          (2, ['board1: free\nboard2: free']))
+        self.assertEquals(self.status.pages('nothing*'), (0, []))
+        return
+
+    def test_update(self):
+        """Test if only the page with the changed line is joined again."""
+        self.status.pages()
+        pages = self.status._reports['*']
+        self.status.update('board5', 'u', 1)
+        self.assertEquals(pages.texts[0],
+                          'board1: free\nboard2: free\nboard3: free')
+        self.assertEquals(pages.texts[1], None)
+        self.assertEquals(self.status.pages()[1][1],
+                          'board4: free\nboard5: used by u\nboard6: free')
+        self.assertTrue(self.status._reports['*'] is pages)
+        return
+
+    def test_longer_lines(self):
+        """Test if a page that got too long is split again."""
+        self.status.pages()
+        self.status.update('board2', 'someone-with-a-long-name', 1)
+        (_, pages) = self.status.pages()
+        self.assertEquals(pages[0], 'board1: free')
+        self.assertTrue(all(len(page) <= 50 for page in pages[1:]))
+        return
+
+    def test_add_and_remove(self):
+        """Test if adding or removing a resource drops the reports with
+        it."""
+        self.status.pages('board*')
+        self.status.pages('jtag')
+        self.status.remove('board1')
+        self.status.update('board7', None, 0)
+        self.assertEquals(list(self.status._reports), ['jtag'])
+        self.assertEquals(self.status.pages('board*')[0], 6)
+        self.assertEquals(len(self.status), 7)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
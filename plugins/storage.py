@@ -0,0 +1,329 @@
+import json
+import logging
+import threading
+import unittest
+
+# ----------------------------------------------------------------------
+#  The storages
+# ----------------------------------------------------------------------
+
+
+class Conflict(Exception):
+    """The storage has operations this bot hasn't seen yet, so whatever it
+    decided based on its own state may be wrong. Sync and try again."""
+    pass
+
+
+class Storage(object):
+    """Where the operations done on the resources are kept.
+
+    The bot keeps the whole state in memory and every change is an operation
+    (`add`, `request`, `done`...) sent to the storage with record() and then
+    applied locally; on startup, load() returns the last snapshot of the state
+    and the operations done after it. This base class is the in-memory
+    storage: it keeps nothing, so the state is gone when the bot stops.
+
+    Storages shared by several bots refuse an operation with `Conflict` if
+    another bot changed something first; the bot then gets the missing
+    operations with updates() and runs the command again. subscribe() lets the
+    storage tell the bot when there are updates, without waiting for the next
+    command."""
+
+    def load(self):
+        """Return the last snapshot of the state (None if there isn't one) and
+        a list of (operation, args) done after it."""
+        return (None, [])
+
+    def updates(self):
+        """Like load(), but only with what this bot hasn't seen yet; the state
+        is None unless the bot has to start over from it."""
+        return (None, [])
+
+    def record(self, op, *args):
+        """Queue an operation; returns a sequence number for commit()."""
+        return 0
+
+    def record_all(self, operations):
+        """Queue several (operation, args) at once: all of them or, with
+        `Conflict`, none. Returns the sequence number of the last one."""
+        seq = 0
+        for (op, args) in operations:
+            seq = self.record(op, *args)
+        return seq
+
+    def commit(self, seq):
+        """Wait until the operation `seq` is safely stored."""
+        return
+
+    def append(self, op, *args):
+        """Record an operation and wait until it is stored."""
+        seq = self.record(op, *args)
+        self.commit(seq)
+        return seq
+
+    def needs_snapshot(self):
+        """Tell if there are enough operations to be worth a snapshot."""
+        return False
+
+    def snapshot(self, state):
+        """Save the state, which includes every operation recorded so far, so
+        the operations before it can be dropped."""
+        return
+
+    def subscribe(self, callback):
+        """Call `callback()` when other bots change something."""
+        return
+
+    def close(self):
+        return
+
+
+def from_settings():
+    """Build the storage Will's settings ask for: "file" keeps a journal in
+    FILE_DIR, "redis" shares the state with other bots through REDIS_URL and
+    anything else keeps the state in memory only."""
+    from will import settings
+    backend = getattr(settings, 'STORAGE_BACKEND', None)
+    if backend == 'file':
+        from plugins.journal import Journal
+        return Journal(getattr(settings, 'FILE_DIR', './settings/'))
+    if backend == 'redis':
+        import redis
+        url = getattr(settings, 'REDIS_URL', 'redis://localhost:6379/7')
+        return RedisStorage(redis.StrictRedis.from_url(url))
+    return Storage()
+
+
+# Records operations, if nobody else did one since the version the bot has.
+# KEYS: version, log; ARGV: expected version, channel, operations...
+RECORD_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '0')
+if version ~= tonumber(ARGV[1]) then
+    return -1
+end
+for i = 3, #ARGV do
+    redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+version = version + #ARGV - 2
+redis.call('SET', KEYS[1], version)
+redis.call('PUBLISH', ARGV[2], version)
+return version
+"""
+
+# Replaces the log with a snapshot, if it still has the latest version.
+# KEYS: version, log, snapshot, snapshot version; ARGV: version of the state,
+# snapshot
+SNAPSHOT_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or '0')
+if version ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[3], ARGV[2])
+redis.call('SET', KEYS[4], version)
+redis.call('DEL', KEYS[2])
+return 1
+"""
+
+
+class RedisStorage(Storage):
+    """State shared by several bots through Redis.
+
+    Redis keeps the snapshot, the log of operations after it and the version
+    (the number of operations ever done). Operations are recorded by a Lua
+    script that checks, atomically, that the version is still the one this
+    bot has seen, so two bots can't both give a resource away; after that it
+    publishes the new version so the other bots can catch up. Catching up
+    reads the version of the snapshot and the new part of the log in a single
+    MULTI pipeline; only when someone replaced the log with a new snapshot in
+    the meantime it needs another round to read everything."""
+
+    def __init__(self, client, prefix='boardmanager',
+                 snapshot_every=1000):
+        self.client = client
+        self.snapshot_every = snapshot_every
+        self.version_key = prefix + ':version'
+        self.log_key = prefix + ':log'
+        self.snapshot_key = prefix + ':snapshot'
+        self.base_key = prefix + ':snapshot-version'
+        self.channel = prefix + ':updates'
+
+        self._record = client.register_script(RECORD_SCRIPT)
+        self._snapshot = client.register_script(SNAPSHOT_SCRIPT)
+        self._seen = 0              # last version applied by the bot
+        self._snapshot_seen = 0     # version of the last snapshot
+        self._pubsub = None
+        self._thread = None
+
+    def load(self):
+        self._seen = 0
+        self._snapshot_seen = 0
+        return self.updates(reload=True)
+
+    def updates(self, reload=False):
+        if not reload:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.get(self.base_key)
+            pipe.lrange(self.log_key, self._seen - self._snapshot_seen, -1)
+            (base, log) = pipe.execute()
+            if int(base or 0) == self._snapshot_seen:
+                return (None, self._read_log(log))
+
+        # the log was replaced by a snapshot since we last looked
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(self.snapshot_key)
+        pipe.lrange(self.log_key, 0, -1)
+        (snapshot, log) = pipe.execute()
+
+        state = None
+        base = 0
+        if snapshot:
+            snapshot = json.loads(snapshot)
+            base = snapshot['seq']
+        if reload or base > self._seen:
+            # what we were missing is only in the snapshot, start over
+            state = snapshot['state'] if snapshot else None
+            self._seen = base
+        self._snapshot_seen = base
+        return (state, self._read_log(log))
+
+    def _read_log(self, log):
+        operations = []
+        for line in log:
+            record = json.loads(line)
+            if record['seq'] <= self._seen:
+                continue
+            operations.append((record['op'], record['args']))
+            self._seen = record['seq']
+        return operations
+
+    def record(self, op, *args):
+        return self.record_all([(op, args)])
+
+    def record_all(self, operations):
+        records = [json.dumps({'seq': self._seen + number, 'op': op,
+                               'args': args})
+                   for (number, (op, args)) in enumerate(operations, 1)]
+        result = self._record(keys=[self.version_key, self.log_key],
+                              args=[self._seen, self.channel] + records)
+        if int(result) < 0:
+            raise Conflict(operations[0][0])
+        self._seen += len(records)
+        return self._seen
+
+    def needs_snapshot(self):
+        return self._seen - self._snapshot_seen >= self.snapshot_every
+
+    def snapshot(self, state):
+        snapshot = json.dumps({'seq': self._seen, 'state': state})
+        if self._snapshot(keys=[self.version_key, self.log_key,
+                                self.snapshot_key, self.base_key],
+                          args=[self._seen, snapshot]):
+            self._snapshot_seen = self._seen
+        return
+
+    def subscribe(self, callback):
+        def handler(message):
+            try:
+                if int(message['data']) > self._seen:
+                    callback()
+            except Exception:
+                logging.exception('Failed to sync with the other bots')
+
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.channel: handler})
+        self._thread = self._pubsub.run_in_thread(sleep_time=0.1,
+                                                  daemon=True)
+        return
+
+    def close(self):
+        if self._thread:
+            self._thread.stop()
+            self._thread = None
+        if self._pubsub:
+            self._pubsub.close()
+            self._pubsub = None
+        return
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class TestRedisStorage(unittest.TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.first = RedisStorage(fakeredis.FakeStrictRedis(server=server),
+                                  snapshot_every=3)
+        self.second = RedisStorage(fakeredis.FakeStrictRedis(server=server))
+
+    def test_conflict(self):
+        """Test if a bot can't record an operation before seeing what the
+        other bot did."""
+        self.first.load()
+        self.second.load()
+        self.first.append('add', 'A')
+        self.assertRaises(Conflict, self.second.append, 'add', 'A')
+
+        self.assertEquals(self.second.updates(), (None, [('add', ['A'])]))
+        self.assertEquals(self.second.append('request', 'A', 'user'), 2)
+        self.assertEquals(self.first.updates(),
+                          (None, [('request', ['A', 'user'])]))
+        return
+
+    def test_record_all(self):
+        """Test if several operations are recorded together, or none of them
+        when another bot was first."""
+        self.first.load()
+        self.second.load()
+        self.assertEquals(self.first.record_all([('add', ('A',)),
+                                                 ('add', ('B',))]), 2)
+        self.assertRaises(Conflict, self.second.record_all,
+                          [('add', ('C',)), ('add', ('D',))])
+        self.assertEquals(self.second.updates(),
+                          (None, [('add', ['A']), ('add', ['B'])]))
+        self.assertEquals(self.second.record_all([('add', ('C',))]), 3)
+        return
+
+    def test_snapshot(self):
+        """Test if a bot that missed the operations in a snapshot starts over
+        from it."""
+        self.second.load()
+        self.first.load()
+        for resource in 'ABC':
+            self.first.append('add', resource)
+        self.assertTrue(self.first.needs_snapshot())
+        self.first.snapshot({'resources': {'A': [], 'B': [], 'C': []}})
+        self.assertFalse(self.first.needs_snapshot())
+        self.first.append('remove', 'C')
+
+        (state, operations) = self.second.updates()
+        self.assertEquals(state, {'resources': {'A': [], 'B': [], 'C': []}})
+        self.assertEquals(operations, [('remove', ['C'])])
+        return
+
+    def test_stale_snapshot(self):
+        """Test if a snapshot taken from an old state is ignored."""
+        self.first.load()
+        self.second.load()
+        for resource in 'ABC':
+            self.first.append('add', resource)
+        self.second.updates()
+        self.second.append('remove', 'C')
+        self.first.snapshot({'resources': {'A': [], 'B': [], 'C': []}})
+
+        (state, operations) = RedisStorage(self.first.client).load()
+        self.assertEquals(state, None)
+        self.assertEquals(len(operations), 4)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import unittest
+
+# ----------------------------------------------------------------------
+#  The timers
+# ----------------------------------------------------------------------
+
+
+class TimerHeap(object):
+    """Deadlines for a bunch of keys, kept in a heap.
+
+    Scheduling and cancelling are O(log n) and O(1); cancelled timers stay in
+    the heap, marked as dead, until they reach the top or they become the
+    majority of the heap. Collecting the expired timers only looks at the
+    ones that expired, never at the whole set."""
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}      # key -> [deadline, order, key, alive]
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, deadline):
+        """Set the deadline for the key, replacing the previous one."""
+        self.cancel(key)
+        entry = [deadline, next(self._order), key, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        return
+
+    def cancel(self, key):
+        """Forget the key's deadline, if there is one."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry[3] = False
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [entry for entry in self._heap if entry[3]]
+            heapq.heapify(self._heap)
+        return
+
+    def deadline(self, key):
+        """Return the deadline of the key, or None if it has none."""
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def pop_expired(self, now):
+        """Remove and return the keys which deadline is before now, in
+        deadline order."""
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            (_, _, key, alive) = heapq.heappop(heap)
+            if alive:
+                del self._entries[key]
+                expired.append(key)
+        return expired
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestTimerHeap(unittest.TestCase):
+
+    def test_expire_in_order(self):
+        """Test if the timers expire in deadline order and only when their
+        time comes."""
+        timers = TimerHeap()
+        timers.schedule('b', 20)
+        timers.schedule('a', 10)
+        timers.schedule('c', 30)
+        self.assertEquals(timers.pop_expired(5), [])
+        self.assertEquals(timers.pop_expired(20), ['a', 'b'])
+        self.assertEquals(len(timers), 1)
+        self.assertEquals(timers.deadline('c'), 30)
+        return
+
+    def test_reschedule_and_cancel(self):
+        """Test if rescheduled and cancelled timers don't fire."""
+        timers = TimerHeap()
+        timers.schedule('a', 10)
+        timers.schedule('b', 10)
+        timers.schedule('a', 40)
+        timers.cancel('b')
+        timers.cancel('missing')
+        self.assertEquals(timers.pop_expired(30), [])
+        self.assertFalse('b' in timers)
+        self.assertEquals(timers.pop_expired(40), ['a'])
+        return
+
+    def test_compact(self):
+        """Test if cancelled timers don't pile up in the heap."""
+        timers = TimerHeap()
+        for key in range(1000):
+            timers.schedule(key, key)
+        for key in range(990):
+            timers.cancel(key)
+        self.assertTrue(len(timers._heap) < 100)
+        self.assertEquals(timers.pop_expired(1000), list(range(990, 1000)))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,455 @@
+import array
+import bisect
+import operator
+import unittest
+
+try:
+    from itertools import accumulate
+except ImportError:
+    def accumulate(values):
+        total = 0
+        for value in values:
+            total += value
+            yield total
+
+from plugins.names import NAMES
+
+# ----------------------------------------------------------------------
+#  The waitlist
+# ----------------------------------------------------------------------
+
+# the waiting users are kept in sorted blocks, split in two when they get
+# larger than this
+BLOCK_SIZE = 128
+
+_USERS = operator.attrgetter('users')
+
+
+class Block(object):
+    """Waiting users, sorted by key and arrival: three arrays with the keys,
+    the arrivals and the users (as their numbers in NAMES)."""
+    __slots__ = ('keys', 'arrivals', 'users')
+
+    def __init__(self, keys=None, arrivals=None, users=None):
+        self.keys = keys if keys is not None else array.array('d')
+        self.arrivals = arrivals if arrivals is not None \
+            else array.array('l')
+        self.users = users if users is not None else array.array('l')
+
+    def __len__(self):
+        return len(self.users)
+
+    def find(self, key, arrival):
+        """Where the entry is, or would go, in the block."""
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, start)
+        return bisect.bisect_left(self.arrivals, arrival, start, end)
+
+    def last(self):
+        return (self.keys[-1], self.arrivals[-1])
+
+    def offset(self, number):
+        """Where the user is in the block."""
+        return self.users.index(number)
+
+
+class Waitlist(object):
+    """The list of users of a resource: the first one is the user holding it,
+    the others are waiting for their turn.
+
+    Waiting users are served by key, lowest first, and in the order they got
+    in when the keys are the same (users added without a key get the largest
+    key seen so far, so a list without keys is first come, first served).
+    They are kept in order, in blocks of up to BLOCK_SIZE users, with the last
+    entry of each block to find the block an entry belongs to, and a Fenwick
+    tree counting the users in the blocks: adding someone, giving the
+    resource to the next one, removing someone from the middle of the list
+    and finding the position of a user are all a binary search over the
+    blocks, another one inside a block and O(log n) steps in the tree (plus
+    moving the rest of a small block around, which the arrays do at once).
+
+    Blocks are arrays instead of lists of tuples, so a waiting user takes 24
+    bytes in them, and the map from each user to their block takes the rest:
+    the key and the arrival of a user are read from the block, once the scan
+    of its user numbers finds them. Users keep a reference to their number
+    in NAMES while they are in the list, so the names of users who left can
+    be forgotten; `clear` gives them all back."""
+    __slots__ = ('_holder', '_holder_key', '_blocks', '_lasts', '_tree',
+                 '_index', '_next_arrival', '_last_key')
+
+    def __init__(self, users=None):
+        self._holder = None     # number of the user holding it
+        self._holder_key = None
+        self._blocks = []
+        self._lasts = []        # (key, arrival) of the last entry of each block
+        self._tree = [0]        # 1-based Fenwick tree over the block sizes
+        self._index = {}        # waiting user number -> their Block
+        self._next_arrival = 0
+        self._last_key = 0
+        for user in users or []:
+            self.append(user)
+
+    # list-like interface
+
+    def __len__(self):
+        return len(self._index) + (self._holder is not None)
+
+    def __contains__(self, user):
+        number = NAMES.find(user)
+        return number is not None and \
+            (number in self._index or number == self._holder)
+
+    def __iter__(self):
+        if self._holder is not None:
+            yield NAMES.name(self._holder)
+        for block in self._blocks:
+            for number in block.users:
+                yield NAMES.name(number)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if position < 0 or position >= len(self):
+            raise IndexError('waitlist index out of range')
+
+        if position == 0:
+            return NAMES.name(self._holder)
+        (block, offset) = self._find(position - 1)
+        return NAMES.name(self._blocks[block].users[offset])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Waitlist({users!r})'.format(users=list(self))
+
+    def append(self, user, key=None):
+        """Add a user to the list; if someone is holding the resource, they
+        wait behind everyone with a lower key."""
+        if user in self:
+            raise ValueError('{user} is already in the list'.format(
+                user=user))
+
+        if key is None:
+            key = self._last_key
+        self._last_key = max(self._last_key, key)
+        if self._holder is None:
+            self._holder = NAMES.id(user)
+            self._holder_key = key
+            return
+
+        number = NAMES.id(user)
+        entry = (key, self._next_arrival)
+        self._next_arrival += 1
+        self._insert(entry, number)
+        return
+
+    def popleft(self):
+        """Remove and return the user holding the resource; the next one
+        gets it."""
+        if self._holder is None:
+            raise IndexError('pop from an empty waitlist')
+        user = NAMES.name(self._holder)
+        NAMES.release(self._holder)
+        self._holder = None
+        self._holder_key = None
+        if self._blocks:
+            first = self._blocks[0]
+            self._holder = first.users[0]
+            self._holder_key = first.keys[0]
+            del self._index[self._holder]
+            self._delete(0, 0)
+        return user
+
+    def remove(self, user):
+        """Remove a user from any position in the list."""
+        number = self._number(user)
+        if number is None:
+            self.popleft()
+            return
+        (block, offset) = self._find_user(number)
+        del self._index[number]
+        self._delete(block, offset)
+        NAMES.release(number)
+        return
+
+    def clear(self):
+        """Remove everyone, giving their numbers back to NAMES."""
+        while self._holder is not None:
+            self.popleft()
+        return
+
+    def index(self, user):
+        """Return the position of the user in the list, 0 being the user
+        holding the resource."""
+        number = self._number(user)
+        if number is None:
+            return 0
+        (block, offset) = self._find_user(number)
+        return 1 + self._prefix(block) + offset
+
+    def key(self, user):
+        """The key the user got in the list with."""
+        number = self._number(user)
+        if number is None:
+            return self._holder_key
+        (block, offset) = self._find_user(number)
+        return self._blocks[block].keys[offset]
+
+    def next_key(self):
+        """The lowest key of the users waiting, or None."""
+        return self._blocks[0].keys[0] if self._blocks else None
+
+    # internals
+
+    def _number(self, user):
+        """The number of a waiting user, or None for the holder."""
+        number = NAMES.find(user)
+        if number is not None:
+            if number == self._holder:
+                return None
+            if number in self._index:
+                return number
+        raise ValueError('{user} is not in the list'.format(user=user))
+
+    def _find_user(self, number):
+        """The block of a waiting user, and where they are in it."""
+        found = self._index[number]
+        return (bisect.bisect_left(self._lasts, found.last()),
+                found.offset(number))
+
+    def _locate(self, entry):
+        """The block of the entry, and where it is (or goes) in it."""
+        block = bisect.bisect_left(self._lasts, entry)
+        if block == len(self._blocks):
+            # after everyone: the end of the last block
+            block -= 1
+        return (block, self._blocks[block].find(*entry))
+
+    def _insert(self, entry, number):
+        if not self._blocks:
+            self._blocks.append(Block())
+            self._lasts.append(entry)
+            self._tree.append(0)
+        (block, offset) = self._locate(entry)
+        found = self._blocks[block]
+        found.keys.insert(offset, entry[0])
+        found.arrivals.insert(offset, entry[1])
+        found.users.insert(offset, number)
+        self._index[number] = found
+        if offset == len(found) - 1:
+            self._lasts[block] = entry
+        if len(found) > BLOCK_SIZE:
+            self._split(block)
+        else:
+            self._add(block, 1)
+        return
+
+    def _delete(self, block, offset):
+        found = self._blocks[block]
+        del found.keys[offset]
+        del found.arrivals[offset]
+        del found.users[offset]
+        if not found:
+            del self._blocks[block]
+            del self._lasts[block]
+            self._rebuild(block)
+            return
+        if offset == len(found):
+            self._lasts[block] = found.last()
+        self._add(block, -1)
+        return
+
+    def _split(self, block):
+        found = self._blocks[block]
+        half = len(found) // 2
+        second = Block(found.keys[half:], found.arrivals[half:],
+                       found.users[half:])
+        del found.keys[half:]
+        del found.arrivals[half:]
+        del found.users[half:]
+        for number in second.users:
+            self._index[number] = second
+        self._blocks.insert(block + 1, second)
+        self._lasts.insert(block, found.last())
+        self._rebuild(block)
+        return
+
+    def _rebuild(self, start):
+        """Count the users in the blocks again from the block `start` on,
+        after blocks come or go there; the nodes before it still count the
+        same blocks."""
+        counts = [self._prefix(start)]
+        counts.extend(map(len, map(_USERS, self._blocks[start:])))
+        prefix = list(accumulate(counts))   # prefix[i - start] = P(i)
+        tree = self._tree[:start + 1]
+        for i in range(start + 1, len(self._blocks) + 1):
+            # node i counts the blocks from i - lowbit(i), i & (i - 1), to i
+            low = i & (i - 1)
+            tree.append(prefix[i - start] - (prefix[low - start]
+                                             if low >= start
+                                             else self._prefix(low)))
+        self._tree = tree
+        return
+
+    def _prefix(self, block):
+        """Number of users in the blocks before `block`."""
+        total = 0
+        tree = self._tree
+        while block > 0:
+            total += tree[block]
+            block -= block & -block
+        return total
+
+    def _add(self, block, value):
+        tree = self._tree
+        size = len(tree)
+        i = block + 1
+        while i < size:
+            tree[i] += value
+            i += i & -i
+        return
+
+    def _find(self, position):
+        """The block with the waiting user in `position` (0 being the first
+        one waiting), and where the user is in it."""
+        tree = self._tree
+        block = 0
+        step = 1
+        while step * 2 < len(tree):
+            step *= 2
+        while step:
+            if block + step < len(tree) and tree[block + step] <= position:
+                block += step
+                position -= tree[block]
+            step //= 2
+        return (block, position)
+
+
+# ----------------------------------------------------------------------
+#  The tests
+# ----------------------------------------------------------------------
+
+class TestWaitlist(unittest.TestCase):
+
+    def test_fifo(self):
+        """Test if users come out in the order they got in."""
+        waitlist = Waitlist(['A', 'B', 'C'])
+        self.assertEquals(waitlist.popleft(), 'A')
+        self.assertEquals(waitlist.popleft(), 'B')
+        self.assertEquals(waitlist.popleft(), 'C')
+        self.assertFalse(waitlist)
+        self.assertRaises(IndexError, waitlist.popleft)
+        return
+
+    def test_remove_from_middle(self):
+        """Test if removing someone from the middle keeps the positions
+        right."""
+        waitlist = Waitlist(['A', 'B', 'C', 'D'])
+        waitlist.remove('B')
+        self.assertEquals(list(waitlist), ['A', 'C', 'D'])
+        self.assertEquals(waitlist.index('C'), 1)
+        self.assertEquals(waitlist.index('D'), 2)
+        self.assertEquals(waitlist[1], 'C')
+        self.assertEquals(waitlist[-1], 'D')
+        self.assertFalse('B' in waitlist)
+        self.assertRaises(ValueError, waitlist.remove, 'B')
+        self.assertRaises(ValueError, waitlist.index, 'B')
+        return
+
+    def test_duplicate(self):
+        """Test if the list refuses the same user twice."""
+        waitlist = Waitlist(['A'])
+        self.assertRaises(ValueError, waitlist.append, 'A')
+        return
+
+    def test_keys(self):
+        """Test if waiting users are served by key, never taking the
+        resource from the holder."""
+        waitlist = Waitlist()
+        waitlist.append('holder', 50)
+        waitlist.append('late', 30)
+        waitlist.append('early', 10)
+        waitlist.append('same', 30)
+        waitlist.append('nokey')
+        self.assertEquals(list(waitlist),
+                          ['holder', 'early', 'late', 'same', 'nokey'])
+        self.assertEquals(waitlist.index('same'), 3)
+        self.assertEquals(waitlist.key('nokey'), 50)
+        self.assertEquals(waitlist.key('holder'), 50)
+        self.assertEquals(waitlist.next_key(), 10)
+        self.assertEquals(waitlist.popleft(), 'holder')
+        self.assertEquals(waitlist[0], 'early')
+        self.assertEquals(waitlist.key('early'), 10)
+        self.assertEquals(waitlist.next_key(), 30)
+        return
+
+    def test_far_positions(self):
+        """Test if the positions far back in the list, in other blocks,
+        follow the changes."""
+        waitlist = Waitlist(range(3 * BLOCK_SIZE))
+        last = 3 * BLOCK_SIZE - 1
+        self.assertEquals(waitlist.index(last), last)
+        waitlist.remove(1)
+        self.assertEquals(waitlist.index(last), last - 1)
+        waitlist.append('first', -1)
+        self.assertEquals(waitlist.index(last), last)
+        self.assertEquals(waitlist.index('first'), 1)
+        self.assertEquals(waitlist[last], last)
+        self.assertEquals(waitlist[BLOCK_SIZE + 1], BLOCK_SIZE + 1)
+        for user in range(2, 2 * BLOCK_SIZE):
+            waitlist.remove(user)
+        self.assertEquals(waitlist.index(last), last - 2 * BLOCK_SIZE + 2)
+        self.assertEquals(list(waitlist)[:3], [0, 'first', 2 * BLOCK_SIZE])
+        return
+
+    def test_names_released(self):
+        """Test if the names of the users who leave are given back."""
+        waitlist = Waitlist(['released-holder', 'released-1',
+                             'released-2', 'released-3'])
+        waitlist.remove('released-2')
+        self.assertEquals(waitlist.popleft(), 'released-holder')
+        self.assertEquals(NAMES.find('released-holder'), None)
+        self.assertEquals(NAMES.find('released-2'), None)
+        self.assertEquals(waitlist.key('released-3'), 0)
+        waitlist.clear()
+        self.assertEquals(len(waitlist), 0)
+        self.assertEquals(NAMES.find('released-1'), None)
+        self.assertEquals(NAMES.find('released-3'), None)
+        return
+
+    def test_compare_with_sorted_list(self):
+        """Test a long sequence of operations against a sorted list."""
+        waitlist = Waitlist()
+        expected = []
+        holder = None
+        counter = 0
+        for round in range(2000):
+            for _ in range(3):
+                user = 'user{0}'.format(counter)
+                key = (counter * 7919) % 1000
+                waitlist.append(user, key)
+                if holder is None:
+                    holder = user
+                else:
+                    expected.append((key, counter, user))
+                counter += 1
+            expected.sort()
+            waitlist.remove(expected.pop(len(expected) // 2)[2])
+            self.assertEquals(waitlist.popleft(), holder)
+            holder = expected.pop(0)[2]
+
+        users = [holder] + [user for (_, _, user) in expected]
+        self.assertEquals(len(waitlist), len(users))
+        self.assertEquals(list(waitlist), users)
+        for position in (0, 1, len(users) // 2, len(users) - 1):
+            self.assertEquals(waitlist[position], users[position])
+            self.assertEquals(waitlist.index(users[position]), position)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
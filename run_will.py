@@ -1,7 +1,13 @@
 #!/usr/bin/env python
-from will.main import WillBot
+import os
+import sys
 
 if __name__ == '__main__':
+    # --restore <snapshot file>: start with the state in the snapshot (Will
+    # takes the WILL_* environment variables as settings)
+    if len(sys.argv) == 3 and sys.argv[1] == '--restore':
+        os.environ['WILL_RESTORE_SNAPSHOT'] = os.path.abspath(sys.argv[2])
+
+    from will.main import WillBot
     bot = WillBot()
     bot.bootstrap()
-    
\ No newline at end of file